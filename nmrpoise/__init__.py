@@ -126,6 +126,61 @@ def parse_log(fname="."):
     return pd.DataFrame(data=data)
 
 
+def parse_db(fname, routine=None, cf=None):
+    """
+    Read the database of completed optimisations written by the backend.
+
+    Parameters
+    ----------
+    fname : |Path| or str
+        Path to the database file. This is ``poise.db`` inside the
+        ``$TS/exp/stan/nmr/py/user/poise_backend`` folder.
+    routine : str, optional
+        Only return runs of the routine with this name.
+    cf : str, optional
+        Only return runs which used this cost function.
+
+    Returns
+    -------
+    db_df : :class:`DataFrame <pandas.DataFrame>`
+        DataFrame with rows corresponding to optimisations, in chronological
+        order. The columns are the same as those returned by
+        :func:`parse_log`, plus the date, the termination message, the probe,
+        solvent, instrument and sample name, the path to the spectrum, and the
+        full history of points sampled and cost function values (``xvals``
+        and ``fvals``). The time taken is given in seconds.
+    """
+    from .poise_backend.database import get_runs
+
+    fname = Path(fname).resolve()
+    if not fname.exists():
+        raise FileNotFoundError(f"The database '{fname}' was not found.")
+    runs = get_runs(fname, routine=routine, cf=cf)[::-1]
+
+    def unlist(x):
+        # Same as parse_log(): remove the list if it's a singleton
+        return x[0] if isinstance(x, list) and len(x) == 1 else x
+
+    data = {}
+    data["routine"] = [run["routine"] for run in runs]
+    data["initial"] = [unlist(run["init"]) for run in runs]
+    data["param"] = [run["pars"] for run in runs]
+    data["lb"] = [unlist(run["lb"]) for run in runs]
+    data["ub"] = [unlist(run["ub"]) for run in runs]
+    data["tol"] = [unlist(run["tol"]) for run in runs]
+    data["algorithm"] = [run["algorithm"] for run in runs]
+    data["costfn"] = [run["cf"] for run in runs]
+    data["auprog"] = [run["au"] for run in runs]
+    data["optimum"] = [unlist(run["optimum"]) for run in runs]
+    data["fbest"] = [run["fbest"] for run in runs]
+    data["nfev"] = [run["nfev"] for run in runs]
+    data["time"] = [run["time"] for run in runs]
+    for col in ["date", "message", "probe", "solvent", "instrument",
+                "sample", "spectrum", "xvals", "fvals"]:
+        data[col] = [run[col] for run in runs]
+    return pd.DataFrame(data=data)
+
+
 def xmean(series):
     """
     An aggregator function that allows you to average lists in DataFrame
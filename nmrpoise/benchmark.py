@@ -0,0 +1,452 @@
+"""
+benchmark.py
+------------
+
+Benchmarks for the functions which read spectra (``poise_backend/
+cfhelpers.py``), the built-in cost functions, and the optimisers. The time
+taken, the peak memory allocated, and (for the optimisers) the number of
+function evaluations are saved to a JSON file, which can later be compared
+against another run in order to catch regressions.
+
+Run ``python -m nmrpoise.benchmark -h`` for the command-line options.
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+import re
+import sys
+import json
+import inspect
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from time import perf_counter
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ._version import __version__
+from .synthetic import write_1d, write_2d
+from .poise_backend import costfunctions
+from .poise_backend.shared import _g
+from .poise_backend.cfhelpers import getpar, get1d_real, get1d_fid, _get_2d
+from .poise_backend.optpoise import (nelder_mead, multid_search,
+                                     pybobyqa_interface, deco_count, scale,
+                                     unscale)
+
+
+# Dataset sizes: number of (complex) points in 1D, and SI in each dimension
+# in 2D.
+SIZES_1D = [2 ** 14, 2 ** 16, 2 ** 18, 2 ** 20]
+SIZES_2D = [(256, 256), (1024, 1024), (4096, 4096)]
+# Smaller sets of sizes for a quick check.
+QUICK_SIZES_1D = [2 ** 14]
+QUICK_SIZES_2D = [(256, 256)]
+# Metrics which are compared by compare_results(), and the default relative
+# increase in each which counts as a regression.
+METRICS = {"time": 0.25, "peak_memory": 0.1, "nfev": 0}
+# Optimisers benchmarked on the test functions, and their dimensions and
+# noise levels (the standard deviation of the additive Gaussian noise).
+OPTIMISERS = {"nm": nelder_mead, "mds": multid_search,
+              "bobyqa": pybobyqa_interface}
+OPT_DIMENSIONS = [2, 4]
+OPT_NOISE = [0, 0.01]
+
+
+def sphere(x):
+    return np.sum((x - 0.5) ** 2)
+
+
+def rosenbrock(x):
+    return np.sum(100 * (x[1:] - x[:-1] ** 2) ** 2 + (1 - x[:-1]) ** 2)
+
+
+def styblinski_tang(x):
+    return np.sum(x ** 4 - 16 * x ** 2 + 5 * x) / 2
+
+
+# Test functions for the optimisers: the function, the bounds (the same in
+# every dimension), and the position of the global minimum (also the same in
+# every dimension).
+TEST_FUNCTIONS = {"sphere": (sphere, (-2, 2), 0.5),
+                  "rosenbrock": (rosenbrock, (-2, 2), 1.0),
+                  "styblinski_tang": (styblinski_tang, (-5, 5), -2.903534)}
+
+
+def measure(fn, repeats=5):
+    """
+    Measures the time taken by, and the memory allocated by, a function.
+
+    The function is called once to warm up (e.g. to fill the disk cache),
+    then *repeats* times to time it, then once more with `tracemalloc`
+    running to find the peak memory allocated.
+
+    Parameters
+    ----------
+    fn : function
+        The function to measure, which is called without any arguments.
+    repeats : int, optional
+        Number of calls to time.
+
+    Returns
+    -------
+    dict
+        The shortest time taken (in seconds) as ``time``, and the peak memory
+        allocated (in bytes) as ``peak_memory``.
+    """
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        fn()
+        times.append(perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"time": min(times), "peak_memory": peak}
+
+
+def _write_2d(p_expno, si, xdim=None, seed=0):
+    """
+    Writes a 2D dataset with random data in ``2rr``, stored in submatrices.
+    Returns the path to the procno folder.
+    """
+    si1, si2 = si
+    rng = np.random.default_rng(seed)
+    rr = rng.uniform(-2 ** 20, 2 ** 20, size=si)
+    acqus = {"SW_H": 5000.0, "SFO1": 500.0, "O1": 2500.0}
+    # The raw data are never read, so a ser file with one point per FID
+    # avoids writing hundreds of MB for the largest spectra.
+    return write_2d(p_expno, rr, ser=np.zeros((si1, 1), dtype=np.complex128),
+                    acqus=acqus, acqu2s=acqus,
+                    xdim=xdim or (min(si1, 64), min(si2, 256)))
+
+
+def _write_1d(p_expno, size, seed=0):
+    """
+    Writes a 1D dataset with *size* complex points in the FID and in the
+    spectrum, containing a few lines and some noise. The parameters needed by
+    the built-in cost functions are also set.
+    """
+    rng = np.random.default_rng(seed)
+    sw_h = 5000.0
+    t = np.arange(size) / sw_h
+    fid = sum(np.exp((2j * np.pi * freq - np.pi * 3) * t)
+              for freq in [-1500, -200, 800])
+    fid = fid + 0.01 * (rng.standard_normal(size)
+                        + 1j * rng.standard_normal(size))
+    acqus = {"SW_H": sw_h, "SFO1": 500.0, "O1": 2500.0, "SPOFFS2": 0,
+             "L3": 16, "D6": 0}
+    return write_1d(p_expno, fid, acqus=acqus, procs={"SI": size})
+
+
+def bench_readers(p_data, sizes_1d=SIZES_1D, sizes_2d=SIZES_2D, repeats=5):
+    """
+    Benchmarks the functions which read datasets, and the built-in cost
+    functions, on synthetic datasets of different sizes.
+
+    Parameters
+    ----------
+    p_data : |Path|
+        Folder in which the datasets are written.
+    sizes_1d : list of int, optional
+        Numbers of complex points in the 1D datasets.
+    sizes_2d : list of (int, int), optional
+        Sizes (SI in F1 and F2) of the 2D datasets.
+    repeats : int, optional
+        Number of calls to time for each benchmark (see `measure()`).
+
+    Returns
+    -------
+    results : dict
+        The results of `measure()`, keyed by the name of the benchmark, e.g.
+        ``get1d_real[16384]`` or ``cf:minabsint[16384]``.
+    """
+    results = {}
+    # Cost functions read the active spectrum from _g, so it has to be set
+    # (and restored afterwards).
+    saved = (_g.p_spectrum, _g.spec_f1p, _g.spec_f2p)
+    _g.spec_f1p, _g.spec_f2p = None, None
+    cfs = [(name, fn) for name, fn
+           in inspect.getmembers(costfunctions, inspect.isfunction)
+           if fn.__module__ == costfunctions.__name__]
+    try:
+        for size in sizes_1d:
+            p_spec = _write_1d(p_data / f"1d_{size}", size)
+            _g.p_spectrum = p_spec
+            benchmarks = {
+                "getpar": lambda: getpar("SW_H", p_spec),
+                "get1d_real": lambda: get1d_real(p_spec=p_spec),
+                "get1d_fid": lambda: get1d_fid(p_spec=p_spec),
+            }
+            benchmarks.update({f"cf:{name}": fn for name, fn in cfs})
+            for name, fn in benchmarks.items():
+                results[f"{name}[{size}]"] = measure(fn, repeats)
+
+        for si in sizes_2d:
+            label = f"{si[0]}x{si[1]}"
+            p_spec = _write_2d(p_data / f"2d_{label}", si)
+            results[f"getpar[{label}]"] = measure(
+                lambda: getpar("SI", p_spec), repeats)
+            results[f"_get_2d[{label}]"] = measure(
+                lambda: _get_2d("2rr", p_spec=p_spec), repeats)
+    finally:
+        _g.p_spectrum, _g.spec_f1p, _g.spec_f2p = saved
+    return results
+
+
+def bench_optimisers(optimisers=OPTIMISERS, functions=TEST_FUNCTIONS,
+                     dimensions=OPT_DIMENSIONS, noise=OPT_NOISE, repeats=5):
+    """
+    Benchmarks the optimisers on the test functions, with and without noise.
+
+    The test functions are set up in the same way as a routine would be: the
+    tolerance is 1% of the range between the bounds, and the optimisation
+    starts a quarter of the way between the lower and upper bounds. The
+    noise uses the same seed in every optimisation, so the number of
+    function evaluations is reproducible.
+
+    Parameters
+    ----------
+    optimisers : dict, optional
+        The optimisers to benchmark, keyed by name.
+    functions : dict, optional
+        Test functions (see `TEST_FUNCTIONS`).
+    dimensions : list of int, optional
+        The numbers of parameters to optimise.
+    noise : list of float, optional
+        Standard deviations of the noise added to the test functions.
+    repeats : int, optional
+        Number of optimisations to time (see `measure()`).
+
+    Returns
+    -------
+    results : dict
+        The results of `measure()`, together with the number of function
+        evaluations (``nfev``) and the largest distance between the optimum
+        found and the true minimum, in units of the tolerance (``error``).
+        Keys are the names of the benchmarks, e.g. ``nm:rosenbrock[2,0.01]``.
+    """
+    results = {}
+    for (opt_name, optimfn), (fn_name, (fn, bounds, xmin)), n, sd in (
+            (o, f, n, sd) for o in optimisers.items()
+            for f in functions.items() for n in dimensions for sd in noise):
+        lb, ub = np.full(n, bounds[0]), np.full(n, bounds[1])
+        tol = 0.01 * (ub - lb)
+        x0 = lb + 0.25 * (ub - lb)
+        scaled_x0, scaled_lb, scaled_ub, scaled_tol = scale(
+            x0, lb, ub, tol, scaleby="tols")
+        outcome = {}
+
+        def optimise():
+            rng = np.random.default_rng(0)
+
+            @deco_count
+            def cf(x, *args):
+                x = unscale(x, lb, ub, tol, scaleby="tols")
+                return fn(x) + (sd * rng.standard_normal() if sd else 0)
+
+            outcome["result"] = optimfn(cf, scaled_x0, scaled_tol,
+                                        scaled_lb, scaled_ub)
+
+        result = measure(optimise, repeats)
+        opt = outcome["result"]
+        xbest = unscale(opt.xbest, lb, ub, tol, scaleby="tols")
+        result["nfev"] = int(opt.nfev)
+        result["error"] = float(np.max(np.abs(xbest - xmin) / tol))
+        results[f"{opt_name}:{fn_name}[{n},{sd:g}]"] = result
+    return results
+
+
+def run_benchmarks(quick=False, repeats=5, match=None):
+    """
+    Runs all the benchmarks.
+
+    Parameters
+    ----------
+    quick : bool, optional
+        Only use the smallest dataset sizes.
+    repeats : int, optional
+        Number of calls to time for each benchmark.
+    match : str, optional
+        Regular expression. If given, only the results whose names match it
+        are kept.
+
+    Returns
+    -------
+    dict
+        Dictionary with the results (keyed by the name of the benchmark) as
+        ``results``, and information about the system and the versions of
+        POISE and its dependencies as ``metadata``.
+    """
+    with tempfile.TemporaryDirectory() as p_data:
+        results = bench_readers(
+            Path(p_data),
+            sizes_1d=QUICK_SIZES_1D if quick else SIZES_1D,
+            sizes_2d=QUICK_SIZES_2D if quick else SIZES_2D,
+            repeats=repeats)
+    results.update(bench_optimisers(repeats=repeats))
+    if match is not None:
+        results = {k: v for k, v in results.items() if re.search(match, k)}
+    metadata = {"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "nmrpoise": __version__,
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "platform": platform.platform(),
+                "processor": platform.processor(),
+                "repeats": repeats}
+    return {"metadata": metadata, "results": results}
+
+
+def compare_results(baseline, new, tolerances=None):
+    """
+    Compares two sets of benchmark results.
+
+    Parameters
+    ----------
+    baseline : dict
+        The results to compare against, as returned by `run_benchmarks()`
+        (or read from the JSON file).
+    new : dict
+        The new results.
+    tolerances : dict, optional
+        The relative increase in each metric which is counted as a regression
+        (see `METRICS` for the defaults).
+
+    Returns
+    -------
+    compare_df : :class:`DataFrame <pandas.DataFrame>`
+        DataFrame with one row for each benchmark and metric found in both
+        sets of results, with the baseline and new values, their ratio, and
+        whether the new value is a regression.
+    """
+    tolerances = dict(METRICS, **(tolerances or {}))
+    rows = []
+    for name, old_result in baseline["results"].items():
+        new_result = new["results"].get(name)
+        if new_result is None:
+            continue
+        for metric, tol in tolerances.items():
+            if metric not in old_result or metric not in new_result:
+                continue
+            old, now = old_result[metric], new_result[metric]
+            ratio = now / old if old else (1.0 if now == old else np.inf)
+            rows.append({"benchmark": name, "metric": metric,
+                         "baseline": old, "new": now, "ratio": ratio,
+                         "regression": ratio > 1 + tol})
+    return pd.DataFrame(rows, columns=["benchmark", "metric", "baseline",
+                                       "new", "ratio", "regression"])
+
+
+def main(argv=None):
+    """
+    Command-line interface. Returns 1 if a comparison found any regressions,
+    and 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m nmrpoise.benchmark",
+        description=("Benchmark the POISE backend (reading spectra, cost"
+                     " functions, and optimisers), or compare two sets of"
+                     " benchmark results.")
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    run_parser = subparsers.add_parser(
+        "run",
+        help="Run the benchmarks."
+    )
+    run_parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="Save the results to a JSON file."
+    )
+    run_parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="Only use the smallest datasets."
+    )
+    run_parser.add_argument(
+        "-n",
+        "--repeats",
+        type=int,
+        default=5,
+        help="Number of times each benchmark is timed. (default: 5)"
+    )
+    run_parser.add_argument(
+        "-k",
+        "--match",
+        default=None,
+        help=("Only keep benchmarks whose names match this regular"
+              " expression.")
+    )
+    run_parser.add_argument(
+        "--compare",
+        default=None,
+        metavar="BASELINE",
+        help="Compare the results against a baseline JSON file."
+    )
+    compare_parser = subparsers.add_parser(
+        "compare",
+        help="Compare two JSON files with benchmark results."
+    )
+    compare_parser.add_argument(
+        "baseline",
+        help="The baseline results."
+    )
+    compare_parser.add_argument(
+        "new",
+        help="The new results."
+    )
+    for p in [run_parser, compare_parser]:
+        for metric, tol in METRICS.items():
+            p.add_argument(
+                "--" + metric.replace("_", "-") + "-tol",
+                type=float,
+                default=tol,
+                help=(f"Relative increase in {metric} which counts as a"
+                      f" regression. (default: {tol})")
+            )
+    args = parser.parse_args(argv)
+    tolerances = {metric: getattr(args, metric + "_tol")
+                  for metric in METRICS}
+
+    if args.command == "run":
+        new = run_benchmarks(quick=args.quick, repeats=args.repeats,
+                             match=args.match)
+        if args.output is not None:
+            with open(args.output, "w") as fp:
+                json.dump(new, fp, indent=2)
+        with pd.option_context("display.max_rows", None,
+                               "display.width", 200):
+            print(pd.DataFrame.from_dict(new["results"], orient="index"))
+        if args.compare is None:
+            return 0
+        baseline_fname = args.compare
+    else:
+        with open(args.new, "r") as fp:
+            new = json.load(fp)
+        baseline_fname = args.baseline
+    with open(baseline_fname, "r") as fp:
+        baseline = json.load(fp)
+
+    compare_df = compare_results(baseline, new, tolerances)
+    regressions = compare_df[compare_df["regression"]]
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(compare_df.to_string(index=False))
+        if len(regressions) > 0:
+            print(f"\n{len(regressions)} regression(s) found:")
+            print(regressions.to_string(index=False))
+        else:
+            print("\nNo regressions found.")
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
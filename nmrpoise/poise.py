@@ -11,11 +11,13 @@ for a more thorough introduction.
 SPDX-License-Identifier: GPL-3.0-or-later
 """
 
-from __future__ import division, with_statement
+from __future__ import division, print_function, with_statement
 
 import os
 import re
 import json
+import time
+import socket
 import subprocess
 import argparse
 from datetime import datetime
@@ -28,9 +30,14 @@ from de.bruker.nmr.prsc.dbxml.ParfileLocator import getParfileDirs
 tshome = getTopspinHome()
 p_poise = os.path.join(tshome, "exp/stan/nmr/py/user/poise_backend")
 p_backend = os.path.join(p_poise, "backend.py")
+p_server = os.path.join(p_poise, "server.py")
 p_routines = os.path.join(p_poise, "routines")
 p_python3 = r"/usr/local/bin/python"
-Routine = namedtuple("Routine", "name pars lb ub init tol cf au")
+Routine = namedtuple("Routine",
+                     "name pars lb ub init tol cf au"
+                     " constraints transforms steps target stagnation")
+# Fields after `au` are optional, so that older routine files can be loaded.
+Routine.__new__.__defaults__ = (None, None, None, None, None)
 version = "1.2.3"
 
 
@@ -52,8 +59,8 @@ def main(args):
         if not os.path.isdir(folder):
             os.makedirs(folder)
     # Check that cost functions folder actually has some cost functions
-    _cfs = detect_costfunctions()
-    if len(_cfs) == 0:
+    saved_cfs = detect_costfunctions()
+    if len(saved_cfs) == 0:
         err_exit("No cost functions were found. Please define a cost function "
                  ", or reinstall poise to obtain the defaults.")
 
@@ -80,7 +87,7 @@ def main(args):
         # Get the Routine object.
         routine = get_new_routine()
         # Store the routine for future usage
-        with open(os.path.join(p_routines, routine.name + ".json"), "wb") as f:
+        with open(os.path.join(p_routines, routine.name + ".json"), "w") as f:
             json.dump(routine._asdict(), f)
         routine_id = routine.name
     # Otherwise, load a saved routine.
@@ -125,7 +132,6 @@ def main(args):
     # keys).
     check_routine(routine)
     # Check that the cost function exists
-    saved_cfs = detect_costfunctions().keys()
     if routine.cf not in saved_cfs:
         err_exit("The associated cost function {} could not be"
                  " found.".format(routine.cf))
@@ -148,11 +154,19 @@ def main(args):
     check_python3path()
 
     # Check that the backend script is intact
-    if not os.path.isfile(p_backend):
+    if not os.path.isfile(p_server if args.daemon else p_backend):
         err_exit("Backend script not found. Please reinstall poise.")
 
+    # The proxy mode only makes sense for 2D experiments.
+    if args.proxy_td1 > 0 and GETACQUDIM() != 2:
+        err_exit("The --proxy-td1 option can only be used with 2D"
+                 " experiments.")
+
+    # Convert the time budget to seconds.
+    maxtime = process_time(args.maxtime)
+
     # Make sure that args.algorithm is a valid algorithm.
-    if args.algorithm not in ["nm", "mds", "bobyqa"]:
+    if args.algorithm not in ["nm", "mds", "bobyqa", "auto"]:
         # Have to use ERRMSG because MSG() is modal
         ERRMSG("Optimisation algorithm '{}' not found; "
                "using BOBYQA instead".format(args.algorithm))
@@ -161,32 +175,59 @@ def main(args):
     # Before we start the main loop, we need to kill off any other backend
     # processes that are still alive. (We don't do it too early, otherwise we
     # could accidentally terminate a POISE run by running something innocuous
-    # like poise -l.)
-    kill_remaining_backends()
+    # like poise -l.) The daemon is left running, since other optimisations
+    # may be using it.
+    kill_remaining_backends(keep_daemon=True)
+
+    # Original values of any acquisition parameters overridden by the backend
+    # (in multi-fidelity mode), so that they can be restored afterwards.
+    original_pars = {}
 
     # We need to catch java.lang.Error throughout the main loop so that cleanup
     # can be performed if the script is killed from within TopSpin. See #23.
+    backend = None
     try:
-        backend = subprocess.Popen([p_python3, '-u', p_backend],
-                                   stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE)
+        if args.daemon:
+            backend = connect_daemon("run", start=True)
+        else:
+            backend = subprocess.Popen([p_python3, '-u', p_backend],
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       universal_newlines=True)
+        # Acquisition parameters to override in the exploratory stage of a
+        # multi-fidelity optimisation.
+        explore = []
+        if args.explore_ns > 0:
+            explore.append("NS={}".format(args.explore_ns))
+        if args.proxy_td1 > 0:
+            explore.append("TD1={}".format(args.proxy_td1))
         # Pass key information to the backend script
-        for item in [args.algorithm, routine_id, p_spectrum, args.maxfev]:
-            print >>backend.stdin, item
+        for item in [args.algorithm, routine_id, p_spectrum, args.maxfev,
+                     int(args.warm), args.noise_reps, " ".join(explore),
+                     int(args.resume), maxtime, int(args.separable),
+                     int(args.refine), args.restarts]:
+            print(item, file=backend.stdin)
         backend.stdin.flush()
 
-        # Main loop, controlled by the lines printed by the backend.
-        first_expno = True
+        # Main loop, controlled by the lines printed by the backend. When
+        # resuming with separate expnos, the current expno already contains
+        # the last spectrum of the interrupted run, so don't overwrite it.
+        first_expno = not args.resume
         while True:
             # Read in what the backend has to say.
-            line = backend.stdout.readline()
+            line = backend.stdout.readline().strip()
 
             # CASE 1 -- Optimisation has converged (or terminated with
             #           CostFunctionError after at least one acquisition)
             if line.startswith("optima:"):
                 optima = line.split()[1:]
                 # Get the optimiser message as well.
-                opt_message = backend.stdout.readline()
+                opt_message = backend.stdout.readline().strip()
+                # The daemon closes the connection once it has finished
+                # writing to poise.log.
+                if args.daemon:
+                    backend.stdout.read()
+                    backend.close()
                 break
 
             # CASE 2 -- Optimisation terminated before first acquisition
@@ -221,6 +262,10 @@ def main(args):
                         first_expno = False
                 # Make sure we're at the correct dataset.
                 RE(current_dataset)
+                # Apply (or undo) any parameter overrides requested by the
+                # backend. These come after a '|', e.g. "values: 1.0 | NS=1".
+                line, _, fidelity = line.partition("|")
+                set_fidelity(fidelity.split(), original_pars)
                 # Obtain the values and set them
                 values = line.split()[1:]
                 if len(values) != len(routine.pars):
@@ -246,8 +291,8 @@ def main(args):
                     raise RuntimeError("Acquisition stopped prematurely. "
                                        "poise has been terminated.")
                 # Tell backend script it's done
-                print >>backend.stdin, "done"
-                print >>backend.stdin, make_p_spectrum()
+                print("done", file=backend.stdin)
+                print(make_p_spectrum(), file=backend.stdin)
                 backend.stdin.flush()
 
             # CASE 5 - Traceback for backend error
@@ -265,8 +310,10 @@ def main(args):
 
     # Cleanup code if anything goes wrong.
     except (Error, RuntimeError) as e:
-        # Reset TI to empty string
+        # Reset TI to empty string, and any overridden parameters to their
+        # original values
         PUTPAR("TI", " ")
+        set_fidelity([], original_pars)
         # For some really silly reason, I can't just call
         # kill_remaining_backends() here, or else if the *original* POISE is
         # killed (using TopSpin's `kill`), it throws a
@@ -275,19 +322,27 @@ def main(args):
         # file. In principle there's nothing *wrong* with that because the
         # .pidXXX file will be cleaned up on the next run, but this just works
         # more cleanly.
-        XCMD("xpy poise --kill")
+        # The daemon shouldn't be killed, though: closing the connection is
+        # enough to stop the optimisation.
+        if args.daemon:
+            if backend is not None:
+                backend.close()
+        else:
+            XCMD("xpy poise --kill")
         # BTW, err_exit() only gets called if it's RuntimeError. I don't know
         # why. If it's killed via TopSpin, then it just shows
         # java.lang.ThreadDeath as usual.
-        err_exit("Error during acquisition loop:\n{}".format(e.message),
-                 log=True)
+        err_exit("Error during acquisition loop:\n{}".format(e), log=True)
 
     # Optimisation successfully ended, or prematurely ended?
-    opt_success = opt_message == "Optimisation terminated successfully."
+    opt_success = (opt_message
+                   == "Optimisation terminated successfully due to"
+                   " convergence.")
 
     # Store the optima in the (final) dataset, and show a message to the user
     # if not in quiet mode.
     RE(current_dataset)
+    set_fidelity([], original_pars)
     s = opt_message + "\n"
     for par, optimum in zip(routine.pars, optima):
         so_far = "" if opt_success else " (so far)"
@@ -598,7 +653,7 @@ def load_routine(routine_name):
     Routine
         The Routine object.
     """
-    with open(os.path.join(p_routines, routine_name + ".json"), "rb") as f:
+    with open(os.path.join(p_routines, routine_name + ".json"), "r") as f:
         routine = Routine(**json.load(f))
     return routine
 
@@ -622,6 +677,28 @@ def check_routine(routine):
     except AttributeError:
         err_exit("The routine file is invalid.\n"
                  "Please delete it and recreate it from within poise.")
+    if not isinstance(routine.constraints, (list, type(None))):
+        err_exit("The constraints of the routine {} should be a list of"
+                 " expressions.".format(routine.name))
+    if (routine.transforms is not None
+            and (not isinstance(routine.transforms, list)
+                 or len(routine.transforms) != len(routine.pars))):
+        err_exit("The transforms of the routine {} should be a list with one"
+                 " entry per parameter.".format(routine.name))
+    if (routine.steps is not None
+            and (not isinstance(routine.steps, list)
+                 or len(routine.steps) != len(routine.pars))):
+        err_exit("The steps of the routine {} should be a list with one"
+                 " entry per parameter.".format(routine.name))
+    if not isinstance(routine.target, (int, float, type(None))):
+        err_exit("The target of the routine {} should be a number."
+                 .format(routine.name))
+    if (routine.stagnation is not None
+            and (not isinstance(routine.stagnation, list)
+                 or len(routine.stagnation) != 2)):
+        err_exit("The stagnation criterion of the routine {} should be a list"
+                 " containing a number of evaluations and a relative"
+                 " improvement.".format(routine.name))
 
 
 def routine_to_str(routine):
@@ -699,8 +776,16 @@ def detect_costfunctions():
         Dictionary where keys are the names of the cost function and values are
         their docstrings.
     """
+    # If the daemon is running, it can do this without starting Python.
+    daemon = connect_daemon("cfs")
+    if daemon is not None:
+        try:
+            return json.loads(daemon.stdout.readline())
+        finally:
+            daemon.close()
     p_get_cfs = os.path.join(p_poise, "get_cfs.py")
-    p = subprocess.Popen([p_python3, p_get_cfs], stdout=subprocess.PIPE)
+    p = subprocess.Popen([p_python3, p_get_cfs], stdout=subprocess.PIPE,
+                         universal_newlines=True)
     fdict_as_str, _ = p.communicate()
     return json.loads(fdict_as_str)
 
@@ -742,7 +827,10 @@ def convert_name(name):
     # GETPAR() accepts: CNST 1, P 1, D 1, PLW 1, PLdB 1 (note small d), GPZ 1
     #                   SPW 1, SPdB 1, SPOFFS 1, SPOAL 1,
     #               but O1, O1P, SFO1 (note no space)
+    #               and 1 TD for the indirect dimension (the "td1" command)
     ts_name = name.upper()
+    if ts_name == "TD1":
+        return "1 TD"
     ts_namel = ts_name.rstrip("1234567890")   # the word
     ts_namer = ts_name[len(ts_namel):]        # the number
     # Add a space if needed
@@ -800,12 +888,45 @@ def convert_name_and_putpar(name, val):
     """
     try:
         val = float(val)
-        PUTPAR(convert_name(name), str(val))
+        # Integer-valued parameters (e.g. loop counters) can't be set using
+        # a string like "3.0".
+        if val.is_integer():
+            PUTPAR(convert_name(name), str(int(val)))
+        else:
+            PUTPAR(convert_name(name), str(val))
     except ValueError:
         err_exit("The value {} for parameter {} "
                  "was invalid.".format(val, name))
 
 
+def set_fidelity(overrides, original_pars):
+    """
+    Sets the acquisition parameters which the backend asked to be overridden
+    for the next spectrum (in multi-fidelity mode), and restores any
+    parameters which were overridden before but no longer are.
+
+    Parameters
+    ----------
+    overrides : list of str
+        The overrides, e.g. ["NS=1"].
+    original_pars : dict
+        The original values of all parameters which are currently overridden.
+        This is modified in place.
+
+    Returns
+    -------
+    None
+    """
+    requested = dict(item.split("=", 1) for item in overrides)
+    for par, value in requested.items():
+        if par not in original_pars:
+            original_pars[par] = GETPAR(convert_name(par))
+        PUTPAR(convert_name(par), value)
+    for par in list(original_pars.keys()):
+        if par not in requested:
+            PUTPAR(convert_name(par), original_pars.pop(par))
+
+
 def process_values(parname, input_string):
     """
     Does some processing on user input to allow familiar hacks, like
@@ -848,6 +969,36 @@ def process_values(parname, input_string):
                  "Please try again.".format(input_string, parname))
 
 
+def process_time(input_string):
+    """
+    Converts a duration given on the command line, such as "90s", "45m" or
+    "2h", into seconds. Numbers without a suffix are taken to be seconds.
+
+    Parameters
+    ----------
+    input_string : str
+        The duration.
+
+    Returns
+    -------
+    float
+        The duration in seconds.
+    """
+    units = {"s": 1, "m": 60, "h": 3600}
+    try:
+        if input_string[-1:] in units:
+            t = float(input_string[:-1]) * units[input_string[-1]]
+        else:
+            t = float(input_string)
+    except ValueError:
+        err_exit("'{}' was not a valid time. Please use a number of seconds,"
+                 " or a number followed by 's', 'm', or 'h'."
+                 "".format(input_string))
+    if t < 0:
+        err_exit("The time budget cannot be negative.")
+    return t
+
+
 def make_p_spectrum():
     """
     Constructs the path to the procno folder of the active spectrum.
@@ -971,11 +1122,20 @@ def pulprog_contains_wvm():
     return False
 
 
-def kill_remaining_backends():
+def kill_remaining_backends(keep_daemon=False):
     """
     Checks the poise_backend folder for any .pidXXXX files (which represent
     backends that have not exited), then kills all the associated PIDs and
     deletes the files.
+
+    Parameters
+    ----------
+    keep_daemon : bool, optional
+        Whether to leave the backend daemon running.
+
+    Returns
+    -------
+    None
     """
     for file in os.listdir(p_poise):
         if file.startswith(".pid"):
@@ -984,10 +1144,147 @@ def kill_remaining_backends():
             except ValueError:  # not an int
                 pass
             else:
+                if keep_daemon and read_daemon_pidfile(file) is not None:
+                    continue
                 kill_pid(file[4:])
                 os.remove(os.path.join(p_poise, file))
 
 
+def read_daemon_pidfile(file):
+    """
+    Reads a .pidXXXX file in the poise_backend folder. The backend daemon
+    writes its address and the token needed to use it to this file, in the
+    format "daemon <host> <port> <token>", whereas the files of normal
+    backends are empty. The daemon's file can only be read by the user who
+    started it.
+
+    Parameters
+    ----------
+    file : str
+        The name of the file.
+
+    Returns
+    -------
+    (host, port, token) : (str, int, str) or None
+        The address of the daemon and its token, or None if the file does not
+        belong to the daemon (or has already been removed, or belongs to
+        another user).
+    """
+    try:
+        with open(os.path.join(p_poise, file), "r") as f:
+            words = f.read().split()
+    except (IOError, OSError):
+        return None
+    if len(words) != 4 or words[0] != "daemon":
+        return None
+    return words[1], int(words[2]), words[3]
+
+
+class DaemonConnection(object):
+    """
+    Connection to the backend daemon. This has ``stdin`` and ``stdout``
+    attributes, like the subprocess.Popen object of a normal backend. The
+    token is sent straight away, so that the daemon accepts the connection.
+    """
+    def __init__(self, host, port, token):
+        self.socket = socket.create_connection((host, port))
+        self.stdin = self.socket.makefile("w")
+        self.stdout = self.socket.makefile("r")
+        print(token, file=self.stdin)
+
+    def close(self):
+        for f in [self.stdin, self.stdout]:
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        self.socket.close()
+
+
+def find_daemon():
+    """
+    Connects to the backend daemon, if it is running. Pidfiles left behind by
+    daemons which are no longer running are deleted.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    DaemonConnection or None
+        The connection, or None if the daemon is not running.
+    """
+    for file in os.listdir(p_poise):
+        if not file.startswith(".pid"):
+            continue
+        daemon = read_daemon_pidfile(file)
+        if daemon is None:
+            continue
+        try:
+            return DaemonConnection(*daemon)
+        except (IOError, OSError):
+            # Connection refused: the daemon is no longer running.
+            os.remove(os.path.join(p_poise, file))
+    return None
+
+
+def connect_daemon(command, start=False):
+    """
+    Connects to the backend daemon and sends it a command ("run" or "cfs").
+
+    Parameters
+    ----------
+    command : str
+        The command to send.
+    start : bool, optional
+        Whether to start the daemon if it is not running.
+
+    Returns
+    -------
+    DaemonConnection or None
+        The connection, or None if the daemon is not running (and *start* is
+        False).
+    """
+    daemon = find_daemon()
+    if daemon is None and start:
+        daemon = start_daemon()
+    if daemon is not None:
+        print(command, file=daemon.stdin)
+        daemon.stdin.flush()
+    return daemon
+
+
+def start_daemon(timeout=60):
+    """
+    Starts the backend daemon and connects to it. Raises RuntimeError if the
+    daemon has not started listening within *timeout* seconds.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Time to wait for the daemon, in seconds.
+
+    Returns
+    -------
+    DaemonConnection
+        The connection to the daemon.
+    """
+    # The daemon never prints anything, but it must not hold on to TopSpin's
+    # stdout either.
+    devnull = open(os.devnull, "w")
+    process = subprocess.Popen([p_python3, "-u", p_server], stdout=devnull)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The backend daemon could not be started.")
+        daemon = find_daemon()
+        if daemon is not None:
+            return daemon
+        time.sleep(0.05)
+    raise RuntimeError("The backend daemon took too long to start.")
+
+
 def kill_pid(pid):
     """
     Kills a process with PID pid.
@@ -1037,7 +1334,9 @@ def create_routine(cli_args):
         err_exit("poise --create: invalid input")
     # If we got here, the input is probably OK.
     routine = Routine(name, [param], [minval], [maxval], [init], [tol], cf, au)
-    with open(os.path.join(p_routines, routine.name + ".json"), "wb") as f:
+    if not os.path.isdir(p_routines):
+        os.makedirs(p_routines)
+    with open(os.path.join(p_routines, routine.name + ".json"), "w") as f:
         json.dump(routine._asdict(), f)
     EXIT()
 
@@ -1107,8 +1406,11 @@ if __name__ == "__main__":
         "-a",
         "--algorithm",
         default="bobyqa",
-        choices=["nm", "mds", "bobyqa"],
-        help="Optimisation algorithm to use. (default: 'bobyqa')"
+        choices=["nm", "mds", "bobyqa", "auto"],
+        help=("Optimisation algorithm to use. 'auto' lets the backend choose "
+              "based on the routine, the noise level, and previous runs "
+              "(and uses Brent's method for routines with one parameter). "
+              "(default: 'bobyqa')")
     )
     me_group.add_argument(
         "--create",
@@ -1130,7 +1432,8 @@ if __name__ == "__main__":
     me_group.add_argument(
         "--kill",
         action="store_true",
-        help=("Kill POISE backends that may still be running.")
+        help=("Kill POISE backends that may still be running, including the "
+              "daemon.")
     )
     me_group.add_argument(
         "-l",
@@ -1144,6 +1447,24 @@ if __name__ == "__main__":
         action="store_true",
         help="Show the POISE version and exit."
     )
+    parser.add_argument(
+        "-d",
+        "--daemon",
+        action="store_true",
+        help=("Run the optimisation in the backend daemon, which is started "
+              "if it is not already running, and then stays running so that "
+              "later optimisations start more quickly. Use 'poise --kill' to "
+              "stop it. (default: off)")
+    )
+    parser.add_argument(
+        "--explore-ns",
+        type=int,
+        default=0,
+        metavar="NS",
+        help=("Use multi-fidelity mode: first optimise roughly using spectra "
+              "acquired with NS scans, then refine using the full number of "
+              "scans. Use 0 to disable. (default: 0)")
+    )
     parser.add_argument(
         "--maxfev",
         type=int,
@@ -1152,6 +1473,38 @@ if __name__ == "__main__":
               "any limit (technically there is a hard limit, which is 500 "
               "times the number of parameters being optimised). (default: 0)")
     )
+    parser.add_argument(
+        "--maxtime",
+        type=str,
+        default="0",
+        metavar="TIME",
+        help=("Time budget for the optimisation, e.g. '90s', '45m', or '2h' "
+              "(a number without a unit is taken to be seconds). The "
+              "optimisation stops, returning the best point found so far, "
+              "once the next spectrum would take it beyond the budget. Use 0 "
+              "to not enforce any limit. (default: 0)")
+    )
+    parser.add_argument(
+        "--noise-reps",
+        type=int,
+        default=0,
+        metavar="N",
+        help=("Acquire N replicate spectra at the initial point before "
+              "optimising, in order to estimate the noise level of the cost "
+              "function. The optimisation then stops once differences in the "
+              "cost function are within the noise. Must be at least 2 to "
+              "have any effect. (default: 0)")
+    )
+    parser.add_argument(
+        "--proxy-td1",
+        type=int,
+        default=0,
+        metavar="TD1",
+        help=("For 2D experiments only: use multi-fidelity mode, where the "
+              "exploratory spectra are acquired with only TD1 points in the "
+              "indirect dimension. Can be combined with --explore-ns. Use 0 "
+              "to disable. (default: 0)")
+    )
     parser.add_argument(
         "-q",
         "--quiet",
@@ -1160,6 +1513,32 @@ if __name__ == "__main__":
               "Using this flag is necessary if POISE is to be run under "
               "automation. (default: off)")
     )
+    parser.add_argument(
+        "--refine",
+        action="store_true",
+        help=("Return the minimum of a quadratic model fitted to the spectra "
+              "acquired near the optimum, instead of the best point acquired. "
+              "The model is always written to poise.log. (default: off)")
+    )
+    parser.add_argument(
+        "--restarts",
+        type=int,
+        default=0,
+        metavar="N",
+        help=("Restart the optimisation up to N times once it has converged, "
+              "alternately around the best point and from a point far from "
+              "all points evaluated so far. All restarts share the --maxfev "
+              "and --maxtime budgets. (default: 0)")
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=("Resume an optimisation which was interrupted, using the "
+              "checkpoint saved in the current expno. Spectra which were "
+              "already acquired are not acquired again. The algorithm and "
+              "other optimisation settings are taken from the checkpoint. "
+              "(default: off)")
+    )
     parser.add_argument(
         "-s",
         "--separate",
@@ -1167,6 +1546,23 @@ if __name__ == "__main__":
         help=("Use separate expnos for each function evaluation. (default: "
               "off)")
     )
+    parser.add_argument(
+        "--separable",
+        action="store_true",
+        help=("Test which parameters interact with each other, using a few "
+              "extra spectra at the start of the optimisation, and optimise "
+              "groups of parameters which don't interact separately. "
+              "(default: off)")
+    )
+    parser.add_argument(
+        "-w",
+        "--warm",
+        action="store_true",
+        help=("Start the optimisation from the optimum of the most recent "
+              "completed run of the same routine (as recorded in poise.log), "
+              "using a smaller initial simplex or trust region. (default: "
+              "off)")
+    )
     args = parser.parse_args()
 
     # List
@@ -9,10 +9,13 @@ SPDX-License-Identifier: GPL-3.0-or-later
 """
 
 import os
+import re
 import sys
 import json
+import sqlite3
 from traceback import print_exc
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import partial, update_wrapper
 from pathlib import Path
 from collections import namedtuple
 from contextlib import contextmanager
@@ -30,26 +33,77 @@ if __name__ == "__main__" and __package__ is None:
     sys.path.insert(1, str(Path(__file__).parents[1].resolve()))
     __import__(__package__)
 
-from .optpoise import (scale, unscale, deco_count,
-                       nelder_mead, multid_search, pybobyqa_interface,
-                       OutOfBoundsError)
+from .optpoise import (scale, unscale,
+                       nelder_mead, multid_search, pybobyqa_interface, brent,
+                       compass_search,
+                       round_to_steps, fit_quadratic,
+                       NotAcquiredError, OutOfBoundsError,
+                       OptResult, MAGIC_TOL,
+                       NOISE_THRESHOLD, MESSAGE_OPT_SUCCESS,
+                       MESSAGE_OPT_NOISE_LIMITED,
+                       MESSAGE_OPT_MAXFEV_REACHED, MESSAGE_OPT_TARGET_REACHED,
+                       MESSAGE_OPT_PREMATURE_TERMINATION)
 from .shared import _g
 from .cfhelpers import *
+from . import database
+from .constraints import make_violation_function
 from . import costfunctions
 from . import costfunctions_user
 
-Routine = namedtuple("Routine", "name pars lb ub init tol cf au")
+# Fields after `au` are optional, so that routines saved by older versions of
+# POISE can still be loaded.
+Routine = namedtuple("Routine",
+                     "name pars lb ub init tol cf au"
+                     " constraints transforms steps target stagnation")
+Routine.__new__.__defaults__ = (None,) * 5
+# Size of the initial simplex / trust region when warm-starting from a
+# previous optimum. This is smaller than the default (MAGIC_TOL * 10) because
+# the previous optimum is expected to be close to the new one.
+WARM_INIT_STEP = MAGIC_TOL * 3
+# In multi-fidelity mode, the exploratory stage is carried out with tolerances
+# that are this many times larger than the routine tolerances. The
+# full-fidelity stage then starts with a simplex / trust region of this size.
+EXPLORE_TOL_FACTOR = 3
+# Name of the checkpoint file, which lives next to poise.log.
+CHECKPOINT_FNAME = "poise_checkpoint.json"
+# Settings for automatic optimiser selection: see choose_optimiser().
+AUTO_MIN_RUNS = 3
+AUTO_FBEST_RTOL = 0.1
+AUTO_NOISE_FRACTION = 0.05
+# In separable mode, two parameters are considered to interact if their
+# interaction term is larger than this fraction of their main effects (and
+# larger than the noise).
+SEPARABILITY_RTOL = 0.1
+# Restarts: see run_restarts(). A restart counts as an improvement if it
+# lowers the best cost function value by more than this fraction (or the
+# noise level, if larger). Spread-out starting points are chosen from this
+# many random candidates. Only optimisations which ended with one of these
+# messages are restarted.
+RESTART_RTOL = 0.01
+RESTART_CANDIDATES = 1000
+RESTART_MESSAGES = [MESSAGE_OPT_SUCCESS, MESSAGE_OPT_NOISE_LIMITED]
+# Initial step of the lattice search for discrete parameters (see
+# run_lattice_search()): one tolerance, or one lattice spacing if that is
+# larger. The search starts from the optimum found by the optimiser, so it is
+# not expected to have far to go.
+LATTICE_INIT_STEP = MAGIC_TOL
 
 
 @contextmanager
-def pidfile():
+def pidfile(text=""):
     """
     Context manager that creates a '.pid<PID>' file inside the poise_backend
-    directory. Deletes the file once the backend exits.
+    directory, containing *text*. Deletes the file once the backend exits.
+    The file can only be read by the current user (on Windows, this depends
+    on the permissions of the folder instead).
     """
     pid = os.getpid()
     pid_fname = Path(__file__).resolve().expanduser().parent / f".pid{pid}"
-    pid_fname.touch()
+    fd = os.open(pid_fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # The mode above is only used if the file didn't exist already.
+    os.chmod(pid_fname, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
     try:
         yield
     finally:
@@ -59,37 +113,56 @@ def pidfile():
 
 def main_wrapper():
     """
-    Wrapper for main(). This performs several tasks:
+    Wrapper for main(), used when the backend is started by the frontend as a
+    subprocess. This implements a context manager to print the backend PID to
+    a file ($ts/py/user/poise_backend/.pid<PID>), deleting the file after the
+    backend completes, and runs run_session() inside it.
+    """
+    with pidfile() as _:
+        run_session()
+
+
+def run_session():
+    """
+    Runs one optimisation for the frontend connected to stdin and stdout.
+    This performs several tasks:
       1. Reads in the global variables printed by the frontend.
-      2. Implements a context manager to print the backend PID to a file
-         ($ts/py/user/poise_backend/pid.log), deleting the file after the
-         backend completes.
+      2. Runs main().
       3. Catches all exceptions, propagates them to the frontend by printing to
          stdout, and prints the full traceback to the backend error log.
     """
-    with pidfile() as _:
-        try:
-            from .shared import _g
-            # Set global variables by reading in input from frontend.
-            _g.optimiser = input()
-            _g.routine_id = input()
-            _g.p_spectrum = Path(input())
-            _g.maxfev = int(input())
-            _g.p_optlog = _g.p_spectrum.parents[1] / "poise.log"
-            _g.p_errlog = _g.p_spectrum.parents[1] / "poise_err_backend.log"
-            # Run main routine.
-            main()
-        except Exception as e:
-            # Because the frontend is only reading one line at a time, there's
-            # no point in printing the entire traceback. Thus we just print a
-            # very short summary line.
-            print(f"Backend exception: {type(e).__name__}({repr(e.args)})")
-            # Then print it to the errlog.
-            with open(_g.p_errlog, "a") as ferr:
-                print("======= From backend =======", file=ferr)
-                print(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), file=ferr)
-                print_exc(file=ferr)
-                print("\n\n", file=ferr)
+    try:
+        # Set global variables by reading in input from frontend.
+        _g.optimiser = input()
+        _g.routine_id = input()
+        _g.p_spectrum = Path(input())
+        _g.maxfev = int(input())
+        _g.warm = bool(int(input()))
+        _g.noise_reps = int(input())
+        _g.explore = parse_fidelity(input())
+        _g.resume = bool(int(input()))
+        _g.maxtime = float(input())
+        _g.separable = bool(int(input()))
+        _g.refine = bool(int(input()))
+        _g.restarts = int(input())
+        _g.p_optlog = _g.p_spectrum.parents[1] / "poise.log"
+        _g.p_errlog = _g.p_spectrum.parents[1] / "poise_err_backend.log"
+        # Run main routine.
+        main()
+    except Exception as e:
+        # Because the frontend is only reading one line at a time, there's no
+        # point in printing the entire traceback. Thus we just print a very
+        # short summary line.
+        print(f"Backend exception: {type(e).__name__}({repr(e.args)})")
+        # Then print it to the errlog (if the frontend got far enough to tell
+        # us where it is).
+        if _g.p_errlog is None:
+            return
+        with open(_g.p_errlog, "a") as ferr:
+            print("======= From backend =======", file=ferr)
+            print(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), file=ferr)
+            print_exc(file=ferr)
+            print("\n\n", file=ferr)
 
 
 def main():
@@ -97,29 +170,79 @@ def main():
     Main routine.
     """
     tic = datetime.now()
+    _g.t_start = tic
+    _g.eval_times = []
 
     # Load the routine and cost function.
     routine, cost_function = get_routine_cf(_g.routine_id)
+    routine = apply_steps(routine)
+    _g.violation = None
+    if routine.constraints:
+        _g.violation = make_violation_function(routine.constraints,
+                                               routine.pars)
 
-    # Choose the optimisation function. optpoise implements a PyBOBYQA
-    # interface so that the returned result has the same attributes as our
-    # other optimisers.
-    optimfndict = {"nm": nelder_mead,
-                   "mds": multid_search,
-                   "bobyqa": pybobyqa_interface
-                   }
-    try:
-        optimfn = optimfndict[_g.optimiser.lower()]
-    except KeyError:
-        raise ValueError(f"Invalid optimiser {_g.optimiser} specified.")
+    # If resuming, restore the settings of the interrupted run. The
+    # optimisation is then simply run again from the same starting point:
+    # because the optimisers are deterministic, they request exactly the same
+    # points as before, and acquire_nmr() returns the recorded cost function
+    # values for these instead of acquiring the spectra again.
+    _g.p_checkpoint = _g.p_spectrum.parents[1] / CHECKPOINT_FNAME
+    _g.replay = []
+    if _g.resume:
+        checkpoint = load_checkpoint(_g.p_checkpoint)
+        if checkpoint is None:
+            raise FileNotFoundError(f"No checkpoint found at"
+                                    f" {_g.p_checkpoint}.")
+        if checkpoint["routine"] != routine._asdict():
+            raise ValueError("The routine has been modified since the"
+                             " checkpoint was saved.")
+        _g.optimiser = checkpoint["optimiser"]
+        _g.maxfev = checkpoint["maxfev"]
+        _g.noise_reps = checkpoint["noise_reps"]
+        _g.explore = checkpoint["explore"]
+        _g.separable = checkpoint["separable"]
+        _g.restarts = checkpoint["restarts"]
+        _g.warm = False
+        _g.replay = checkpoint["history"]
+
+    # Choose the optimisation function. In "auto" mode, the choice is made
+    # later, once the noise level is known.
+    _g.optimiser = _g.optimiser.lower()
+    if _g.optimiser != "auto":
+        optimfn = get_optimfn(_g.optimiser)
+
+    # Find the starting point. If a warm start was requested, start from the
+    # optimum of the most recent completed run of the same routine (clipped
+    # to the current bounds), using a smaller initial simplex / trust region.
+    init = routine.init
+    init_step = MAGIC_TOL * 10
+    if _g.resume:
+        init, init_step = checkpoint["init"], checkpoint["init_step"]
+    elif _g.warm:
+        prev_optimum = get_previous_optimum(routine, _g.p_optlog,
+                                            _g.p_database)
+        if prev_optimum is not None:
+            prev_optimum = np.clip(prev_optimum, routine.lb, routine.ub)
+        if prev_optimum is None:
+            warm_msg = "no previous run found, using initial values"
+        elif _g.violation is not None and _g.violation(prev_optimum) > 0:
+            warm_msg = "previous optimum is infeasible, using initial values"
+        else:
+            init = prev_optimum.tolist()
+            init_step = WARM_INIT_STEP
+            warm_msg = "from previous optimum"
+    # The optimisers need to know the cost function at the starting point.
+    if _g.violation is not None and _g.violation(init) > 0:
+        raise ValueError(f"The initial values {init} do not satisfy the"
+                         f" constraints {routine.constraints}.")
+
+    check_fidelity(_g.explore, getndim())
 
     # Scale the initial values and tolerances
     npars = len(routine.pars)
-    scaled_x0, scaled_lb, scaled_ub, scaled_xtol = scale(routine.init,
-                                                         routine.lb,
-                                                         routine.ub,
-                                                         routine.tol,
-                                                         scaleby="tols")
+    scaled_x0, scaled_lb, scaled_ub, scaled_xtol = scale(
+        init, routine.lb, routine.ub, routine.tol, scaleby="tols",
+        transforms=routine.transforms)
 
     # Some logging
     with open(_g.p_optlog, "a") as log:
@@ -131,11 +254,36 @@ def main():
         print(fmt.format("Optimisation parameters", routine.pars), file=log)
         print(fmt.format("Cost function", routine.cf), file=log)
         print(fmt.format("AU programme", routine.au), file=log)
-        print(fmt.format("Initial values", routine.init), file=log)
+        print(fmt.format("Initial values", init), file=log)
+        if _g.warm:
+            print(fmt.format("Warm start", warm_msg), file=log)
+        if _g.resume:
+            print(fmt.format("Resumed from checkpoint",
+                             f"{len(_g.replay)} evaluations recorded"),
+                  file=log)
         print(fmt.format("Lower bounds", routine.lb), file=log)
         print(fmt.format("Upper bounds", routine.ub), file=log)
         print(fmt.format("Tolerances", routine.tol), file=log)
-        print(fmt.format("Optimisation algorithm", _g.optimiser), file=log)
+        if routine.transforms:
+            print(fmt.format("Transforms", routine.transforms), file=log)
+        if routine.steps:
+            print(fmt.format("Steps", routine.steps), file=log)
+        if routine.constraints:
+            print(fmt.format("Constraints", routine.constraints), file=log)
+        if routine.target is not None:
+            print(fmt.format("Target", routine.target), file=log)
+        if routine.stagnation is not None:
+            print(fmt.format("Stagnation", routine.stagnation), file=log)
+        if _g.optimiser != "auto":
+            print(fmt.format("Optimisation algorithm", _g.optimiser),
+                  file=log)
+        if _g.explore:
+            print(fmt.format("Exploratory fidelity",
+                             format_fidelity(_g.explore)), file=log)
+        for module in _g.stale_modules:
+            print(f"Warning: {module} has been modified, but the backend"
+                  " daemon is still using the old version, because another"
+                  " optimisation is running.", file=log)
         print("", file=log)
         fmt = "{:^10s}  " * (npars + 1)
         print(fmt.format(*routine.pars, "cf"), file=log)
@@ -155,25 +303,138 @@ def main():
     # Clear out _g.xvals and _g.fvals. They will be added to by acquire_nmr().
     _g.xvals = []
     _g.fvals = np.array([])
-    # Carry out the optimisation.
-    opt_result = optimfn(acquire_nmr, scaled_x0, scaled_xtol,
-                         scaled_lb, scaled_ub,
-                         args=optimargs, maxfev=_g.maxfev)
+    _g.fidelities = []
+    _g.fidelity = {}
+    # Everything needed to restart the optimisation from scratch, which is
+    # saved in the checkpoint file along with the evaluation history.
+    _g.checkpoint_settings = {"routine_id": _g.routine_id,
+                              "routine": routine._asdict(),
+                              "optimiser": _g.optimiser,
+                              "maxfev": _g.maxfev,
+                              "noise_reps": _g.noise_reps,
+                              "explore": _g.explore,
+                              "separable": _g.separable,
+                              "restarts": _g.restarts,
+                              "init": list(init),
+                              "init_step": init_step,
+                              }
+    # Estimate the noise level of the cost function if requested.
+    _g.noise = 0
+    if _g.noise_reps >= 2:
+        _g.noise = estimate_noise(scaled_x0, _g.noise_reps, optimargs)
+        with open(_g.p_optlog, "a") as log:
+            print(f"Noise level: {_g.noise:.4g} (standard deviation of"
+                  f" {_g.noise_reps} replicates)", file=log)
+    # Choose the optimiser automatically if requested.
+    if _g.optimiser == "auto":
+        try:
+            runs = database.get_runs(_g.p_database, routine=routine.name,
+                                     cf=routine.cf, pars=routine.pars)
+        except sqlite3.Error:
+            runs = []
+        _g.optimiser, reason = choose_optimiser(routine, _g.noise, _g.fvals,
+                                                runs)
+        optimfn = get_optimfn(_g.optimiser)
+        # A resumed run must use the same optimiser, even if the choice would
+        # be different by then (e.g. because of other runs in the database).
+        _g.checkpoint_settings["optimiser"] = _g.optimiser
+        with open(_g.p_optlog, "a") as log:
+            fmt = "{:25s} - {}"
+            print(fmt.format("Optimisation algorithm", _g.optimiser),
+                  file=log)
+            print(fmt.format("Chosen automatically", reason), file=log)
+    # In separable mode, the parameters are split into groups which don't
+    # interact, and these are optimised one after another.
+    runner = run_optimiser
+    _g.groups = None
+    if _g.separable and npars > 1:
+        runner = run_separable
+    # Optional early stopping criteria from the routine. These are not used
+    # in the exploratory stage of a multi-fidelity optimisation, since the
+    # cost function values there are not comparable with the full ones.
+    stopping = {"target": routine.target, "stagnation": routine.stagnation}
+    # Restarts are likewise only carried out at full fidelity.
+    full_runner = runner
+    if _g.restarts > 0:
+        full_runner = partial(run_restarts, runner, restarts=_g.restarts)
+    # With discrete parameters, the optimisers can converge on a plateau
+    # created by rounding, so a lattice search is carried out afterwards.
+    scaled_steps = get_scaled_steps(routine)
+    if np.any(scaled_steps > 0):
+        full_runner = partial(run_lattice_search, full_runner,
+                              steps=scaled_steps)
+    # In multi-fidelity mode, first carry out an exploratory optimisation
+    # using cheaper spectra and looser tolerances, using at most half of the
+    # function evaluation budget. The full-fidelity optimisation then starts
+    # from the best point found. Cost function values are never compared
+    # across fidelities, so they don't need to be rescaled.
+    if _g.explore:
+        _g.fidelity = dict(_g.explore)
+        with open(_g.p_optlog, "a") as log:
+            print(f"Exploratory stage ({format_fidelity(_g.fidelity)})",
+                  file=log)
+        opt_result = runner(optimfn, scaled_x0,
+                            scaled_xtol * EXPLORE_TOL_FACTOR,
+                            scaled_lb, scaled_ub, optimargs,
+                            budget=((_g.maxfev + 1) // 2),
+                            init_step=init_step, noise=0)
+        _g.fidelity = {}
+        explore_fvals = _g.fvals[[bool(f) for f in _g.fidelities]]
+        if (explore_fvals.size > 0 and not opt_result.message.startswith(
+                MESSAGE_OPT_PREMATURE_TERMINATION)):
+            explore_xvals = [x for x, f in zip(_g.xvals, _g.fidelities) if f]
+            explore_best = explore_xvals[np.argmin(explore_fvals)]
+            scaled_x0 = scale(explore_best, routine.lb, routine.ub,
+                              routine.tol, scaleby="tols",
+                              transforms=routine.transforms)[0]
+            init_step = MAGIC_TOL * EXPLORE_TOL_FACTOR
+            with open(_g.p_optlog, "a") as log:
+                print("Full-fidelity stage", file=log)
+            opt_result = full_runner(optimfn, scaled_x0, scaled_xtol,
+                                     scaled_lb, scaled_ub, optimargs,
+                                     budget=_g.maxfev,
+                                     init_step=init_step, noise=_g.noise,
+                                     **stopping)
+    else:
+        opt_result = full_runner(optimfn, scaled_x0, scaled_xtol,
+                                 scaled_lb, scaled_ub, optimargs,
+                                 budget=_g.maxfev,
+                                 init_step=init_step, noise=_g.noise,
+                                 **stopping)
     # We are going to ignore the xbest returned by the optimiser itself, in
     # favour of the best xval and fval stored globally. This is so that we can
     # "interrupt" the optimisation halfway through (using a CostFunctionError)
     # while still returning the best point to the user.
     # We *will*, however, use the opt_result.message attribute.
 
+    # The optimisation is over, so the checkpoint is no longer needed.
+    remove_checkpoint()
+
     # If no values have been recorded yet, just end immediately.
     if _g.fvals.size == 0:
         print("terminated")
         return
     # Note that _g.xvals are unscaled values (this is more useful to the
     # advanced user who may want to access it from within a cost function).
-    best_index = np.argmin(_g.fvals)
+    # The optimum is only chosen from full-fidelity evaluations, unless there
+    # weren't any.
+    full_fidelity = np.array([not f for f in _g.fidelities])
+    if not np.any(full_fidelity):
+        full_fidelity[:] = True
+    best_index = np.flatnonzero(full_fidelity)[
+        np.argmin(_g.fvals[full_fidelity])]
     xbest, fbest = _g.xvals[best_index], _g.fvals[best_index]
 
+    # Fit a quadratic model to the points near the optimum. This is always
+    # logged, but the model optimum is only returned if it was requested.
+    try:
+        refined = refine_optimum(routine, np.flatnonzero(full_fidelity))
+    except (ValueError, np.linalg.LinAlgError) as e:
+        refined, refine_reason = None, str(e)
+    else:
+        if _g.refine:
+            xbest, fbest = refined.xbest, refined.fbest
+
     # Tell frontend script that the optimisation is done
     print(f"optima: {' '.join([str(i) for i in xbest])}")
     # Strip newlines from the opt result message, just in case (because the
@@ -187,6 +448,19 @@ def main():
     with open(_g.p_optlog, "a") as log:
         print("", file=log)
         fmt = "{:27s} - {}"
+        if refined is None:
+            print(fmt.format("Quadratic model",
+                             f"not fitted ({refine_reason})"), file=log)
+        else:
+            ci = [[float(f"{lo:.6g}"), float(f"{hi:.6g}")]
+                  for lo, hi in zip(refined.ci_lower, refined.ci_upper)]
+            print(fmt.format("Quadratic model optimum",
+                             refined.xbest.tolist()), file=log)
+            print(fmt.format("Quadratic model 95% CI", ci), file=log)
+            print(fmt.format("Quadratic model minimum",
+                             float(refined.fbest)), file=log)
+            print(fmt.format("Quadratic model points", refined.npts),
+                  file=log)
         print(fmt.format("Best values found", xbest.tolist()), file=log)
         print(fmt.format("Cost function at minimum", fbest),
               file=log)
@@ -194,6 +468,30 @@ def main():
               file=log)
         print(fmt.format("Total time taken", time_taken), file=log)
 
+    # Store the run in the database. A failure here shouldn't affect the
+    # optimisation itself, which has already finished.
+    p_acqus = _g.p_spectrum.parents[1] / "acqus"
+    try:
+        database.record_run(
+            _g.p_database,
+            date=tic.strftime("%Y-%m-%d %H:%M:%S"),
+            routine=routine.name, pars=routine.pars, cf=routine.cf,
+            au=routine.au, algorithm=_g.optimiser, init=init,
+            lb=routine.lb, ub=routine.ub, tol=routine.tol,
+            optimum=xbest, fbest=float(fbest), nfev=acquire_nmr.calls,
+            time=(toc - tic).total_seconds(), message=opt_result.message,
+            probe=database.get_acqus_string("PROBHD", p_acqus),
+            solvent=database.get_acqus_string("SOLVENT", p_acqus),
+            instrument=database.get_acqus_string("INSTRUM", p_acqus),
+            sample=_g.p_spectrum.parents[2].name,
+            spectrum=str(_g.p_spectrum),
+            xvals=_g.xvals, fvals=_g.fvals,
+        )
+    except sqlite3.Error as e:
+        with open(_g.p_optlog, "a") as log:
+            print(f"Could not write to database {_g.p_database}: {e}",
+                  file=log)
+
 
 def get_routine_cf(routine_id, p_routine_dir=None):
     """
@@ -236,8 +534,1018 @@ def get_routine_cf(routine_id, p_routine_dir=None):
     return routine, cost_function
 
 
-@deco_count
-def acquire_nmr(x, cost_function, routine):
+def get_optimfn(optimiser):
+    """
+    Returns the optimisation function corresponding to an optimiser name.
+    optpoise implements a PyBOBYQA interface so that the returned result has
+    the same attributes as our other optimisers.
+
+    Parameters
+    ----------
+    optimiser : str from {"nm", "mds", "bobyqa", "brent"}
+        The name of the optimiser.
+
+    Returns
+    -------
+    function
+    """
+    optimfndict = {"nm": nelder_mead,
+                   "mds": multid_search,
+                   "bobyqa": pybobyqa_interface,
+                   "brent": brent,
+                   }
+    try:
+        optimfn = optimfndict[optimiser]
+    except KeyError:
+        raise ValueError(f"Invalid optimiser {optimiser} specified.")
+    # Reflect Nelder-Mead trial points back inside the bounds, so that no
+    # iterations are wasted on points that can't be measured. (BOBYQA and
+    # Brent already stay within the bounds.) This isn't done for MDS, whose
+    # steps must keep the shape of the simplex; projecting or reflecting them
+    # makes it degenerate. Both methods do construct their initial simplex
+    # within the bounds, though.
+    if optimiser == "nm":
+        optimfn = partial(optimfn, bounds_method="reflect")
+    return optimfn
+
+
+def choose_optimiser(routine, noise=0, fvals=(), runs=()):
+    """
+    Chooses the optimiser which is expected to need the fewest spectra for a
+    routine. Routines with only one parameter are always optimised using
+    Brent's method, which only ever samples points inside a shrinking
+    bracket. (In simulations of p1cal, it needs about as many spectra as
+    BOBYQA.) Otherwise, in order of priority:
+
+     1. If at least AUTO_MIN_RUNS previous runs of the same routine were
+        completed with some optimiser, the one with the lowest mean number of
+        spectra is used. Optimisers whose median final cost function is
+        noticeably worse than the best one are not considered.
+     2. If some parameters are discrete, or the routine has constraints,
+        Nelder-Mead is used. BOBYQA's quadratic models cope badly with the
+        flat regions and penalty values which these create.
+     3. If the cost function is noisy (the noise level is more than
+        AUTO_NOISE_FRACTION of its value), Nelder-Mead is used, as it only
+        compares cost function values (rather than fitting a model to them).
+     4. Otherwise, BOBYQA is used.
+
+    Parameters
+    ----------
+    routine : Routine
+        The active optimisation routine.
+    noise : float, optional
+        The estimated noise level (zero if not estimated).
+    fvals : ndarray, optional
+        The cost function values measured so far (i.e. the replicates used
+        to estimate the noise level).
+    runs : list of dict, optional
+        Previous runs of the routine, as returned by database.get_runs().
+
+    Returns
+    -------
+    optimiser : str
+        The chosen optimiser.
+    reason : str
+        A short explanation of the choice, for the log file.
+    """
+    if len(routine.pars) == 1:
+        return "brent", "only one parameter"
+
+    # Statistics from previous runs, ignoring those that didn't finish
+    # normally.
+    stats = {}
+    for run in runs:
+        if (run["algorithm"] in ["nm", "mds", "bobyqa"]
+                and run["nfev"] is not None and run["fbest"] is not None
+                and not (run["message"] or "").startswith(
+                    MESSAGE_OPT_PREMATURE_TERMINATION)):
+            stats.setdefault(run["algorithm"], []).append(run)
+    stats = {alg: (np.mean([r["nfev"] for r in alg_runs]),
+                   np.median([r["fbest"] for r in alg_runs]),
+                   len(alg_runs))
+             for alg, alg_runs in stats.items()
+             if len(alg_runs) >= AUTO_MIN_RUNS}
+    if stats:
+        best_f = min(f for _, f, _ in stats.values())
+        good = {alg: stat for alg, stat in stats.items()
+                if stat[1] <= best_f + AUTO_FBEST_RTOL * abs(best_f)}
+        optimiser = min(good, key=lambda alg: good[alg][0])
+        summary = ", ".join(f"{alg} {nfev:.1f} ({n} runs)"
+                            for alg, (nfev, _, n) in sorted(good.items()))
+        return optimiser, f"fewest spectra in previous runs: {summary}"
+
+    if routine.steps and any(routine.steps):
+        return "nm", "routine has discrete parameters"
+    if routine.constraints:
+        return "nm", "routine has constraints"
+    if noise > 0 and len(fvals) > 0:
+        fmean = abs(np.mean(fvals))
+        if fmean == 0 or noise > AUTO_NOISE_FRACTION * fmean:
+            return "nm", "cost function is noisy"
+    return "bobyqa", ("default, as there are not enough previous runs to"
+                      " compare optimisers")
+
+
+def apply_steps(routine):
+    """
+    Checks the steps of a routine with discrete parameters, and makes sure
+    that the tolerance of each discrete parameter is no smaller than its step
+    (there is no point trying to converge more finely than the lattice).
+    This is only done for parameters without a transform, as the tolerances
+    of transformed parameters are in different units.
+
+    Parameters
+    ----------
+    routine : Routine
+        The routine as loaded from its file.
+
+    Returns
+    -------
+    Routine
+        The routine with adjusted tolerances. If it has no steps, it is
+        returned unchanged.
+    """
+    if not routine.steps:
+        return routine
+    if len(routine.steps) != len(routine.pars):
+        raise ValueError(f"{len(routine.steps)} steps were given for"
+                         f" {len(routine.pars)} parameters.")
+    transforms = routine.transforms or [None] * len(routine.pars)
+    tol = list(routine.tol)
+    for i, step in enumerate(routine.steps):
+        if not step:
+            continue
+        if step < 0:
+            raise ValueError(f"The step for {routine.pars[i]} must be"
+                             " positive.")
+        if (np.floor(routine.ub[i] / step + 1e-9)
+                < np.ceil(routine.lb[i] / step - 1e-9)):
+            raise ValueError(f"There are no multiples of the step {step}"
+                             f" between the bounds of {routine.pars[i]}.")
+        if transforms[i] in [None, "linear"]:
+            tol[i] = max(tol[i], step)
+    return routine._replace(tol=tol)
+
+
+def get_previous_optimum(routine, p_optlog, p_database=None):
+    """
+    Searches a poise.log file for the most recent completed run of the same
+    routine (i.e. one with the same name, parameters, and cost function), and
+    returns the optimum found in that run. If there is no such run in the log
+    file, the database of completed runs is searched instead; this allows
+    optima to be carried over from other datasets.
+
+    Parameters
+    ----------
+    routine : Routine
+        The active optimisation routine.
+    p_optlog : pathlib.Path
+        Path to the poise.log file.
+    p_database : pathlib.Path, optional
+        Path to the database of completed runs. If not given, only the log
+        file is searched.
+
+    Returns
+    -------
+    list of float or None
+        The previous optimum. None if no matching run was found.
+    """
+    prev_optimum = None
+    if p_optlog.exists():
+        prev_optimum = _get_previous_optimum_log(routine, p_optlog)
+    if prev_optimum is None and p_database is not None:
+        try:
+            runs = database.get_runs(p_database, routine=routine.name,
+                                     cf=routine.cf, pars=routine.pars,
+                                     limit=1)
+        except sqlite3.Error:
+            runs = []
+        if runs:
+            prev_optimum = runs[0]["optimum"]
+    return prev_optimum
+
+
+def _get_previous_optimum_log(routine, p_optlog):
+    """
+    Searches a poise.log file for the optimum of the most recent completed
+    run of the same routine. See get_previous_optimum().
+    """
+
+    def parse_rhs(line):
+        # Get the second half of the line. Convert '[4.]' to '[4]' so that
+        # json.loads() can parse it (as in nmrpoise.parse_log()).
+        rhs = line.split("-", maxsplit=1)[1].strip()
+        return json.loads(re.sub(r"\.([^\d])", r"\1", rhs))
+
+    prev_optimum = None
+    run = {}
+    with open(p_optlog, "r") as fp:
+        for line in fp:
+            if "===================" in line:
+                run = {}
+            elif line.startswith("Routine name"):
+                run["name"] = line.split("-", maxsplit=1)[1].strip()
+            elif line.startswith("Optimisation parameters"):
+                run["pars"] = parse_rhs(line.replace("'", '"'))
+            elif line.startswith("Cost function  "):
+                run["cf"] = line.split("-", maxsplit=1)[1].strip()
+            elif line.startswith("Best values found"):
+                run["xbest"] = parse_rhs(line)
+            elif line.startswith("Total time taken"):
+                # Run completed, check if it matches.
+                if (run.get("name") == routine.name
+                        and run.get("pars") == list(routine.pars)
+                        and run.get("cf") == routine.cf
+                        and run.get("xbest") is not None):
+                    prev_optimum = run["xbest"]
+    return prev_optimum
+
+
+def run_optimiser(optimfn, x0, xtol, lb, ub, optimargs, budget, cf=None,
+                  **kwargs):
+    """
+    Runs one optimisation, making sure that the total number of spectra
+    acquired (including any acquired before this optimisation) does not
+    exceed a given budget.
+
+    Parameters
+    ----------
+    optimfn : function
+        The optimiser.
+    x0, xtol, lb, ub : ndarray
+        Scaled initial point, tolerances, and bounds.
+    optimargs : tuple
+        Arguments to pass to acquire_nmr().
+    budget : int
+        Maximum total number of spectra. Zero means no limit.
+    cf : function, optional
+        The cost function to optimise. Defaults to acquire_nmr(). Any other
+        cost function must call acquire_nmr() and have the same ``calls``
+        attribute.
+    kwargs
+        Further keyword arguments to pass to the optimiser.
+
+    Returns
+    -------
+    OptResult
+        The result of the optimisation. If the budget was already exhausted,
+        the optimiser is not run at all, and only the message is set.
+    """
+    if budget > 0:
+        maxfev = budget - acquire_nmr.calls
+        if maxfev <= 0:
+            return OptResult(xbest=None, fbest=None, niter=0, nfev=0,
+                             message=MESSAGE_OPT_MAXFEV_REACHED)
+    else:
+        maxfev = 0
+    return optimfn(cf or acquire_nmr, x0, xtol, lb, ub,
+                   args=optimargs, maxfev=maxfev, **kwargs)
+
+
+class Subproblem():
+    """
+    Cost function for optimising a subset of the parameters while keeping
+    the others fixed, used in separable mode. It has the same ``calls``
+    attribute as acquire_nmr(), so that the optimisers can count spectra.
+    """
+    def __init__(self, x, group):
+        """
+        Parameters
+        ----------
+        x : ndarray
+            Scaled point, which provides the values of the fixed parameters.
+        group : list of int
+            Indices of the parameters being optimised.
+        """
+        self.x = np.array(x, dtype=float)
+        self.group = group
+
+    @property
+    def calls(self):
+        return acquire_nmr.calls
+
+    def __call__(self, y, *args):
+        x = self.x.copy()
+        x[self.group] = y
+        return acquire_nmr(x, *args)
+
+
+def find_groups(x0, xtol, lb, ub, optimargs, init_step, noise=0):
+    """
+    Tests which parameters interact with each other, by acquiring spectra at
+    x0, at x0 plus a step in each parameter, and at x0 plus a step in each
+    pair of parameters. For parameters i and j, the interaction term
+
+        f(x0 + d_i + d_j) - f(x0 + d_i) - f(x0 + d_j) + f(x0)
+
+    is zero if the cost function is separable in i and j. The steps are the
+    same as the first step taken by brent(), so that one-parameter groups can
+    reuse these spectra.
+
+    Parameters
+    ----------
+    x0, xtol, lb, ub : ndarray
+        Scaled initial point, tolerances, and bounds.
+    optimargs : tuple
+        Arguments to pass to acquire_nmr().
+    init_step : float
+        Size of the steps.
+    noise : float, optional
+        Estimated noise level (standard deviation of one evaluation).
+        Interaction terms are only significant at the 95% confidence level,
+        i.e. if they exceed 1.96 times their standard deviation, which is
+        twice the noise level.
+
+    Returns
+    -------
+    list of list of int
+        The indices of the parameters in each group. Parameters in different
+        groups don't interact.
+    """
+    n = len(x0)
+    x0 = np.asarray(x0, dtype=float)
+    steps = np.minimum(x0 + init_step, ub) - x0
+    steps = np.where(steps < np.asarray(xtol) / 4,
+                     np.maximum(x0 - init_step, lb) - x0, steps)
+    f0 = acquire_nmr(x0, *optimargs)
+    fi = [acquire_nmr(x0 + steps * np.eye(n)[i], *optimargs)
+          for i in range(n)]
+    # Connected components of the graph of interacting parameters.
+    group_of = list(range(n))
+    for i in range(n):
+        for j in range(i + 1, n):
+            fij = acquire_nmr(x0 + steps * (np.eye(n)[i] + np.eye(n)[j]),
+                              *optimargs)
+            interaction = fij - fi[i] - fi[j] + f0
+            # The interaction term is the sum of four independent values, so
+            # its standard deviation is twice the noise level. It is only
+            # taken to be nonzero if it lies outside the 95% confidence
+            # interval (1.96 standard deviations) for a separable function.
+            threshold = max(SEPARABILITY_RTOL * max(abs(fi[i] - f0),
+                                                    abs(fi[j] - f0)),
+                            1.96 * 2 * noise)
+            if not abs(interaction) <= threshold:   # also catches nan
+                old, new = group_of[j], group_of[i]
+                group_of = [new if g == old else g for g in group_of]
+    return [[i for i in range(n) if group_of[i] == g]
+            for g in sorted(set(group_of))]
+
+
+def run_separable(optimfn, x0, xtol, lb, ub, optimargs, budget, **kwargs):
+    """
+    Runs an optimisation in separable mode. The parameters are first split
+    into groups which don't interact (see find_groups()); this is only done
+    once per optimisation. Each group is then optimised in turn, with the
+    other parameters fixed at their current best values. Groups containing
+    only one parameter are optimised using Brent's method. If all parameters
+    interact, this is the same as run_optimiser().
+
+    The parameters are the same as for run_optimiser().
+
+    Returns
+    -------
+    OptResult
+        The result of the optimisation.
+    """
+    routine = optimargs[1]
+    if _g.groups is None:
+        # Don't test for separability if it would use up the whole budget.
+        n = len(x0)
+        n_test = 1 + n + n * (n - 1) // 2
+        if budget > 0 and acquire_nmr.calls + n_test >= budget:
+            _g.groups = [list(range(n))]
+        else:
+            try:
+                _g.groups = find_groups(x0, xtol, lb, ub, optimargs,
+                                        kwargs.get("init_step",
+                                                   MAGIC_TOL * 10),
+                                        kwargs.get("noise", 0))
+            except CostFunctionError as e:
+                return OptResult(xbest=None, fbest=None, niter=0, nfev=0,
+                                 message=(MESSAGE_OPT_PREMATURE_TERMINATION
+                                          + "\nReason: " + e.message))
+        with open(_g.p_optlog, "a") as log:
+            names = [[routine.pars[i] for i in group] for group in _g.groups]
+            print(f"Separable groups: {names}", file=log)
+    if len(_g.groups) == 1:
+        return run_optimiser(optimfn, x0, xtol, lb, ub, optimargs, budget,
+                             **kwargs)
+
+    x = np.array(x0, dtype=float)
+    niter, nfev, message = 0, 0, MESSAGE_OPT_SUCCESS
+    for group in _g.groups:
+        with open(_g.p_optlog, "a") as log:
+            print(f"Optimising {[routine.pars[i] for i in group]}",
+                  file=log)
+        calls = acquire_nmr.calls
+        group_optimfn = brent if len(group) == 1 else optimfn
+        result = run_optimiser(group_optimfn, x[group], xtol[group],
+                               lb[group], ub[group], optimargs, budget,
+                               cf=Subproblem(x, group), **kwargs)
+        niter += result.niter
+        nfev += acquire_nmr.calls - calls
+        if result.xbest is not None:
+            x[group] = result.xbest
+        if result.message != MESSAGE_OPT_SUCCESS:
+            message = result.message
+        # Don't carry on if the optimisation was stopped. (Stagnation only
+        # applies to the group which stagnated.)
+        if (message.startswith(MESSAGE_OPT_PREMATURE_TERMINATION)
+                or message in [MESSAGE_OPT_MAXFEV_REACHED,
+                               MESSAGE_OPT_TARGET_REACHED]):
+            break
+    return OptResult(xbest=x, fbest=None, niter=niter, nfev=nfev,
+                     message=message)
+
+
+def best_full_fidelity():
+    """
+    Finds the best point acquired at full fidelity so far.
+
+    Returns
+    -------
+    (ndarray, float) or (None, float)
+        The unscaled point and its cost function value. If no point has been
+        acquired at full fidelity, returns (None, inf).
+    """
+    indices = [i for i, fid in enumerate(_g.fidelities) if not fid]
+    if not indices:
+        return None, np.inf
+    i = indices[np.argmin(np.asarray(_g.fvals)[indices])]
+    return _g.xvals[i], _g.fvals[i]
+
+
+def spread_point(lb, ub, routine, seed):
+    """
+    Chooses a starting point for a restart which is as far as possible from
+    all the points evaluated so far (out of a set of random candidates), so
+    that a different part of the parameter space is explored.
+
+    Parameters
+    ----------
+    lb, ub : ndarray
+        Scaled bounds.
+    routine : Routine
+        The active routine.
+    seed : int
+        Seed for the random candidates. This makes the choice deterministic,
+        so that the optimisation can be resumed.
+
+    Returns
+    -------
+    ndarray or None
+        The scaled starting point. None if no candidate satisfies the
+        routine's constraints.
+    """
+    rng = np.random.default_rng(seed)
+    candidates = rng.uniform(lb, ub, size=(RESTART_CANDIDATES, len(lb)))
+    unscaled = [unscale(c, routine.lb, routine.ub, routine.tol,
+                        scaleby="tols", transforms=routine.transforms)
+                for c in candidates]
+    if _g.violation is not None:
+        candidates = np.array([c for c, u in zip(candidates, unscaled)
+                               if _g.violation(u) <= 0])
+        if candidates.size == 0:
+            return None
+    evaluated = np.array([scale(x, routine.lb, routine.ub, routine.tol,
+                                scaleby="tols",
+                                transforms=routine.transforms)[0]
+                          for x in _g.xvals])
+    if evaluated.size == 0:
+        return candidates[0]
+    dists = np.linalg.norm(candidates[:, None, :] - evaluated[None, :, :],
+                           axis=2)
+    return candidates[np.argmax(np.min(dists, axis=1))]
+
+
+def run_restarts(runner, optimfn, x0, xtol, lb, ub, optimargs, budget,
+                 restarts, **kwargs):
+    """
+    Runs an optimisation, then restarts it up to a given number of times if
+    it converged, to guard against premature convergence (e.g. a simplex
+    which has collapsed because of noise) and local minima. Restarts
+    alternate between a fresh simplex / trust region around the best point
+    so far, and a point far away from all points evaluated so far (see
+    spread_point()). Restarting stops once two restarts in a row have failed
+    to improve the best cost function value significantly.
+
+    All restarts share the same budget (and time budget), and points which
+    have already been acquired are not acquired again (see acquire_nmr()).
+
+    Parameters
+    ----------
+    runner : function
+        The function used to run each optimisation, i.e. run_optimiser() or
+        run_separable().
+    restarts : int
+        Maximum number of restarts.
+    The other parameters are the same as for run_optimiser().
+
+    Returns
+    -------
+    OptResult
+        The result of the last optimisation, with ``nfev`` and ``niter``
+        summed over all of them.
+    """
+    routine = optimargs[1]
+    calls = acquire_nmr.calls
+    result = runner(optimfn, x0, xtol, lb, ub, optimargs, budget, **kwargs)
+    niter = result.niter
+    fails = 0
+    for i in range(restarts):
+        # Only restart if the optimisation converged, not if it was stopped.
+        if result.message not in RESTART_MESSAGES or fails >= 2:
+            break
+        xbefore, fbefore = best_full_fidelity()
+        if xbefore is None:
+            break
+        if i % 2 == 0:
+            start = scale(xbefore, routine.lb, routine.ub, routine.tol,
+                          scaleby="tols", transforms=routine.transforms)[0]
+            where = "around best point"
+        else:
+            start = spread_point(lb, ub, routine, seed=i)
+            if start is None:
+                break
+            where = "from " + str(unscale(start, routine.lb, routine.ub,
+                                          routine.tol, scaleby="tols",
+                                          transforms=routine.transforms)
+                                  .tolist())
+        with open(_g.p_optlog, "a") as log:
+            print(f"Restart {i + 1} ({where})", file=log)
+        result = runner(optimfn, start, xtol, lb, ub, optimargs, budget,
+                        **kwargs)
+        niter += result.niter
+        fafter = best_full_fidelity()[1]
+        threshold = max(RESTART_RTOL * abs(fbefore),
+                        NOISE_THRESHOLD * kwargs.get("noise", 0))
+        fails = 0 if fbefore - fafter > threshold else fails + 1
+    xbest, fbest = best_full_fidelity()
+    if xbest is not None:
+        xbest = scale(xbest, routine.lb, routine.ub, routine.tol,
+                      scaleby="tols", transforms=routine.transforms)[0]
+    return OptResult(xbest=xbest, fbest=fbest, niter=niter,
+                     nfev=acquire_nmr.calls - calls, message=result.message)
+
+
+def get_scaled_steps(routine):
+    """
+    Returns the scaled lattice spacing of each parameter of a routine, for
+    use with compass_search(). Only parameters without a transform have a
+    constant spacing in the scaled units; for all other parameters (and
+    continuous ones), the spacing is zero. The values of discrete parameters
+    are rounded to the lattice by acquire_nmr() in any case.
+
+    Parameters
+    ----------
+    routine : Routine
+        The active routine.
+
+    Returns
+    -------
+    ndarray
+        The scaled spacing of each parameter.
+    """
+    transforms = routine.transforms or [None] * len(routine.pars)
+    steps = routine.steps or [None] * len(routine.pars)
+    return np.array([(step or 0) * MAGIC_TOL / tol
+                     if transform in [None, "linear"] else 0
+                     for step, tol, transform in zip(steps, routine.tol,
+                                                     transforms)])
+
+
+def run_lattice_search(runner, optimfn, x0, xtol, lb, ub, optimargs, budget,
+                       steps, **kwargs):
+    """
+    Runs an optimisation of a routine with discrete parameters, and then, if
+    it converged, continues from the best point with a compass search which
+    moves between neighbouring points of the lattice (see compass_search()).
+    This finds a point which none of its neighbours improves on, even when
+    the optimiser has stopped on a plateau created by rounding trial points
+    to the lattice. The lattice search shares the budget of the optimisation,
+    and points which have already been acquired are not acquired again.
+
+    Parameters
+    ----------
+    runner : function
+        The function used to run the optimisation, i.e. run_optimiser(),
+        run_separable(), or run_restarts().
+    steps : ndarray
+        The scaled lattice spacing of each parameter (see
+        get_scaled_steps()).
+    The other parameters are the same as for run_optimiser().
+
+    Returns
+    -------
+    OptResult
+        The best point found, with ``nfev`` and ``niter`` summed over both
+        searches. The message is that of the optimisation, unless the lattice
+        search was stopped early.
+    """
+    routine = optimargs[1]
+    calls = acquire_nmr.calls
+    result = runner(optimfn, x0, xtol, lb, ub, optimargs, budget, **kwargs)
+    xbefore, _ = best_full_fidelity()
+    if result.message not in RESTART_MESSAGES or xbefore is None:
+        return result
+    start = scale(xbefore, routine.lb, routine.ub, routine.tol,
+                  scaleby="tols", transforms=routine.transforms)[0]
+    with open(_g.p_optlog, "a") as log:
+        print("Lattice search around best point", file=log)
+    lattice = run_optimiser(compass_search, start, xtol, lb, ub, optimargs,
+                            budget, **dict(kwargs, steps=steps,
+                                           init_step=LATTICE_INIT_STEP))
+    message = result.message
+    if lattice.message != MESSAGE_OPT_SUCCESS:
+        message = lattice.message
+    xbest, fbest = best_full_fidelity()
+    xbest = scale(xbest, routine.lb, routine.ub, routine.tol,
+                  scaleby="tols", transforms=routine.transforms)[0]
+    return OptResult(xbest=xbest, fbest=fbest,
+                     niter=result.niter + lattice.niter,
+                     nfev=acquire_nmr.calls - calls, message=message)
+
+
+def refine_optimum(routine, indices):
+    """
+    Estimates the optimum more precisely than the best point sampled, by
+    fitting a local quadratic model to the points evaluated during the
+    optimisation (see optpoise.fit_quadratic()). No further spectra are
+    acquired.
+
+    Parameters
+    ----------
+    routine : Routine
+        The active routine.
+    indices : ndarray
+        The indices of the evaluations in _g.xvals and _g.fvals which may be
+        used (i.e. those which were acquired at full fidelity).
+
+    Returns
+    -------
+    OptResult
+        Has attributes ``xbest`` (the minimum of the model, in unscaled
+        units), ``fbest`` (the value of the model there), ``ci_lower`` and
+        ``ci_upper`` (the 95% confidence interval of each parameter), and
+        ``npts`` (the number of points used).
+
+    Raises
+    ------
+    ValueError
+        If the model cannot be fitted, or its minimum lies outside the
+        bounds or violates the routine's constraints. The message gives the
+        reason.
+    """
+    def to_scaled(x):
+        return scale(x, routine.lb, routine.ub, routine.tol, scaleby="tols",
+                     transforms=routine.transforms)[0]
+
+    def to_unscaled(x):
+        return unscale(x, routine.lb, routine.ub, routine.tol, scaleby="tols",
+                       transforms=routine.transforms)
+
+    scaled_lb, scaled_ub = (to_scaled(b) for b in (routine.lb, routine.ub))
+    scaled_xvals = np.array([to_scaled(_g.xvals[i]) for i in indices])
+    fit = fit_quadratic(scaled_xvals, _g.fvals[indices], noise=_g.noise)
+    if np.any(fit.xbest < scaled_lb) or np.any(fit.xbest > scaled_ub):
+        raise ValueError("the minimum of the fitted quadratic lies outside"
+                         " the bounds")
+    xbest = to_unscaled(fit.xbest)
+    if routine.steps:
+        xbest = round_to_steps(xbest, routine.steps, routine.lb, routine.ub)
+    if _g.violation is not None and _g.violation(xbest) > 0:
+        raise ValueError("the minimum of the fitted quadratic violates the"
+                         " constraints")
+    # Transforms are increasing, so the interval can be unscaled endpoint by
+    # endpoint.
+    ci_lower = to_unscaled(np.clip(fit.xbest - fit.ci, scaled_lb, scaled_ub))
+    ci_upper = to_unscaled(np.clip(fit.xbest + fit.ci, scaled_lb, scaled_ub))
+    return OptResult(xbest=xbest, fbest=fit.fbest, ci_lower=ci_lower,
+                     ci_upper=ci_upper, npts=fit.npts)
+
+
+def parse_fidelity(s):
+    """
+    Parses a list of acquisition parameter overrides, e.g. "NS=1 DS=0", into
+    a dict, e.g. {"NS": "1", "DS": "0"}. The values are kept as strings since
+    they are only ever passed back to the frontend.
+    """
+    return dict(item.split("=", maxsplit=1) for item in s.split())
+
+
+def check_fidelity(fidelity, ndim):
+    """
+    Checks that a set of acquisition parameter overrides can be used on a
+    dataset.
+
+    Parameters
+    ----------
+    fidelity : dict
+        The overrides, as returned by parse_fidelity().
+    ndim : int
+        Dimensionality of the dataset.
+
+    Raises
+    ------
+    ValueError
+        If any of the overrides are invalid. In particular, TD1 (proxy mode)
+        can only be reduced for 2D datasets.
+    """
+    for par, value in fidelity.items():
+        if par not in ["NS", "TD1"]:
+            raise ValueError(f"Parameter {par} cannot be overridden.")
+        if int(value) < 1:
+            raise ValueError(f"Invalid value {value} for parameter {par}.")
+    if "TD1" in fidelity and ndim != 2:
+        raise ValueError("TD1 can only be overridden for 2D datasets.")
+
+
+def format_fidelity(fidelity):
+    """
+    Inverse of parse_fidelity().
+    """
+    return " ".join(f"{par}={value}" for par, value in fidelity.items())
+
+
+def save_checkpoint():
+    """
+    Writes the checkpoint file, containing the settings of the current
+    optimisation and every evaluation made so far. The file is first written
+    to a temporary file and then moved into place, so that a valid
+    checkpoint exists even if the backend is killed while writing it.
+
+    The checkpoint is written to the expno folder of the most recently
+    acquired spectrum (this only matters if separate expnos are being used),
+    so that the optimisation can be resumed from the last expno.
+    """
+    p_new = _g.p_spectrum.parents[1] / CHECKPOINT_FNAME
+    history = [{"x": x.tolist(), "f": float(f), "fidelity": fid}
+               for x, f, fid in zip(_g.xvals, _g.fvals, _g.fidelities)]
+    checkpoint = dict(_g.checkpoint_settings, history=history)
+    p_tmp = p_new.with_name(CHECKPOINT_FNAME + ".tmp")
+    with open(p_tmp, "w") as fp:
+        json.dump(checkpoint, fp)
+    os.replace(p_tmp, p_new)
+    if p_new != _g.p_checkpoint:
+        remove_checkpoint()
+        _g.p_checkpoint = p_new
+
+
+def load_checkpoint(p_checkpoint):
+    """
+    Reads a checkpoint file written by save_checkpoint().
+
+    Parameters
+    ----------
+    p_checkpoint : pathlib.Path
+        Path to the checkpoint file.
+
+    Returns
+    -------
+    dict or None
+        The contents of the checkpoint. None if the file doesn't exist.
+    """
+    if not p_checkpoint.exists():
+        return None
+    with open(p_checkpoint, "r") as fp:
+        return json.load(fp)
+
+
+def remove_checkpoint():
+    """
+    Deletes the current checkpoint file, if it exists.
+    """
+    if _g.p_checkpoint is not None and _g.p_checkpoint.exists():
+        _g.p_checkpoint.unlink()
+
+
+def record_evaluation(unscaled_val, cf_val):
+    """
+    Adds one evaluation to _g.xvals, _g.fvals, and _g.fidelities, then
+    updates the checkpoint file.
+    """
+    _g.xvals.append(unscaled_val)
+    _g.fvals = np.append(_g.fvals, cf_val)
+    _g.fidelities.append(dict(_g.fidelity))
+    save_checkpoint()
+
+
+def previous_evaluation(unscaled_val):
+    """
+    Looks up the cost function value at a point which has already been
+    acquired, at the current fidelity.
+
+    Parameters
+    ----------
+    unscaled_val : ndarray
+        The point requested by the optimiser.
+
+    Returns
+    -------
+    float or None
+        The mean of the values recorded at this point (there may be more than
+        one, e.g. if replicates were acquired to estimate the noise level).
+        None if the point has not been acquired before.
+    """
+    fvals = [f for x, f, fid in zip(_g.xvals, _g.fvals, _g.fidelities)
+             if fid == _g.fidelity
+             and np.allclose(x, unscaled_val, rtol=1e-9, atol=0)]
+    if not fvals:
+        return None
+    return float(np.mean(fvals))
+
+
+def replay_evaluation(unscaled_val):
+    """
+    When resuming, returns the recorded cost function value for the next
+    point requested by the optimiser. If this point doesn't match the one
+    that was recorded (which should not happen), replay is abandoned and
+    the remaining recorded evaluations are discarded.
+
+    Parameters
+    ----------
+    unscaled_val : ndarray
+        The point requested by the optimiser.
+
+    Returns
+    -------
+    float or None
+        The recorded cost function value. None if there are no more recorded
+        evaluations, or if the point doesn't match.
+    """
+    if not _g.replay:
+        return None
+    record = _g.replay.pop(0)
+    if (np.allclose(record["x"], unscaled_val, rtol=1e-9, atol=0)
+            and record["fidelity"] == _g.fidelity):
+        return record["f"]
+    _g.replay = []
+    with open(_g.p_optlog, "a") as log:
+        print("Checkpoint does not match the current optimisation; "
+              "acquiring spectra from here on.", file=log)
+    return None
+
+
+def estimate_noise(x, reps, optimargs):
+    """
+    Estimates the noise level of the cost function by acquiring several
+    replicate spectra at the same point. These evaluations are recorded in
+    _g.xvals and _g.fvals (and count towards maxfev) as usual.
+
+    Parameters
+    ----------
+    x : ndarray
+        Scaled point at which to acquire the replicates.
+    reps : int
+        Number of replicates.
+    optimargs : tuple
+        Arguments to pass to acquire_nmr().
+
+    Returns
+    -------
+    float
+        Sample standard deviation of the replicate cost function values. Zero
+        if fewer than two values were obtained (e.g. because the cost function
+        raised a CostFunctionError).
+    """
+    fvals = []
+    try:
+        for _ in range(reps):
+            fvals.append(acquire_nmr(x, *optimargs, allow_repeat=True))
+    except CostFunctionError:
+        pass
+    if len(fvals) < 2:
+        return 0
+    return float(np.std(fvals, ddof=1))
+
+
+def predict_eval_time():
+    """
+    Predicts how long the next spectrum will take to acquire and process,
+    using the mean of the times measured so far at the current fidelity (or
+    at any fidelity, if no spectra have been acquired at this one yet).
+
+    Returns
+    -------
+    float or None
+        The predicted time in seconds. None if no spectra have been acquired
+        yet.
+    """
+    times = [t for fid, t in _g.eval_times if fid == _g.fidelity]
+    if not times:
+        times = [t for _, t in _g.eval_times]
+    if not times:
+        return None
+    return float(np.mean(times))
+
+
+def time_budget_exceeded():
+    """
+    Checks whether acquiring another spectrum is predicted to take the
+    optimisation beyond its time budget (if there is one).
+
+    Returns
+    -------
+    bool
+    """
+    t_next = predict_eval_time()
+    if _g.maxtime <= 0 or t_next is None:
+        return False
+    elapsed = (datetime.now() - _g.t_start).total_seconds()
+    return elapsed + t_next > _g.maxtime
+
+
+def log_predicted_finish(logf):
+    """
+    Writes the predicted time at which the optimisation will have finished
+    to the log file, together with the number of spectra that can still be
+    acquired within the budget. This is an upper bound: the optimisation may
+    well converge sooner. Nothing is written if there is neither a time
+    budget nor a maximum number of function evaluations.
+
+    Parameters
+    ----------
+    logf : file object
+        The open poise.log file.
+
+    Returns
+    -------
+    None
+    """
+    t_next = predict_eval_time()
+    if (_g.maxtime <= 0 and _g.maxfev <= 0) or not t_next:
+        return
+    now = datetime.now()
+    remaining = []
+    if _g.maxfev > 0:
+        # acquire_nmr.calls doesn't yet include the current spectrum.
+        remaining.append(max(_g.maxfev - acquire_nmr.calls - 1, 0))
+    if _g.maxtime > 0:
+        t_left = _g.maxtime - (now - _g.t_start).total_seconds()
+        remaining.append(max(int(t_left // t_next), 0))
+    n = min(remaining)
+    finish = now + timedelta(seconds=n * t_next)
+    if _g.maxtime > 0:
+        finish = min(finish, _g.t_start + timedelta(seconds=_g.maxtime))
+    print(f"Predicted finish by {finish.strftime('%H:%M:%S')}"
+          f" ({n} more spectra at most)", file=logf)
+
+
+def constraint_penalty():
+    """
+    Calculates the cost function value that BOBYQA is given for points that
+    violate the routine's constraints. This is larger than every value seen
+    so far by the spread of those values.
+
+    Returns
+    -------
+    float
+        The penalty value.
+    """
+    if len(_g.fvals) == 0:
+        return 1
+    fmax, fmin = np.max(_g.fvals), np.min(_g.fvals)
+    spread = (fmax - fmin) or abs(fmax) or 1
+    return float(fmax + spread)
+
+
+class _PerRunCounter():
+    """
+    Callable returned by deco_count_per_run().
+    """
+    def __init__(self, fn):
+        update_wrapper(self, fn)
+
+    def __call__(self, *args, **kwargs):
+        try:
+            result = self.__wrapped__(*args, **kwargs)
+        except NotAcquiredError as e:
+            return e.value
+        else:
+            self.calls += 1
+            return result
+
+    @property
+    def calls(self):
+        return _g.acquire_calls
+
+    @calls.setter
+    def calls(self, value):
+        _g.acquire_calls = value
+
+
+def deco_count_per_run(fn):
+    """
+    Like optpoise.deco_count(), but the number of calls is stored in the
+    State of the current optimisation (as ``_g.acquire_calls``) instead of on
+    the function, so that optimisations run at the same time by the backend
+    daemon are counted separately.
+    """
+    return _PerRunCounter(fn)
+
+
+@deco_count_per_run
+def acquire_nmr(x, cost_function, routine, allow_repeat=False):
     """
     This is the function which is actually passed to the optimisation function
     as the "cost function", and is responsible for triggering acquisition in
@@ -246,6 +1554,10 @@ def acquire_nmr(x, cost_function, routine):
     Briefly, this function does the following:
 
      - Returns np.inf immediately if the values are outside the given bounds.
+     - Rounds the values of discrete parameters to their lattice.
+     - Returns immediately, without acquiring a spectrum, if the values
+       violate the routine's constraints, or if the routine has discrete
+       parameters and the (rounded) point has already been acquired.
      - Otherwise, prints the values to stdout, which triggers acquisition by
        the frontend.
      - Waits for the frontend to pass the message "done" back, indicating that
@@ -262,6 +1574,9 @@ def acquire_nmr(x, cost_function, routine):
         User-defined cost function object.
     routine : Routine
         The active optimisation routine.
+    allow_repeat : bool, optional
+        If True, a point is acquired even if it has been acquired before.
+        This is used for the replicates in estimate_noise().
 
     Returns
     -------
@@ -269,12 +1584,20 @@ def acquire_nmr(x, cost_function, routine):
         Value of the cost function.
     """
     unscaled_val = unscale(x, routine.lb, routine.ub,
-                           routine.tol, scaleby="tols")
+                           routine.tol, scaleby="tols",
+                           transforms=routine.transforms)
+    # Points on the bounds may end up very slightly outside them because of
+    # floating-point error in scaling and unscaling. Put them back.
+    for bound in [routine.lb, routine.ub]:
+        unscaled_val = np.where(np.isclose(unscaled_val, bound,
+                                           rtol=1e-9, atol=1e-12),
+                                bound, unscaled_val)
     # Format string for logging.
     fstr = "{:^10.4f}  " * (len(x) + 1)
 
     with open(_g.p_optlog, "a") as logf:
-        # Enforce constraints on optimisation.
+        # Enforce constraints on optimisation. (NM never gets here, since it
+        # is run with bounds_method="reflect".)
         # This doesn't need to be done for BOBYQA, because we pass the `bounds`
         # parameter, which automatically stops it from sampling outside the
         # bounds. If we *do* enforce the constraints on BOBYQA, this can lead
@@ -288,13 +1611,64 @@ def acquire_nmr(x, cost_function, routine):
             print(fstr.format(*unscaled_val, np.inf), file=logf)
             raise OutOfBoundsError
 
-        # Print unscaled values, prompting frontend script to start acquisition
-        print("values: " + " ".join([str(i) for i in unscaled_val]))
+        # Round discrete parameters. TopSpin would otherwise do this silently,
+        # so that the point recorded would not be the one that was acquired.
+        if routine.steps:
+            unscaled_val = round_to_steps(unscaled_val, routine.steps,
+                                          routine.lb, routine.ub)
+
+        # Points which violate the routine's constraints are not acquired
+        # either. BOBYQA builds a quadratic model of the cost function, which
+        # would be ruined by infinite values, so it gets a finite penalty
+        # instead. The log shows infinity in both cases.
+        if _g.violation is not None and _g.violation(unscaled_val) > 0:
+            print(fstr.format(*unscaled_val, np.inf), file=logf)
+            if _g.optimiser == "bobyqa":
+                raise OutOfBoundsError(constraint_penalty())
+            raise OutOfBoundsError
+
+        # With discrete parameters, different trial points often round to
+        # the same acquisition. Reuse the value(s) already measured there.
+        # This is also done in separable mode, where the sub-optimisations
+        # reuse the spectra acquired when testing for separability, and when
+        # restarting, where the new optimisation starts from the best point.
+        if ((routine.steps or _g.separable or _g.restarts)
+                and not allow_repeat):
+            cf_val = previous_evaluation(unscaled_val)
+            if cf_val is not None:
+                raise NotAcquiredError(cf_val)
+
+        # If resuming, use the recorded value instead of acquiring again.
+        cf_val = replay_evaluation(unscaled_val)
+        if cf_val is not None:
+            _g.nfev += 1
+            print(fstr.format(*unscaled_val, cf_val), file=logf)
+            record_evaluation(unscaled_val, cf_val)
+            return cf_val
+
+        # Print unscaled values, prompting frontend script to start
+        # acquisition. Any acquisition parameters which should be changed for
+        # this evaluation (in multi-fidelity mode) are appended after a '|'.
+        values_msg = "values: " + " ".join([str(i) for i in unscaled_val])
+        if _g.fidelity:
+            values_msg += " | " + format_fidelity(_g.fidelity)
+        # If there isn't enough time left to acquire it, stop instead. This
+        # is treated like a CostFunctionError, so the best point so far is
+        # still returned.
+        if time_budget_exceeded():
+            msg = ("The next spectrum would exceed the time budget"
+                   f" of {_g.maxtime:g} s.")
+            print(msg, file=logf)
+            raise CostFunctionError(msg)
+        print(values_msg)
+        t_acq = datetime.now()
         # Wait for acquisition to complete, then calculate cost function
         signal = input()  # frontend prints "done" here
         # Set p_spectrum according to which spectrum the frontend evaluated.
         # This is important when using the separate_expnos option.
         _g.p_spectrum = Path(input())  # frontend prints path to active spec.
+        _g.eval_times.append((dict(_g.fidelity),
+                              (datetime.now() - t_acq).total_seconds()))
         # Evaluate the cost function, log, pass the cost function value back
         # to the frontend (it's stored in the `TI` parameter), and return.
         if signal == "done":
@@ -307,8 +1681,7 @@ def acquire_nmr(x, cost_function, routine):
                 try:
                     e.cf_val = float(e.cf_val)
                     print(fstr.format(*unscaled_val, e.cf_val), file=logf)
-                    _g.xvals.append(unscaled_val)
-                    _g.fvals = np.append(_g.fvals, e.cf_val)
+                    record_evaluation(unscaled_val, e.cf_val)
                 except ValueError:   # couldn't be converted to a float
                     fstr2 = "{:^10.4f}  " * len(x)
                     print(fstr2.format(*unscaled_val), file=logf)
@@ -332,8 +1705,8 @@ def acquire_nmr(x, cost_function, routine):
                 # No CostFunctionError raised.
                 print(fstr.format(*unscaled_val, cf_val), file=logf)
                 print(f"cf: {cf_val}")  # send back to frontend
-                _g.xvals.append(unscaled_val)
-                _g.fvals = np.append(_g.fvals, cf_val)
+                record_evaluation(unscaled_val, cf_val)
+                log_predicted_finish(logf)
                 return cf_val    # return control to optimiser
             # Any other error will be propagated up.
         else:
@@ -0,0 +1,322 @@
+"""
+batch.py
+--------
+
+Vectorised versions of the Nelder-Mead and multidimensional search optimisers
+in optpoise.py, which run many independent optimisations in lockstep. These
+are meant for simulations (e.g. for choosing tolerances or comparing
+algorithms on synthetic cost functions), where thousands of optimisations are
+run and the Python overhead of the scalar optimisers dominates.
+
+The simplices of all optimisations are stored in one array of shape (B, N + 1,
+N), and every step (reflection, sorting, convergence tests, etc.) is carried
+out on all optimisations that need it at once. The cost function is likewise
+called with a 2D array of points. Each optimisation follows exactly the same
+steps as the scalar optimiser would.
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+import numpy as np
+
+from .optpoise import (initial_simplex, bound_point, OptResult,
+                       MAGIC_TOL, NOISE_THRESHOLD,
+                       MESSAGE_OPT_SUCCESS, MESSAGE_OPT_MAXFEV_REACHED,
+                       MESSAGE_OPT_MAXITER_REACHED, MESSAGE_OPT_NOISE_LIMITED)
+
+
+class BatchSimplex():
+    """
+    The simplices of a batch of optimisations, together with the
+    bookkeeping that the scalar optimisers do using deco_cf(): counting
+    function evaluations, enforcing the maximum, and keeping track of the
+    best point evaluated so far.
+
+    Optimisations are referred to by their index in the batch. Methods which
+    take an array of indices only act on those optimisations.
+    """
+    def __init__(self, cf, x0, xtol, scaled_lb, scaled_ub, args, maxfev,
+                 simplex_method, seed, init_step, noise):
+        x0 = np.atleast_2d(np.asfarray(x0))
+        self.B, self.N = x0.shape
+        self.cf, self.args = cf, args
+        self.xtol, self.lb, self.ub = (np.broadcast_to(np.asfarray(a),
+                                                       x0.shape)
+                                       for a in (xtol, scaled_lb, scaled_ub))
+        self.maxiter = 500 * self.N
+        self.maxfev = maxfev if maxfev > 0 else 500 * self.N
+        self.noise = noise
+
+        # The initial simplex always lies within the bounds.
+        self.x = initial_simplex(x0, method=simplex_method, length=init_step,
+                                 seed=seed, lb=self.lb, ub=self.ub)
+        self.f = np.full((self.B, self.N + 1), np.inf)
+        self.init_range = np.ptp(self.x, axis=1)
+
+        self.niter = np.zeros(self.B, dtype=int)
+        self.calls = np.zeros(self.B, dtype=int)
+        self.xbest, self.fbest = self.x[:, 0].copy(), np.full(self.B, np.inf)
+        self.message = np.full(self.B, None, dtype=object)
+
+    def active(self):
+        """
+        Indices of the optimisations which have not terminated yet.
+        """
+        return np.flatnonzero(self.message == None)  # noqa: E711
+
+    def stop(self, idx, mask, message):
+        """
+        Terminates the optimisations idx[mask], and returns the rest of idx.
+        """
+        self.message[idx[mask]] = message
+        return idx[~mask]
+
+    def within_budget(self, idx, reserve=0):
+        """
+        Terminates the optimisations in idx which have no more than
+        ``reserve`` function evaluations left, and returns a boolean mask
+        for the remaining ones.
+        """
+        over = self.calls[idx] >= self.maxfev - reserve
+        self.message[idx[over]] = MESSAGE_OPT_MAXFEV_REACHED
+        return ~over
+
+    def evaluate(self, idx, x):
+        """
+        Evaluates the cost function at one point (x[i]) for each optimisation
+        (idx[i]).
+        """
+        if idx.size == 0:
+            return np.zeros(0)
+        f = np.asfarray(self.cf(np.ascontiguousarray(x), *self.args))
+        self.calls[idx] += 1
+        better = f < self.fbest[idx]
+        self.xbest[idx[better]] = x[better]
+        self.fbest[idx[better]] = f[better]
+        return f
+
+    def sort(self, idx):
+        """
+        Sorts the simplices in ascending order of the cost function.
+        """
+        order = np.argsort(self.f[idx], axis=1)
+        self.x[idx] = np.take_along_axis(self.x[idx], order[:, :, None], 1)
+        self.f[idx] = np.take_along_axis(self.f[idx], order, 1)
+
+    def replace_worst(self, idx, x, f):
+        """
+        Replaces the worst point of each simplex, then sorts them.
+        """
+        self.sort(idx)
+        self.x[idx, self.N], self.f[idx, self.N] = x, f
+        self.sort(idx)
+
+    def evaluate_initial(self):
+        """
+        Evaluates the cost function at the vertices of the initial simplices,
+        sorting after each evaluation like the scalar optimisers do.
+        """
+        for i in range(self.N + 1):
+            idx = self.active()
+            idx = idx[self.within_budget(idx)]
+            self.f[idx, i] = self.evaluate(idx, self.x[idx, i])
+            self.sort(idx)
+
+    def start_iteration(self):
+        """
+        Checks the convergence criteria for all active optimisations, then
+        increments the number of iterations for the rest.
+
+        Returns
+        -------
+        ndarray
+            The indices of the optimisations that carry on.
+        """
+        idx = self.active()
+        simplex_range = np.ptp(self.x[idx], axis=1)
+        idx = self.stop(idx, np.all(simplex_range <= self.xtol[idx], axis=1),
+                        MESSAGE_OPT_SUCCESS)
+        if self.noise > 0:
+            simplex_range = np.ptp(self.x[idx], axis=1)
+            noise_limited = (
+                np.all(simplex_range <= 0.5 * self.init_range[idx], axis=1)
+                & (np.ptp(self.f[idx], axis=1)
+                   <= NOISE_THRESHOLD * self.noise))
+            idx = self.stop(idx, noise_limited, MESSAGE_OPT_NOISE_LIMITED)
+        self.niter[idx] += 1
+        self.sort(idx)
+        return self.stop(idx, self.niter[idx] >= self.maxiter,
+                         MESSAGE_OPT_MAXITER_REACHED)
+
+    def result(self):
+        """
+        Sorts all simplices and collects the results.
+        """
+        self.sort(np.arange(self.B))
+        return OptResult(xbest=self.xbest, fbest=self.fbest,
+                         niter=self.niter, nfev=self.calls,
+                         simplex=self.x, fvals=self.f,
+                         message=self.message.tolist())
+
+
+def nelder_mead_batch(cf, x0, xtol, scaled_lb, scaled_ub,
+                      args=(), maxfev=0, simplex_method="spendley", seed=None,
+                      init_step=MAGIC_TOL * 10, noise=0, bounds_method=None):
+    """
+    Runs many independent Nelder-Mead optimisations at once. Each of them
+    takes exactly the same steps as optpoise.nelder_mead().
+
+    Parameters
+    ----------
+    cf : function
+        The cost function. This must be vectorised: it is called with an
+        array of points of shape (M, N) (plus ``args``), and must return an
+        array of M cost function values. Each point may belong to a different
+        optimisation.
+    x0 : ndarray
+        Initial points, with shape (B, N), for B optimisations in N
+        dimensions.
+    xtol, scaled_lb, scaled_ub : ndarray
+        Tolerances and bounds, either with shape (N,) (shared by all
+        optimisations) or (B, N).
+    The other parameters are the same as for optpoise.nelder_mead(), and
+    apply to every optimisation.
+
+    Returns
+    -------
+    OptResult
+        Has the same attributes as the result of optpoise.nelder_mead(), but
+        each is an array with one entry per optimisation (``message`` is a
+        list).
+    """
+    sim = BatchSimplex(cf, x0, xtol, scaled_lb, scaled_ub, args, maxfev,
+                       simplex_method, seed, init_step, noise)
+    N = sim.N
+    mu_ic, mu_oc, mu_r, mu_e = -0.5, 0.5, 1, 2
+
+    def xnew(mu, idx):
+        xbar = np.mean(sim.x[idx, 0:N], axis=1)
+        x = ((1 + mu) * xbar) - (mu * sim.x[idx, N])
+        return bound_point(x, sim.lb[idx], sim.ub[idx], bounds_method)
+
+    def shrink(idx):
+        idx = idx[sim.within_budget(idx, reserve=N)]
+        x0 = sim.x[idx, 0:1]
+        sim.x[idx, 1:] = x0 - (sim.x[idx, 1:] - x0)/2
+        for i in range(1, N + 1):
+            sim.f[idx, i] = sim.evaluate(idx, sim.x[idx, i])
+        sim.sort(idx)
+
+    sim.evaluate_initial()
+    while True:
+        idx = sim.start_iteration()
+        idx = idx[sim.within_budget(idx)]
+        if idx.size == 0:
+            break
+
+        # Reflect.
+        x_r = xnew(mu_r, idx)
+        f_r = sim.evaluate(idx, x_r)
+        f_0, f_n1, f_n = sim.f[idx, 0], sim.f[idx, N - 1], sim.f[idx, N]
+
+        accept = (f_0 <= f_r) & (f_r < f_n1)
+        sim.replace_worst(idx[accept], x_r[accept], f_r[accept])
+
+        # Expand.
+        expand = f_r < f_0
+        e_idx, e_xr, e_fr = idx[expand], x_r[expand], f_r[expand]
+        ok = sim.within_budget(e_idx)
+        e_idx, e_xr, e_fr = e_idx[ok], e_xr[ok], e_fr[ok]
+        x_e = xnew(mu_e, e_idx)
+        f_e = sim.evaluate(e_idx, x_e)
+        better = f_e < e_fr
+        sim.replace_worst(e_idx, np.where(better[:, None], x_e, e_xr),
+                          np.where(better, f_e, e_fr))
+
+        # Outside and inside contractions.
+        shrink_idx = []
+        for mu, contract in [(mu_oc, (f_n1 <= f_r) & (f_r < f_n)),
+                             (mu_ic, f_r >= f_n)]:
+            c_idx, c_fr = idx[contract], f_r[contract]
+            ok = sim.within_budget(c_idx)
+            c_idx, c_fr = c_idx[ok], c_fr[ok]
+            x_c = xnew(mu, c_idx)
+            f_c = sim.evaluate(c_idx, x_c)
+            if mu == mu_oc:
+                success = f_c <= c_fr
+            else:
+                success = f_c < sim.f[c_idx, N]
+            sim.replace_worst(c_idx[success], x_c[success], f_c[success])
+            shrink_idx.append(c_idx[~success])
+        shrink(np.concatenate(shrink_idx))
+
+    return sim.result()
+
+
+def multid_search_batch(cf, x0, xtol, scaled_lb, scaled_ub,
+                        args=(), maxfev=0, simplex_method="spendley",
+                        seed=None, init_step=MAGIC_TOL * 10, noise=0,
+                        bounds_method=None):
+    """
+    Runs many independent multidimensional search optimisations at once.
+    Each of them takes exactly the same steps as optpoise.multid_search().
+
+    The parameters and return value are the same as for nelder_mead_batch().
+    """
+    sim = BatchSimplex(cf, x0, xtol, scaled_lb, scaled_ub, args, maxfev,
+                       simplex_method, seed, init_step, noise)
+    N = sim.N
+    mu_e, mu_c = 2, 0.5
+
+    def evaluate_vertices(idx, mu, bounded):
+        """
+        Evaluates the points x0 - mu * (x[j] - x0) one vertex at a time,
+        dropping optimisations whose budget runs out on the way. Returns the
+        indices which evaluated all of them, the mask of these within idx,
+        and the points and values.
+        """
+        alive = np.ones(idx.size, dtype=bool)
+        xs = np.zeros((idx.size, N, N))
+        fs = np.zeros((idx.size, N))
+        for j in range(1, N + 1):
+            alive[alive] = sim.within_budget(idx[alive])
+            a_idx = idx[alive]
+            x0 = sim.x[a_idx, 0]
+            x = x0 - mu * (sim.x[a_idx, j] - x0)
+            if bounded:
+                x = bound_point(x, sim.lb[a_idx], sim.ub[a_idx],
+                                bounds_method)
+            xs[alive, j - 1] = x
+            fs[alive, j - 1] = sim.evaluate(a_idx, x)
+        return idx[alive], alive, xs[alive], fs[alive]
+
+    sim.evaluate_initial()
+    while True:
+        idx = sim.start_iteration()
+        if idx.size == 0:
+            break
+
+        # Reflect.
+        idx, _, r_j, f_r_j = evaluate_vertices(idx, 1, True)
+
+        # Expand.
+        expand = sim.f[idx, 0] > np.amin(f_r_j, axis=1)
+        e_idx, alive, e_j, f_e_j = evaluate_vertices(idx[expand], mu_e, True)
+        r_j, f_r_j = r_j[expand][alive], f_r_j[expand][alive]
+        use_e = np.amin(f_r_j, axis=1) > np.amin(f_e_j, axis=1)
+        sim.x[e_idx, 1:] = np.where(use_e[:, None, None], e_j, r_j)
+        sim.f[e_idx, 1:] = np.where(use_e[:, None], f_e_j, f_r_j)
+        sim.sort(e_idx)
+
+        # Contract. The vertices are moved before they are evaluated, so if
+        # the budget runs out halfway, the simplex is left half-contracted
+        # (exactly like the scalar version).
+        c_idx = idx[~expand]
+        for j in range(1, N + 1):
+            x0 = sim.x[c_idx, 0]
+            sim.x[c_idx, j] = x0 + mu_c * (sim.x[c_idx, j] - x0)
+            c_idx = c_idx[sim.within_budget(c_idx)]
+            sim.f[c_idx, j] = sim.evaluate(c_idx, sim.x[c_idx, j])
+        sim.sort(c_idx)
+
+    return sim.result()
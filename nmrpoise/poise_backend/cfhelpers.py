@@ -244,9 +244,17 @@ def _get_1d(spec_fname, bounds="", p_spec=None):
     """
     p_spec = p_spec or _g.p_spectrum
     p_specdata = p_spec / spec_fname
-    spec = np.fromfile(p_specdata, dtype=np.int32)
-    nc_proc = int(getpar("NC_proc", p_spec))
-    spec = spec * (2 ** nc_proc)
+    # Determine datatype (TopSpin DTYPP parameter). For int values, NC_proc is
+    # used to scale the data; for double values, it is not used. Older
+    # datasets may not have DTYPP or BYTORDP, in which case they are int and
+    # little-endian.
+    dt = ">" if getpar("BYTORDP", p_spec) == 1 else "<"
+    if getpar("DTYPP", p_spec) == 2:
+        spec = np.fromfile(p_specdata, dtype=np.dtype(dt + "d"))
+    else:
+        spec = np.fromfile(p_specdata, dtype=np.dtype(dt + "i4"))
+        nc_proc = int(getpar("NC_proc", p_spec))
+        spec = spec * (2 ** nc_proc)
 
     # Handle an edge case where _g.spec_f1p and _g.spec_f2p can be ndarrays
     # (for a 1D spectrum they should be floats). This occurs when the spectrum
@@ -344,12 +352,15 @@ def _get_2d(spec_fname, f1_bounds="", f2_bounds="", p_spec=None):
 
     # Check data type (TopSpin 3 int vs TopSpin 4 float)
     dtypp = getpar("dtypp", p_spec)
+    dt = "<" if np.all(getpar("bytordp", p_spec) == 0) else ">"
     if dtypp[0] == 0 and dtypp[1] == 0:  # TS3 data
-        dt = "<" if np.all(getpar("bytordp", p_spec) == 0) else ">"
         dt += "i4"
+        scaling_factor = 2 ** getpar("nc_proc", p_spec)[1]
+    elif dtypp[0] == 2 and dtypp[1] == 2:
+        dt += "d"
+        scaling_factor = 1
     else:
-        raise NotImplementedError("_get_2d: "
-                                  "float data not yet accepted")
+        raise NotImplementedError(f"_get_2d: DTYPP {dtypp} not accepted")
     sp = np.fromfile(p_specdata, dtype=np.dtype(dt))
     # Format according to xdim. See TopSpin "data format" manual.
     # See also http://docs.nmrfx.org/viewer/files/datasets.
@@ -368,7 +379,7 @@ def _get_2d(spec_fname, f1_bounds="", f2_bounds="", p_spec=None):
     sp = np.hsplit(sp, nrows)
     sp = np.concatenate(sp, axis=0)
     sp = sp.reshape(si)
-    sp = sp * (2 ** getpar("nc_proc", p_spec)[1])
+    sp = sp * scaling_factor
 
     # Read in DPL and overwrite bounds if the bounds were not set
     if f1_bounds == "":
@@ -699,6 +710,20 @@ def getnfev():
     return _g.nfev
 
 
+def getfidelity():
+    """
+    Returns the acquisition parameters which were overridden for the spectrum
+    being evaluated, as a dict (e.g. ``{"NS": "1"}`` for the exploratory
+    stage of a multi-fidelity optimisation). The dict is empty if the
+    spectrum was acquired with the parameters of the dataset, i.e. at full
+    fidelity.
+
+    Most cost functions need not care about this, since cost function values
+    are only ever compared between spectra of the same fidelity.
+    """
+    return dict(_g.fidelity)
+
+
 def log(*args):
     """
     Prints something to the poise.log file.
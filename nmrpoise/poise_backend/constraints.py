@@ -0,0 +1,182 @@
+"""
+constraints.py
+--------------
+
+Functions for parsing and evaluating the inequality constraints which can be
+specified in a routine, e.g. "d1 >= d20 + p1 * 1e-6".
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+import ast
+import sys
+import operator
+
+import numpy as np
+
+
+# Numbers are parsed as ast.Num before Python 3.8, and as ast.Constant
+# afterwards (ast.Num is deprecated from then on).
+_NUMBER = ast.Constant if sys.version_info >= (3, 8) else ast.Num
+# Operators and functions that may be used in constraint expressions.
+_BINOPS = {ast.Add: operator.add,
+           ast.Sub: operator.sub,
+           ast.Mult: operator.mul,
+           ast.Div: operator.truediv,
+           ast.Pow: operator.pow,
+           }
+_UNARYOPS = {ast.UAdd: operator.pos,
+             ast.USub: operator.neg,
+             }
+_FUNCTIONS = {"abs": abs,
+              "min": min,
+              "max": max,
+              "sqrt": np.sqrt,
+              "exp": np.exp,
+              "log": np.log,
+              "log10": np.log10,
+              }
+
+
+def make_violation_function(constraints, pars):
+    """
+    Compiles a list of constraints into a single function which measures how
+    badly a point violates them.
+
+    Each constraint is a string containing one comparison (using ``<``,
+    ``<=``, ``>``, or ``>=``) between two arithmetic expressions in the
+    optimisation parameters, for example ``"d1 >= d20 + p1 * 1e-6"``.
+    Parameter names are case-insensitive, and must be given in the same units
+    as in the routine (i.e. the units that TopSpin uses). Numbers, ``+ - * /
+    **``, brackets, and the functions abs, min, max, sqrt, exp, log, and log10
+    may be used. Chained comparisons such as ``"0 < d1 - d2 < 0.1"`` are also
+    allowed.
+
+    Parameters
+    ----------
+    constraints : list of str or None
+        The constraints. None is the same as an empty list.
+    pars : list of str
+        The names of the optimisation parameters, in order.
+
+    Returns
+    -------
+    function
+        A function which takes the (unscaled) values of the parameters and
+        returns the total amount by which the constraints are violated. This
+        is zero if (and only if) all constraints are satisfied.
+
+    Raises
+    ------
+    ValueError
+        If any of the constraints is not a valid expression.
+    """
+    indices = {par.lower(): i for i, par in enumerate(pars)}
+    trees = [_parse_constraint(c, indices) for c in (constraints or [])]
+
+    def violation(x):
+        total = 0
+        for tree in trees:
+            # Evaluate each side of each comparison.
+            values = [_evaluate(node, x, indices)
+                      for node in [tree.left] + tree.comparators]
+            for op, left, right in zip(tree.ops, values[:-1], values[1:]):
+                if isinstance(op, (ast.Lt, ast.LtE)):
+                    total += max(0, left - right)
+                else:
+                    total += max(0, right - left)
+        return total
+
+    return violation
+
+
+def _parse_constraint(constraint, indices):
+    """
+    Parses one constraint and checks that it only contains allowed
+    operations.
+
+    Parameters
+    ----------
+    constraint : str
+        The constraint.
+    indices : dict
+        Lowercased parameter names, mapped to their positions.
+
+    Returns
+    -------
+    ast.Compare
+        The parsed constraint.
+    """
+    try:
+        tree = ast.parse(constraint.strip(), mode="eval").body
+    except SyntaxError:
+        raise ValueError(f"Invalid constraint '{constraint}'.") from None
+    if (not isinstance(tree, ast.Compare)
+            or not all(isinstance(op, (ast.Lt, ast.LtE, ast.Gt, ast.GtE))
+                       for op in tree.ops)):
+        raise ValueError(f"Invalid constraint '{constraint}': constraints"
+                         " must be inequalities.")
+    for node in [tree.left] + tree.comparators:
+        _check_node(node, indices, constraint)
+    return tree
+
+
+def _check_node(node, indices, constraint):
+    """
+    Recursively checks that an expression only contains numbers, parameters,
+    and allowed operators and functions.
+    """
+    if isinstance(node, _NUMBER):
+        ok = isinstance(_number_value(node), (int, float))
+    elif isinstance(node, ast.Name):
+        ok = node.id.lower() in indices
+        if not ok:
+            raise ValueError(f"Invalid constraint '{constraint}': unknown"
+                             f" parameter '{node.id}'.")
+    elif isinstance(node, ast.BinOp):
+        ok = type(node.op) in _BINOPS
+        _check_node(node.left, indices, constraint)
+        _check_node(node.right, indices, constraint)
+    elif isinstance(node, ast.UnaryOp):
+        ok = type(node.op) in _UNARYOPS
+        _check_node(node.operand, indices, constraint)
+    elif isinstance(node, ast.Call):
+        ok = (isinstance(node.func, ast.Name)
+              and node.func.id in _FUNCTIONS
+              and not node.keywords)
+        for arg in node.args:
+            _check_node(arg, indices, constraint)
+    else:
+        ok = False
+    if not ok:
+        # Name the operator rather than the operation, if that is what is
+        # not allowed (e.g. FloorDiv rather than BinOp).
+        what = type(getattr(node, "op", node)).__name__
+        raise ValueError(f"Invalid constraint '{constraint}': {what} is not"
+                         " allowed.")
+
+
+def _number_value(node):
+    """
+    Returns the value of a node which has been parsed as a number.
+    """
+    return node.value if sys.version_info >= (3, 8) else node.n
+
+
+def _evaluate(node, x, indices):
+    """
+    Recursively evaluates an expression which has been checked using
+    _check_node().
+    """
+    if isinstance(node, _NUMBER):
+        return _number_value(node)
+    elif isinstance(node, ast.Name):
+        return x[indices[node.id.lower()]]
+    elif isinstance(node, ast.BinOp):
+        return _BINOPS[type(node.op)](_evaluate(node.left, x, indices),
+                                      _evaluate(node.right, x, indices))
+    elif isinstance(node, ast.UnaryOp):
+        return _UNARYOPS[type(node.op)](_evaluate(node.operand, x, indices))
+    elif isinstance(node, ast.Call):
+        return _FUNCTIONS[node.func.id](*[_evaluate(arg, x, indices)
+                                          for arg in node.args])
@@ -0,0 +1,202 @@
+"""
+database.py
+-----------
+
+Functions for storing completed optimisations in a SQLite database, so that
+the results of previous runs can be looked up without having to find and
+parse every poise.log file.
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+import json
+import sqlite3
+from contextlib import closing
+
+
+# Columns of the runs table, in order. List-valued fields (parameters, bounds,
+# the optimum, and the evaluation history) are stored as JSON strings.
+COLUMNS = [("date", "TEXT"),          # "%Y-%m-%d %H:%M:%S"
+           ("routine", "TEXT"),
+           ("pars", "TEXT"),          # JSON
+           ("cf", "TEXT"),
+           ("au", "TEXT"),
+           ("algorithm", "TEXT"),
+           ("init", "TEXT"),          # JSON
+           ("lb", "TEXT"),            # JSON
+           ("ub", "TEXT"),            # JSON
+           ("tol", "TEXT"),           # JSON
+           ("optimum", "TEXT"),       # JSON
+           ("fbest", "REAL"),
+           ("nfev", "INTEGER"),
+           ("time", "REAL"),          # seconds
+           ("message", "TEXT"),
+           ("probe", "TEXT"),
+           ("solvent", "TEXT"),
+           ("instrument", "TEXT"),
+           ("sample", "TEXT"),        # dataset name
+           ("spectrum", "TEXT"),      # path to procno folder
+           ("xvals", "TEXT"),         # JSON, list of lists
+           ("fvals", "TEXT"),         # JSON
+           ]
+JSON_COLUMNS = ["pars", "init", "lb", "ub", "tol", "optimum", "xvals",
+                "fvals"]
+
+
+def connect(p_db):
+    """
+    Opens a connection to the database, creating the runs table (and its
+    index) if it doesn't already exist.
+
+    Parameters
+    ----------
+    p_db : |Path|
+        Path to the database file.
+
+    Returns
+    -------
+    sqlite3.Connection
+    """
+    conn = sqlite3.connect(str(p_db))
+    conn.row_factory = sqlite3.Row
+    coldefs = ", ".join(f"{name} {type}" for name, type in COLUMNS)
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS runs "
+                     f"(id INTEGER PRIMARY KEY AUTOINCREMENT, {coldefs})")
+        conn.execute("CREATE INDEX IF NOT EXISTS runs_routine_cf "
+                     "ON runs (routine, cf, id)")
+    return conn
+
+
+def record_run(p_db, **run):
+    """
+    Adds one completed optimisation to the database.
+
+    Parameters
+    ----------
+    p_db : |Path|
+        Path to the database file.
+    run
+        Values for each column in ``COLUMNS``. Columns which are not passed
+        are stored as NULL. The values of JSON columns can be lists or
+        ndarrays.
+
+    Returns
+    -------
+    int
+        The id of the new row.
+    """
+    unknown = set(run) - {name for name, _ in COLUMNS}
+    if unknown:
+        raise ValueError(f"Unknown database columns: {sorted(unknown)}")
+    values = []
+    for name, _ in COLUMNS:
+        value = run.get(name)
+        if name in JSON_COLUMNS and value is not None:
+            value = json.dumps(_tolist(value))
+        values.append(value)
+    names = ", ".join(name for name, _ in COLUMNS)
+    placeholders = ", ".join("?" * len(COLUMNS))
+    with closing(connect(p_db)) as conn:
+        with conn:
+            cursor = conn.execute(f"INSERT INTO runs ({names}) "
+                                  f"VALUES ({placeholders})", values)
+        return cursor.lastrowid
+
+
+def get_runs(p_db, routine=None, cf=None, pars=None, limit=None):
+    """
+    Looks up completed optimisations in the database, most recent first.
+
+    Parameters
+    ----------
+    p_db : |Path|
+        Path to the database file.
+    routine : str, optional
+        Only return runs of the routine with this name.
+    cf : str, optional
+        Only return runs which used this cost function.
+    pars : list of str, optional
+        Only return runs which optimised exactly these parameters (in this
+        order).
+    limit : int, optional
+        Maximum number of runs to return.
+
+    Returns
+    -------
+    list of dict
+        One dict per run, with keys given by ``COLUMNS`` (plus ``id``). JSON
+        columns are decoded back into lists. If the database file does not
+        exist, an empty list is returned.
+    """
+    if not p_db.exists():
+        return []
+    conditions, params = [], []
+    for name, value in [("routine", routine), ("cf", cf)]:
+        if value is not None:
+            conditions.append(f"{name} = ?")
+            params.append(value)
+    if pars is not None:
+        conditions.append("pars = ?")
+        params.append(json.dumps(list(pars)))
+    query = "SELECT * FROM runs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY id DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(int(limit))
+
+    with closing(connect(p_db)) as conn:
+        rows = conn.execute(query, params).fetchall()
+    runs = []
+    for row in rows:
+        run = dict(row)
+        for name in JSON_COLUMNS:
+            if run[name] is not None:
+                run[name] = json.loads(run[name])
+        runs.append(run)
+    return runs
+
+
+def get_acqus_string(par, p_acqus):
+    """
+    Obtains the value of a string-valued acquisition parameter, such as
+    PROBHD or SOLVENT. (getpar() only returns numeric parameters.)
+
+    Parameters
+    ----------
+    par : str
+        Name of the acquisition parameter.
+    p_acqus : |Path|
+        Path to the acqus file.
+
+    Returns
+    -------
+    str or None
+        The value, with the enclosing angle brackets removed. None if the
+        file or parameter doesn't exist.
+    """
+    try:
+        with open(p_acqus, "r") as file:
+            for line in file:
+                if line.startswith(f"##${par.upper()}="):
+                    value = line.split("=", maxsplit=1)[1].strip()
+                    if value.startswith("<") and value.endswith(">"):
+                        value = value[1:-1]
+                    return value
+    except OSError:
+        pass
+    return None
+
+
+def _tolist(value):
+    """
+    Recursively converts ndarrays (and numpy scalars) to Python objects so
+    that they can be serialised by json.dumps().
+    """
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_tolist(v) for v in value]
+    return value
@@ -14,25 +14,27 @@ import json
 from pathlib import Path
 
 
-def main():
+def get_cfs(file):
     """
-    Parses costfunctions.py to get the top-level functions. Prints them to
-    stdout with a space as the delimiter. This allows the frontend to read them
-    in using Popen.communicate().
+    Gets the top-level functions and their docstrings from a given file.
+    Returns a dictionary in the format {'function_name': 'docstring'}.
+    """
+    with open(file, 'r') as fp:
+        tree = ast.parse(fp.read())
+    # Find out which nodes are actually functions.
+    functions = [func for func in tree.body
+                 if isinstance(func, ast.FunctionDef)]
+    # Get their names as well as their docstrings.
+    function_names = [func.name for func in functions]
+    docstrings = [ast.get_docstring(func) for func in functions]
+    return dict(zip(function_names, docstrings))
+
+
+def get_all_cfs():
+    """
+    Gets the system and user cost functions, in the format returned by
+    get_cfs().
     """
-    def get_cfs(file):
-        # Gets cost functions and docstrings from a given file.
-        # Returns dictionary in the format {'function_name' : 'docstring'}.
-        with open(file, 'r') as fp:
-            tree = ast.parse(fp.read())
-        # Find out which nodes are actually functions.
-        functions = [func for func in tree.body
-                     if isinstance(func, ast.FunctionDef)]
-        # Get their names as well as their docstrings.
-        function_names = [func.name for func in functions]
-        docstrings = [ast.get_docstring(func) for func in functions]
-        return dict(zip(function_names, docstrings))
-
     cf_system_file = Path(__file__).resolve().parent / "costfunctions.py"
     cf_user_file = Path(__file__).resolve().parent / "costfunctions_user.py"
 
@@ -42,8 +44,16 @@ def main():
     # {**x, **y} causes the entries from y to overwrite entries from x with the
     # same name, which means that user cost functions shadow system cost
     # functions. In 3.9+ we can do this with all_cfs = system_cfs | user_cfs :)
-    all_cfs = {**system_cfs, **user_cfs}
-    print(json.dumps(all_cfs))
+    return {**system_cfs, **user_cfs}
+
+
+def main():
+    """
+    Parses costfunctions.py to get the top-level functions. Prints them to
+    stdout as a JSON dictionary. This allows the frontend to read them in
+    using Popen.communicate().
+    """
+    print(json.dumps(get_all_cfs()))
 
 
 if __name__ == "__main__":
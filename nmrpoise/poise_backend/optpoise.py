@@ -26,12 +26,105 @@ MESSAGE_OPT_PREMATURE_TERMINATION = ("Optimisation terminated"
                                      " before convergence.")
 MESSAGE_OPT_MAXFEV_REACHED = "Maximum function evaluations reached."
 MESSAGE_OPT_MAXITER_REACHED = "Maximum iterations reached."
+MESSAGE_OPT_NOISE_LIMITED = ("Optimisation terminated as the differences"
+                             " between cost function values were within the"
+                             " noise level.")
+MESSAGE_OPT_TARGET_REACHED = ("Optimisation terminated as the target cost"
+                              " function value was reached.")
+MESSAGE_OPT_STAGNATED = ("Optimisation terminated as the cost function"
+                         " stopped improving.")
 
+# Two cost function values are only considered to be significantly different
+# if they differ by more than NOISE_THRESHOLD times the standard deviation of
+# a single evaluation. This corresponds to a two-sided test at the 95% level
+# on the difference of two independent measurements.
+NOISE_THRESHOLD = 1.96 * np.sqrt(2)
 
-def scale(val, lb, ub, tol, scaleby="bounds"):
+
+def _logit(x):
+    return np.log(x / (1 - x))
+
+
+def _expit(x):
+    return 1 / (1 + np.exp(-x))
+
+
+# Transforms which can be applied to individual parameters before scaling.
+# Each entry is a tuple of (forward, inverse) functions. Tolerances of
+# transformed parameters are specified in the transformed space, so for
+# example a tolerance of 0.05 on a log-transformed parameter means that it is
+# optimised to within roughly 5% of its value.
+TRANSFORMS = {"linear": (lambda x: x, lambda x: x),
+              "log": (np.log, np.exp),
+              "logit": (_logit, _expit),
+              }
+
+
+def register_transform(name, forward, inverse):
+    """
+    Makes a new parameter transform available to routines. This can be called
+    from ``costfunctions_user.py``.
+
+    Parameters
+    ----------
+    name : str
+        The name of the transform, which is used in routine files.
+    forward : function
+        Function which transforms an ndarray of parameter values. It must be
+        strictly increasing over the bounds of any parameter it is used for.
+    inverse : function
+        The inverse of ``forward``.
+
+    Returns
+    -------
+    None
+    """
+    TRANSFORMS[name] = (forward, inverse)
+
+
+def _apply_transforms(val, transforms, inverse=False):
+    """
+    Applies per-parameter transforms to an ndarray of values.
+
+    Parameters
+    ----------
+    val : ndarray
+        The values to transform.
+    transforms : list of (str or None) or None
+        The name of the transform for each parameter. None is the same as
+        "linear".
+    inverse : bool, optional
+        Whether to apply the inverse transforms instead.
+
+    Returns
+    -------
+    ndarray
+        The transformed values.
+    """
+    if transforms is None:
+        return val
+    if len(transforms) != len(val):
+        raise ValueError(f"{len(transforms)} transforms were given for"
+                         f" {len(val)} parameters.")
+    val = np.array(val, dtype=float)
+    for i, name in enumerate(transforms):
+        try:
+            fns = TRANSFORMS[name or "linear"]
+        except KeyError:
+            raise ValueError(f"Invalid transform '{name}' specified.")
+        val[i] = fns[int(inverse)](val[i])
+    return val
+
+
+def scale(val, lb, ub, tol, scaleby="bounds", transforms=None):
     """
     Scales a set of values so that the optimisation behaves better.
 
+    If transforms are given, the values and bounds are first transformed
+    (e.g. by taking logarithms), and the scaling is then carried out in the
+    transformed space. The tolerances are taken to already be in the
+    transformed space.
+
     For scaleby="bounds", scales a set of values such that the lower and upper
     bounds for all variables are 0 and 1 respectively). We used to use this.
     As of the current version it's no longer being used.
@@ -51,6 +144,9 @@ def scale(val, lb, ub, tol, scaleby="bounds"):
         The unscaled tolerances.
     scaleby : str from {"bounds", "tols"}
         Method to scale by.
+    transforms : list of (str or None), optional
+        The name of the transform (a key of ``TRANSFORMS``) to apply to each
+        parameter. None means no transform.
 
     Returns
     -------
@@ -70,6 +166,14 @@ def scale(val, lb, ub, tol, scaleby="bounds"):
     # Check if any are outside bounds
     if np.any(val < lb) or np.any(val > ub):
         return None
+    # Transform them
+    if transforms is not None:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            val, lb, ub = (_apply_transforms(i, transforms)
+                           for i in (val, lb, ub))
+        if not np.all(np.isfinite(lb)) or not np.all(np.isfinite(ub)):
+            raise ValueError("The transforms are not defined over the whole"
+                             " range between the bounds.")
     # Scale them
     if scaleby == "bounds":
         scaled_val = (val - lb)/(ub - lb)
@@ -84,7 +188,8 @@ def scale(val, lb, ub, tol, scaleby="bounds"):
     return scaled_val, scaled_lb, scaled_ub, scaled_tol
 
 
-def unscale(scaled_val, orig_lb, orig_ub, orig_tol, scaleby="bounds"):
+def unscale(scaled_val, orig_lb, orig_ub, orig_tol, scaleby="bounds",
+            transforms=None):
     """
     Unscales a set of scaled values to their original values.
 
@@ -100,6 +205,8 @@ def unscale(scaled_val, orig_lb, orig_ub, orig_tol, scaleby="bounds"):
         The *unscaled* tolerances.
     scaleby : str from {"bounds", "tols"}
         Method to scale by.
+    transforms : list of (str or None), optional
+        The transforms which were passed to scale().
 
     Returns
     -------
@@ -112,10 +219,71 @@ def unscale(scaled_val, orig_lb, orig_ub, orig_tol, scaleby="bounds"):
                                                                     orig_lb,
                                                                     orig_ub,
                                                                     orig_tol))
+    orig_lb, orig_ub = (_apply_transforms(i, transforms)
+                        for i in (orig_lb, orig_ub))
     if scaleby == "bounds":
-        return orig_lb + (scaled_val * (orig_ub - orig_lb))
+        val = orig_lb + (scaled_val * (orig_ub - orig_lb))
     elif scaleby == "tols":
-        return (scaled_val * orig_tol / MAGIC_TOL) + orig_lb
+        val = (scaled_val * orig_tol / MAGIC_TOL) + orig_lb
+    return _apply_transforms(val, transforms, inverse=True)
+
+
+def initial_simplex(x0, method="spendley", length=MAGIC_TOL * 10, seed=None,
+                    lb=None, ub=None):
+    """
+    Constructs the initial simplex for Nelder-Mead or multidimensional
+    search. Several simplices can be constructed at once, by passing a 2D
+    array of initial points.
+
+    Parameters
+    ----------
+    x0 : ndarray
+        Initial guess, with shape (N,), or initial guesses, with shape (B, N).
+    method, length, seed, lb, ub
+        See Simplex. The bounds must either have shape (N,), or the same
+        shape as x0.
+
+    Returns
+    -------
+    ndarray
+        The simplex, with shape (N + 1, N), or the simplices, with shape (B, N
+        + 1, N). The first vertex of each is the initial guess.
+    """
+    x0 = np.asfarray(x0)
+    N = x0.shape[-1]
+    diagonal = np.eye(N, dtype=bool)
+    if method == "spendley":
+        # Default method.
+        # Spendley (1962). DOI 10.1080/00401706.1962.10490033
+        # Rosenbrock with x0 = [1.3, 0.7, 0.8, 1.9, 1.2]: 472 nfev, 284 nit
+        p = (1/(N * np.sqrt(2))) * (N - 1 + np.sqrt(N + 1))
+        q = (1/(N * np.sqrt(2))) * (np.sqrt(N + 1) - 1)
+        vertices = x0[..., None, :] + np.where(diagonal, length * p,
+                                               length * q)
+    elif method == "axis":
+        # Axis-by-axis simplex. Each point is just x0 extended along
+        # a different axis.
+        # Rosenbrock with x0 = [1.3, 0.7, 0.8, 1.9, 1.2]: 566 nfev, 342 nit
+        vertices = x0[..., None, :] + np.where(diagonal, length, 0.0)
+    elif method == "random":
+        # Every point except x0 is random.
+        # Rosenbrock with x0 = [1.3, 0.7, 0.8, 1.9, 1.2]: 705 nfev, 431 nit
+        # (average over 1000 iterations)
+        rng = np.random.default_rng(seed=seed)
+        vertices = np.broadcast_to(rng.uniform(size=(N, N)),
+                                   x0.shape[:-1] + (N, N))
+    else:
+        raise ValueError(f"invalid simplex generation method "
+                         "'{method}' specified")
+    x = np.concatenate([x0[..., None, :], vertices], axis=-2)
+
+    if lb is not None and ub is not None:
+        lb = np.broadcast_to(lb, x0.shape)[..., None, :]
+        ub = np.broadcast_to(ub, x0.shape)[..., None, :]
+        outside = (x < lb) | (x > ub)
+        x = np.where(outside, 2 * x0[..., None, :] - x, x)
+        x = np.clip(x, lb, ub)
+    return x
 
 
 class Simplex():
@@ -123,7 +291,7 @@ class Simplex():
     Simplex class.
     """
     def __init__(self, x0, method="spendley",
-                 length=MAGIC_TOL * 10, seed=None):
+                 length=MAGIC_TOL * 10, seed=None, lb=None, ub=None):
         """
         Initialises a Simplex object.
 
@@ -149,46 +317,24 @@ class Simplex():
             method="random". This parameter is passed directly to
             `numpy.random.default_rng()`; the full list of acceptable input is
             documented there.
+        lb : ndarray, optional
+            Lower bounds. If both bounds are given, every vertex which lies
+            outside the bounds is reflected through x0 (in each dimension
+            where it lies outside), and then clipped to the bounds if it is
+            still outside.
+        ub : ndarray, optional
+            Upper bounds.
         """
         self.x0 = np.ravel(np.asfarray(x0))
         self.N = np.size(self.x0)
 
         # Generate simplex
-        self.x = np.zeros((self.N + 1, self.N))
+        if lb is not None and ub is not None:
+            lb, ub = np.ravel(lb), np.ravel(ub)
+        self.x = initial_simplex(self.x0, method=method, length=length,
+                                 seed=seed, lb=lb, ub=ub)
         self.f = np.full(self.N + 1, fill_value=np.inf)
 
-        if method == "spendley":
-            # Default method.
-            # Spendley (1962). DOI 10.1080/00401706.1962.10490033
-            # Rosenbrock with x0 = [1.3, 0.7, 0.8, 1.9, 1.2]: 472 nfev, 284 nit
-            p = (1/(self.N * np.sqrt(2))) * (self.N - 1 + np.sqrt(self.N + 1))
-            q = (1/(self.N * np.sqrt(2))) * (np.sqrt(self.N + 1) - 1)
-            self.x[0] = self.x0
-            for i in range(1, self.N + 1):
-                for j in range(self.N):
-                    self.x[i, j] = self.x0[j] + length*p \
-                        if j == i - 1 else self.x0[j] + length*q
-        elif method == "axis":
-            # Axis-by-axis simplex. Each point is just x0 extended along
-            # a different axis.
-            # Rosenbrock with x0 = [1.3, 0.7, 0.8, 1.9, 1.2]: 566 nfev, 342 nit
-            self.x[0] = self.x0
-            for i in range(1, self.N + 1):
-                for j in range(self.N):
-                    self.x[i, j] = self.x0[j] + length \
-                        if j == i - 1 else self.x0[j]
-        elif method == "random":
-            # Every point except x0 is random.
-            # Rosenbrock with x0 = [1.3, 0.7, 0.8, 1.9, 1.2]: 705 nfev, 431 nit
-            # (average over 1000 iterations)
-            self.x[0] = self.x0
-            rng = np.random.default_rng(seed=seed)
-            for i in range(1, self.N + 1):
-                self.x[i] = rng.uniform(size=self.N)
-        else:
-            raise ValueError(f"invalid simplex generation method "
-                             "'{method}' specified")
-
     def sort(self):
         """
         Sorts the simplex and associated function values in ascending order of
@@ -204,7 +350,7 @@ class Simplex():
         Calculates the centroid. Assumes the function values are already
         sorted.
         """
-        return np.average(self.x[0:self.N], axis=0)
+        return np.mean(self.x[0:self.N], axis=0)
 
     def xworst(self):
         """
@@ -238,27 +384,133 @@ class MaxItersReached(Exception):
     pass
 
 
+class NoiseLevelReached(Exception):
+    pass
+
+
 class EarlyTerminationError(Exception):
+    """
+    Raised by a cost function decorated with deco_cf() when one of the
+    optional stopping criteria is met. The optimisers return the best point
+    evaluated so far, with the exception's message.
+    """
     pass
 
 
-class OutOfBoundsError(Exception):
+class TargetReached(EarlyTerminationError):
+    def __init__(self):
+        super().__init__(MESSAGE_OPT_TARGET_REACHED)
+
+
+class Stagnated(EarlyTerminationError):
+    def __init__(self):
+        super().__init__(MESSAGE_OPT_STAGNATED)
+
+
+class NotAcquiredError(Exception):
+    """
+    Raised by the cost function when no spectrum is acquired for a point.
+    ``value`` is returned to the optimiser in place of a newly measured cost
+    function value (by default infinity).
+    """
+    def __init__(self, value=np.inf):
+        super().__init__(value)
+        self.value = value
+
+
+class OutOfBoundsError(NotAcquiredError):
+    """
+    Raised by the cost function when a point cannot be measured, either
+    because it lies outside the bounds or because it violates the routine's
+    constraints.
+    """
     pass
 
 
+def bound_point(x, lb, ub, method):
+    """
+    Moves a point which lies outside the bounds back inside them.
+
+    Parameters
+    ----------
+    x : ndarray
+        The point.
+    lb : ndarray
+        Lower bounds.
+    ub : ndarray
+        Upper bounds.
+    method : str from {"project", "reflect"} or None
+        "project" clips the point to the bounds. "reflect" reflects it about
+        any bound that it violates (and then clips it, in case it is still
+        outside). If None, the point is returned unchanged.
+
+    Returns
+    -------
+    ndarray
+        The new point.
+    """
+    if method is None:
+        return x
+    elif method == "project":
+        return np.clip(x, lb, ub)
+    elif method == "reflect":
+        x = np.where(x < lb, 2 * lb - x, x)
+        x = np.where(x > ub, 2 * ub - x, x)
+        return np.clip(x, lb, ub)
+    else:
+        raise ValueError(f"Invalid bounds method '{method}' specified.")
+
+
+def round_to_steps(x, steps, lb, ub):
+    """
+    Rounds a point to the nearest point on a lattice, for parameters which can
+    only take discrete values (e.g. loop counters, or parameters with a finite
+    hardware resolution). The lattice consists of the integer multiples of
+    each step which lie within the bounds.
+
+    Parameters
+    ----------
+    x : ndarray
+        The unscaled point.
+    steps : list of (float or None)
+        The step for each parameter. None (or zero) means that the parameter
+        is continuous and is not rounded.
+    lb : ndarray
+        Unscaled lower bounds.
+    ub : ndarray
+        Unscaled upper bounds.
+
+    Returns
+    -------
+    ndarray
+        The rounded point.
+    """
+    x, lb, ub = (np.array(i, dtype=float) for i in (x, lb, ub))
+    steps = np.array([step or 0 for step in steps], dtype=float)
+    d = steps > 0
+    # The small offsets stop bounds which are themselves on the lattice from
+    # being excluded because of floating-point error.
+    k = np.clip(np.round(x[d] / steps[d]),
+                np.ceil(lb[d] / steps[d] - 1e-9),
+                np.floor(ub[d] / steps[d] + 1e-9))
+    # Get rid of floating-point noise such as 48.012499999999996.
+    x[d] = np.round(k * steps[d], 12)
+    return x
+
+
 def deco_count(fn):
     """
     Decorator which counts the number of times a function has been called, as
-    long as the function does not return np.inf. This makes sure that
-    acquire_nmr.calls is not incremented when an out-of-bounds value is
-    "sampled".
+    long as the function does not raise NotAcquiredError. This makes sure
+    that acquire_nmr.calls is not incremented when an out-of-bounds or
+    infeasible value is "sampled", or when a previous value is reused.
     """
     @wraps(fn)
     def counter(*args, **kwargs):
         try:
             result = fn(*args, **kwargs)
-        except OutOfBoundsError:
-            return np.inf  # don't increment calls as experiment was never run
+        except NotAcquiredError as e:
+            return e.value  # don't increment calls as experiment was never run
         else:
             counter.calls += 1
             return result
@@ -266,11 +518,48 @@ def deco_count(fn):
     return counter
 
 
-def deco_cf(maxfev):
+def within_noise(fvals, noise):
+    """
+    Checks whether a set of cost function values are indistinguishable from
+    one another, given the standard deviation of a single evaluation.
+
+    Parameters
+    ----------
+    fvals : ndarray or list
+        Cost function values.
+    noise : float
+        Standard deviation of the cost function. If this is zero (i.e. the
+        noise level is not known), the values are never considered to be
+        within the noise.
+
+    Returns
+    -------
+    bool
+        True if the range of the values is no greater than NOISE_THRESHOLD
+        times the noise level.
+    """
+    if noise <= 0:
+        return False
+    return np.ptp(fvals) <= NOISE_THRESHOLD * noise
+
+
+def deco_cf(maxfev, target=None, stagnation=None):
     """
     Decorator factory which returns a decorator for cost functions. The
     decorator in turn causes the cost function to raise MaxFevalsReached if its
-    number of calls is greater than ``maxfev``.
+    number of calls is greater than ``maxfev``. Only calls made after the
+    decorator is applied are counted, so that the same cost function can be
+    used for several successive optimisations, each with its own limit.
+
+    Optionally, the decorated function also raises TargetReached as soon as a
+    value no greater than ``target`` is measured, and Stagnated once
+    ``stagnation[0]`` successive evaluations have failed to improve on the
+    best value so far by a relative amount of more than ``stagnation[1]``.
+    Only calls which increment the ``calls`` attribute of the cost function
+    (i.e. for POISE, those in which a spectrum was actually acquired) are
+    checked against these criteria. The best point and value seen so far are
+    stored as the ``xbest`` and ``fbest`` attributes of the decorated
+    function, so that they are available even after an exception was raised.
 
     Usage
     =====
@@ -294,19 +583,38 @@ def deco_cf(maxfev):
     decorated function always has a valid 'calls' attribute.
     """
     def decorator(fn):
+        start_calls = fn.calls
+
         @wraps(fn)
-        def decorated_cf(*args, **kwargs):
+        def decorated_cf(x, *args, **kwargs):
             # Check if maximum function evaluations have been reached.
-            if fn.calls >= maxfev:
+            if fn.calls - start_calls >= maxfev:
                 raise MaxFevalsReached
-            # If not, then we can try to run the original function. The
-            # parameters returned are the cost function value, a flag
-            # indicating whether to break, and a message.
-            else:
-                result = fn(*args, **kwargs)
-                decorated_cf.calls = fn.calls
-                return result
+            # If not, then we can try to run the original function.
+            calls = fn.calls
+            result = fn(x, *args, **kwargs)
+            decorated_cf.calls = fn.calls - start_calls
+            fprev = decorated_cf.fbest
+            if result < fprev:
+                decorated_cf.xbest = np.array(x, dtype=float)
+                decorated_cf.fbest = result
+            # Check the other stopping criteria, if a new value was measured.
+            if fn.calls > calls:
+                if target is not None and result <= target:
+                    raise TargetReached
+                if stagnation is not None:
+                    k, rtol = stagnation
+                    if (not np.isfinite(fprev)
+                            or fprev - result > rtol * abs(fprev)):
+                        decorated_cf.stagnant = 0
+                    else:
+                        decorated_cf.stagnant += 1
+                    if decorated_cf.stagnant >= k:
+                        raise Stagnated
+            return result
         decorated_cf.calls = 0
+        decorated_cf.xbest, decorated_cf.fbest = None, np.inf
+        decorated_cf.stagnant = 0
         return decorated_cf
     return decorator
 
@@ -325,7 +633,9 @@ class OptResult:
 
 
 def nelder_mead(cf, x0, xtol, scaled_lb, scaled_ub,
-                args=(), maxfev=0, simplex_method="spendley", seed=None):
+                args=(), maxfev=0, simplex_method="spendley", seed=None,
+                init_step=MAGIC_TOL * 10, noise=0, bounds_method=None,
+                target=None, stagnation=None):
     """
     Nelder-Mead optimiser, as described in Section 8.1 of Kelley, "Iterative
     Methods for Optimization".
@@ -345,8 +655,8 @@ def nelder_mead(cf, x0, xtol, scaled_lb, scaled_ub,
     scaled_lb : ndarray
         Scaled lower bounds for the optimisation.
     scaled_ub : ndarray
-        Scaled upper bounds for the optimisation. This is used to place an
-        upper bound on the simplex size.
+        Scaled upper bounds for the optimisation. The initial simplex is
+        constructed within these bounds.
     args : tuple, optional
         A tuple of arguments to pass to the cost function.
     maxfev : int, optional
@@ -359,6 +669,31 @@ def nelder_mead(cf, x0, xtol, scaled_lb, scaled_ub,
         simplex_method="random". This parameter is passed directly to
         `numpy.random.default_rng()`; the full list of acceptable input is
         documented there.
+    init_step : float, optional
+        Size of the initial simplex (see the *length* parameter of Simplex).
+        Defaults to MAGIC_TOL * 10. Smaller values are useful when x0 is
+        already known to be close to the optimum.
+    noise : float, optional
+        Standard deviation of the cost function. If this is given, the
+        optimisation is also stopped once the simplex has contracted to less
+        than half its initial size and the cost function values at its
+        vertices are within the noise level (see within_noise()). Defaults to
+        0, i.e. convergence is only determined by xtol.
+    bounds_method : str from {"project", "reflect"}, optional
+        How to treat trial points which lie outside the bounds (see
+        bound_point()). If None (the default), points outside the bounds are
+        passed to the cost function as usual, which must then deal with them
+        (for POISE, acquire_nmr() returns infinity without acquiring a
+        spectrum). Note that the initial simplex is always constructed inside
+        the bounds, regardless of this setting.
+
+    target : float, optional
+        Stop the optimisation as soon as a cost function value no greater
+        than this is measured. Defaults to None, i.e. no target.
+    stagnation : tuple of (int, float), optional
+        Stop the optimisation once this many successive evaluations have not
+        improved on the best cost function value by more than the given
+        fraction of it. Defaults to None. See deco_cf() for both of these.
 
     Returns
     -------
@@ -396,14 +731,16 @@ def nelder_mead(cf, x0, xtol, scaled_lb, scaled_ub,
     if maxfev <= 0:
         maxfev = 500 * N
     # Decorate the cost function to raise MaxFevalsReached
-    cf = deco_cf(maxfev)(cf)
+    cf = deco_cf(maxfev, target, stagnation)(cf)
 
     # Check length of xtol
     if len(x0) != len(xtol):
         raise ValueError("Nelder-Mead: x0 and xtol have incompatible lengths")
 
-    # Create and initialise simplex object.
-    sim = Simplex(x0, method=simplex_method, length=MAGIC_TOL * 10, seed=seed)
+    # Create and initialise simplex object. The initial simplex always lies
+    # within the bounds.
+    sim = Simplex(x0, method=simplex_method, length=init_step, seed=seed,
+                  lb=scaled_lb, ub=scaled_ub)
     # Number of iterations. Function evaluations are stored as cf.calls.
     niter = 0
 
@@ -415,9 +752,11 @@ def nelder_mead(cf, x0, xtol, scaled_lb, scaled_ub,
     mu_r = 1       # Reflect parameter
     mu_e = 2       # Expansion parameter
 
-    # Helper function.
+    # Helper function. Shrink steps don't need to be bounded, since they
+    # always stay within the convex hull of the simplex.
     def xnew(mu, sim):
-        return ((1 + mu) * sim.xbar()) - (mu * sim.xworst())
+        x = ((1 + mu) * sim.xbar()) - (mu * sim.xworst())
+        return bound_point(x, scaled_lb, scaled_ub, bounds_method)
 
     def converged(sim, xtol):
         """
@@ -434,6 +773,19 @@ def nelder_mead(cf, x0, xtol, scaled_lb, scaled_ub,
         #
         # return np.max(np.ravel(np.abs(sim[1:] - sim[0]))) <= xtol[0]
 
+    # Size of the initial simplex, used for the noise-level check.
+    init_range = np.amax(sim.x, axis=0) - np.amin(sim.x, axis=0)
+
+    def noise_limited(sim):
+        """
+        Noise-level stopping criterion. The simplex must have contracted, so
+        that a flat region far from the optimum isn't mistaken for
+        convergence.
+        """
+        simplex_range = np.amax(sim.x, axis=0) - np.amin(sim.x, axis=0)
+        return (all(np.less_equal(simplex_range, 0.5 * init_range))
+                and within_noise(sim.f, noise))
+
     # Create temporary list of points evaluated during this iteration (and
     # their corresponding cost function values).
     iter_xs, iter_fs = [], []
@@ -447,6 +799,8 @@ def nelder_mead(cf, x0, xtol, scaled_lb, scaled_ub,
 
         # Main loop.
         while not converged(sim, xtol):
+            if noise_limited(sim):
+                raise NoiseLevelReached
             # Proceed to next iteration.
             niter += 1
             sim.sort()  # for good measure
@@ -525,6 +879,10 @@ def nelder_mead(cf, x0, xtol, scaled_lb, scaled_ub,
         message = MESSAGE_OPT_MAXITER_REACHED
     except MaxFevalsReached:
         message = MESSAGE_OPT_MAXFEV_REACHED
+    except NoiseLevelReached:
+        message = MESSAGE_OPT_NOISE_LIMITED
+    except EarlyTerminationError as e:
+        message = str(e)
     except CostFunctionError as e:
         message = MESSAGE_OPT_PREMATURE_TERMINATION
         if e.message.strip() != "":
@@ -539,6 +897,10 @@ def nelder_mead(cf, x0, xtol, scaled_lb, scaled_ub,
         xbest, fbest = iter_xs[np.argmin(iter_fs)], np.amin(iter_fs)
     else:
         xbest, fbest = sim.x[0], sim.f[0]
+    # When stopped early, the last point evaluated was never returned to the
+    # optimiser, so it may be better than the point found above.
+    if cf.fbest < fbest:
+        xbest, fbest = cf.xbest, cf.fbest
 
     return OptResult(xbest=xbest, fbest=fbest,
                      niter=niter, nfev=cf.calls,
@@ -547,7 +909,9 @@ def nelder_mead(cf, x0, xtol, scaled_lb, scaled_ub,
 
 
 def multid_search(cf, x0, xtol, scaled_lb, scaled_ub,
-                  args=(), maxfev=0, simplex_method="spendley", seed=None):
+                  args=(), maxfev=0, simplex_method="spendley", seed=None,
+                  init_step=MAGIC_TOL * 10, noise=0, bounds_method=None,
+                  target=None, stagnation=None):
     """
     Multidimensional search optimiser, as described in Secion 8.2 of Kelley,
     "Iterative Methods for Optimization".
@@ -567,8 +931,8 @@ def multid_search(cf, x0, xtol, scaled_lb, scaled_ub,
     scaled_lb : ndarray
         Scaled lower bounds for the optimisation.
     scaled_ub : ndarray
-        Scaled upper bounds for the optimisation. This is used to place an
-        upper bound on the simplex size.
+        Scaled upper bounds for the optimisation. The initial simplex is
+        constructed within these bounds.
     args : tuple, optional
         A tuple of arguments to pass to the cost function.
     maxfev : int, optional
@@ -581,6 +945,31 @@ def multid_search(cf, x0, xtol, scaled_lb, scaled_ub,
         simplex_method="random". This parameter is passed directly to
         `numpy.random.default_rng()`; the full list of acceptable input is
         documented there.
+    init_step : float, optional
+        Size of the initial simplex (see the *length* parameter of Simplex).
+        Defaults to MAGIC_TOL * 10. Smaller values are useful when x0 is
+        already known to be close to the optimum.
+    noise : float, optional
+        Standard deviation of the cost function. If this is given, the
+        optimisation is also stopped once the simplex has contracted to less
+        than half its initial size and the cost function values at its
+        vertices are within the noise level (see within_noise()). Defaults to
+        0, i.e. convergence is only determined by xtol.
+    bounds_method : str from {"project", "reflect"}, optional
+        How to treat trial points which lie outside the bounds (see
+        bound_point()). If None (the default), points outside the bounds are
+        passed to the cost function as usual, which must then deal with them
+        (for POISE, acquire_nmr() returns infinity without acquiring a
+        spectrum). Note that the initial simplex is always constructed inside
+        the bounds, regardless of this setting.
+
+    target : float, optional
+        Stop the optimisation as soon as a cost function value no greater
+        than this is measured. Defaults to None, i.e. no target.
+    stagnation : tuple of (int, float), optional
+        Stop the optimisation once this many successive evaluations have not
+        improved on the best cost function value by more than the given
+        fraction of it. Defaults to None. See deco_cf() for both of these.
 
     Returns
     -------
@@ -610,15 +999,17 @@ def multid_search(cf, x0, xtol, scaled_lb, scaled_ub,
     if maxfev <= 0:
         maxfev = 500 * N
     # Decorate cost function so that it handles MaxFevalsReached
-    cf = deco_cf(maxfev)(cf)
+    cf = deco_cf(maxfev, target, stagnation)(cf)
 
     # Check length of xtol
     if len(x0) != len(xtol):
         raise ValueError("Multidimensional search: x0 and xtol have "
                          "incompatible lengths")
 
-    # Create and initialise simplex object.
-    sim = Simplex(x0, method=simplex_method, length=MAGIC_TOL * 10, seed=seed)
+    # Create and initialise simplex object. The initial simplex always lies
+    # within the bounds.
+    sim = Simplex(x0, method=simplex_method, length=init_step, seed=seed,
+                  lb=scaled_lb, ub=scaled_ub)
     # Number of iterations. Function evaluations are stored as cf.calls.
     niter = 0
 
@@ -641,6 +1032,19 @@ def multid_search(cf, x0, xtol, scaled_lb, scaled_ub,
         #
         # return np.max(np.ravel(np.abs(sim[1:] - sim[0]))) <= xtol[0]
 
+    # Size of the initial simplex, used for the noise-level check.
+    init_range = np.amax(sim.x, axis=0) - np.amin(sim.x, axis=0)
+
+    def noise_limited(sim):
+        """
+        Noise-level stopping criterion. The simplex must have contracted, so
+        that a flat region far from the optimum isn't mistaken for
+        convergence.
+        """
+        simplex_range = np.amax(sim.x, axis=0) - np.amin(sim.x, axis=0)
+        return (all(np.less_equal(simplex_range, 0.5 * init_range))
+                and within_noise(sim.f, noise))
+
     # Create temporary list of points evaluated during this iteration (and
     # their corresponding cost function values).
     iter_xs, iter_fs = [], []
@@ -655,6 +1059,8 @@ def multid_search(cf, x0, xtol, scaled_lb, scaled_ub,
 
         # Main loop.
         while not converged(sim, xtol):
+            if noise_limited(sim):
+                raise NoiseLevelReached
             niter += 1
             sim.sort()  # for good measure
 
@@ -669,7 +1075,8 @@ def multid_search(cf, x0, xtol, scaled_lb, scaled_ub,
             r_j = np.zeros((N, N))
             f_r_j = np.zeros(N)
             for j in range(1, N + 1):
-                r_j[j - 1] = sim.x[0] - (sim.x[j] - sim.x[0])
+                r_j[j - 1] = bound_point(sim.x[0] - (sim.x[j] - sim.x[0]),
+                                         scaled_lb, scaled_ub, bounds_method)
                 iter_xs.append(r_j[j - 1])
                 f_r_j[j - 1] = cf(r_j[j - 1], *args)
                 iter_fs.append(f_r_j[j - 1])
@@ -679,7 +1086,9 @@ def multid_search(cf, x0, xtol, scaled_lb, scaled_ub,
                 e_j = np.zeros((N, N))
                 f_e_j = np.zeros(N)
                 for j in range(1, N + 1):
-                    e_j[j - 1] = sim.x[0] - mu_e * (sim.x[j] - sim.x[0])
+                    e_j[j - 1] = bound_point(
+                        sim.x[0] - mu_e * (sim.x[j] - sim.x[0]),
+                        scaled_lb, scaled_ub, bounds_method)
                     iter_xs.append(e_j[j - 1])
                     f_e_j[j - 1] = cf(e_j[j - 1], *args)
                     iter_fs.append(f_e_j[j - 1])
@@ -707,6 +1116,10 @@ def multid_search(cf, x0, xtol, scaled_lb, scaled_ub,
         message = MESSAGE_OPT_MAXITER_REACHED
     except MaxFevalsReached:
         message = MESSAGE_OPT_MAXFEV_REACHED
+    except NoiseLevelReached:
+        message = MESSAGE_OPT_NOISE_LIMITED
+    except EarlyTerminationError as e:
+        message = str(e)
     except CostFunctionError as e:
         message = MESSAGE_OPT_PREMATURE_TERMINATION
         if e.message.strip() != "":
@@ -721,6 +1134,10 @@ def multid_search(cf, x0, xtol, scaled_lb, scaled_ub,
         xbest, fbest = iter_xs[np.argmin(iter_fs)], np.amin(iter_fs)
     else:
         xbest, fbest = sim.x[0], sim.f[0]
+    # When stopped early, the last point evaluated was never returned to the
+    # optimiser, so it may be better than the point found above.
+    if cf.fbest < fbest:
+        xbest, fbest = cf.xbest, cf.fbest
 
     return OptResult(xbest=xbest, fbest=fbest,
                      niter=niter, nfev=cf.calls,
@@ -728,8 +1145,366 @@ def multid_search(cf, x0, xtol, scaled_lb, scaled_ub,
                      message=message)
 
 
+def brent(cf, x0, xtol, scaled_lb, scaled_ub, args=(), maxfev=0,
+          init_step=MAGIC_TOL * 10, noise=0, target=None, stagnation=None):
+    """
+    Bracketed one-dimensional optimiser using Brent's method, i.e.
+    golden-section search accelerated by parabolic interpolation. See Chapter
+    5 of Brent, "Algorithms for Minimization without Derivatives", or Section
+    10.3 of Numerical Recipes.
+
+    The minimum is first bracketed by walking downhill from x0 (in steps which
+    grow by the golden ratio, and never leaving the bounds), after which the
+    bracket is successively narrowed until it is no wider than xtol. Because
+    the bracket can only ever shrink, the optimisation always terminates.
+    This does not make it any less sensitive to noise, though: a noisy value
+    can still cause the wrong part of the bracket to be discarded.
+
+    Parameters
+    ----------
+    cf : function
+        The cost function. For POISE, this means acquire_nmr(), not the
+        user-defined cost function. However in general, this can be any cost
+        function. The cost function *must* be decorated with deco_count() (for
+        POISE, this is already done).
+    x0 : ndarray or list
+        Initial point for optimisation. This should already be scaled, and
+        must only have one element.
+    xtol : ndarray or list
+        Tolerance for the optimisation. This should already be scaled.
+    scaled_lb : ndarray
+        Scaled lower bound for the optimisation.
+    scaled_ub : ndarray
+        Scaled upper bound for the optimisation.
+    args : tuple, optional
+        A tuple of arguments to pass to the cost function.
+    maxfev : int, optional
+        Maximum function evaluations to use. Defaults to 500.
+    init_step : float, optional
+        Size of the first step taken from x0 when bracketing the minimum.
+        Defaults to MAGIC_TOL * 10.
+    noise : float, optional
+        Standard deviation of the cost function. If this is given, the
+        optimisation is also stopped once the bracket has shrunk to less than
+        half its initial width and the cost function values at the three
+        best points are within the noise level (see within_noise()).
+        Defaults to 0, i.e. convergence is only determined by xtol.
+
+    target : float, optional
+        Stop the optimisation as soon as a cost function value no greater
+        than this is measured. Defaults to None, i.e. no target.
+    stagnation : tuple of (int, float), optional
+        Stop the optimisation once this many successive evaluations have not
+        improved on the best cost function value by more than the given
+        fraction of it. Defaults to None. See deco_cf() for both of these.
+
+    Returns
+    -------
+    OptResult
+        Object which contains the following attributes:
+            xbest (ndarray)   : Optimal values for the optimisation.
+            fbest (float)     : Cost function at the optimum.
+            niter (int)       : Number of iterations (after the minimum has
+                                been bracketed).
+            nfev (int)        : Number of function evaluations.
+            message (str)     : Message indicating reason for termination.
+    """
+    # Convert x0 to vector
+    x0 = np.asfarray(x0).flatten()
+    xtol = np.asfarray(xtol).flatten()
+    if x0.size != 1 or xtol.size != 1:
+        raise ValueError("Brent: only one-dimensional problems can be"
+                         " optimised")
+
+    maxiter = 500
+    if maxfev <= 0:
+        maxfev = 500
+    # Decorate the cost function to raise MaxFevalsReached
+    cf = deco_cf(maxfev, target, stagnation)(cf)
+
+    lb = float(np.ravel(scaled_lb)[0])
+    ub = float(np.ravel(scaled_ub)[0])
+    # Smallest distance between two sampled points. The final bracket is at
+    # most 4 * tol1 wide, i.e. no wider than xtol.
+    tol1 = xtol[0] / 4
+    tol2 = 2 * tol1
+    golden = (1 + np.sqrt(5)) / 2     # bracket expansion ratio
+    cgold = (3 - np.sqrt(5)) / 2      # golden section ratio
+    niter = 0
+
+    # Keep track of every point evaluated, so that the best one can be
+    # returned even if the optimisation is interrupted.
+    all_xs, all_fs = [], []
+
+    def f(x):
+        fx = cf(np.array([x]), *args)
+        all_xs.append(x)
+        all_fs.append(fx)
+        return fx
+
+    try:
+        # Bracket the minimum. Walk downhill from x0 until the cost function
+        # starts increasing again, or until the bound is hit.
+        a = x0[0]
+        fa = f(a)
+        b = min(a + init_step, ub)
+        if b - a < tol1:   # x0 is (almost) at the upper bound
+            b = max(a - init_step, lb)
+        fb = f(b)
+        if fb > fa:        # make sure that a -> b is downhill
+            a, b, fa, fb = b, a, fb, fa
+        while True:
+            c = min(max(b + golden * (b - a), lb), ub)
+            if abs(c - b) < tol1:   # b is at the bound
+                c, fc = a, fa
+                break
+            fc = f(c)
+            if fc >= fb:
+                break
+            a, b, fa, fb = b, c, fb, fc
+
+        # Brent's method. lo and hi delimit the bracket; x is the best point
+        # found so far, w the second best, and v the previous value of w.
+        lo, hi = min(a, b, c), max(a, b, c)
+        x, fx = b, fb
+        if fa <= fc:
+            w, fw, v, fv = a, fa, c, fc
+        else:
+            w, fw, v, fv = c, fc, a, fa
+        d, e = 0, hi - lo
+        init_width = hi - lo
+        while True:
+            xm = 0.5 * (lo + hi)
+            if abs(x - xm) <= tol2 - 0.5 * (hi - lo):
+                break
+            if hi - lo <= 0.5 * init_width and within_noise([fx, fw, fv],
+                                                            noise):
+                raise NoiseLevelReached
+            niter += 1
+            if niter >= maxiter:
+                raise MaxItersReached
+            # Try a parabolic step through x, w, and v.
+            parabolic = False
+            if abs(e) > tol1:
+                r = (x - w) * (fx - fv)
+                q = (x - v) * (fx - fw)
+                p = (x - v) * q - (x - w) * r
+                q = 2 * (q - r)
+                if q > 0:
+                    p = -p
+                q = abs(q)
+                etemp, e = e, d
+                # Only accept the step if it is smaller than half the step
+                # before last, and falls inside the bracket.
+                if (abs(p) < abs(0.5 * q * etemp)
+                        and q * (lo - x) < p < q * (hi - x)):
+                    parabolic = True
+                    d = p / q
+                    u = x + d
+                    # Don't evaluate too close to the edges of the bracket.
+                    if u - lo < tol2 or hi - u < tol2:
+                        d = tol1 if xm >= x else -tol1
+            # Otherwise, take a golden section step into the larger segment.
+            if not parabolic:
+                e = (lo - x) if x >= xm else (hi - x)
+                d = cgold * e
+            # Don't evaluate too close to x.
+            if abs(d) >= tol1:
+                u = x + d
+            else:
+                u = x + (tol1 if d > 0 else -tol1)
+            fu = f(u)
+            # Update the bracket and the three points.
+            if fu <= fx:
+                if u >= x:
+                    lo = x
+                else:
+                    hi = x
+                v, fv, w, fw, x, fx = w, fw, x, fx, u, fu
+            else:
+                if u < x:
+                    lo = u
+                else:
+                    hi = u
+                if fu <= fw or w == x:
+                    v, fv, w, fw = w, fw, u, fu
+                elif fu <= fv or v == x or v == w:
+                    v, fv = u, fu
+    except MaxItersReached:
+        message = MESSAGE_OPT_MAXITER_REACHED
+    except MaxFevalsReached:
+        message = MESSAGE_OPT_MAXFEV_REACHED
+    except NoiseLevelReached:
+        message = MESSAGE_OPT_NOISE_LIMITED
+    except EarlyTerminationError as e:
+        message = str(e)
+    except CostFunctionError as e:
+        message = MESSAGE_OPT_PREMATURE_TERMINATION
+        if e.message.strip() != "":
+            message += ("\nReason: " + e.message)
+    else:
+        message = MESSAGE_OPT_SUCCESS
+
+    if len(all_fs) != 0:
+        ibest = np.argmin(all_fs)
+        xbest, fbest = np.array([all_xs[ibest]]), all_fs[ibest]
+    else:
+        xbest, fbest = x0, np.inf
+    # When stopped early, the last point evaluated was never returned to the
+    # optimiser, so it may be better than the point found above.
+    if cf.fbest < fbest:
+        xbest, fbest = cf.xbest, cf.fbest
+
+    return OptResult(xbest=xbest, fbest=fbest,
+                     niter=niter, nfev=cf.calls,
+                     message=message)
+
+
+def compass_search(cf, x0, xtol, scaled_lb, scaled_ub, args=(), maxfev=0,
+                   init_step=MAGIC_TOL * 10, noise=0, steps=None,
+                   target=None, stagnation=None):
+    """
+    Compass search (also known as coordinate search), as described in
+    Section 3.1 of Kolda, Lewis and Torczon, "Optimization by Direct Search:
+    New Perspectives on Some Classical and Modern Methods", SIAM Rev. 2003,
+    45, 385.
+
+    In each iteration, the points one step away from the best point along
+    each coordinate are evaluated in turn, and the search moves to the first
+    one which is better (after which the step in that coordinate is doubled).
+    If none of them is better, all the steps are halved. Because every trial
+    point differs from the best point in only one parameter, the steps of
+    discrete parameters can be kept on their lattice: they are never made
+    smaller than the lattice spacing, so the search only converges once none
+    of the neighbouring lattice points is better. The simplex methods and
+    BOBYQA cannot guarantee this, because rounding to the lattice creates
+    plateaus on which they can appear to converge.
+
+    Parameters
+    ----------
+    cf : function
+        The cost function. For POISE, this means acquire_nmr(), not the
+        user-defined cost function. However in general, this can be any cost
+        function. The cost function *must* be decorated with deco_count() (for
+        POISE, this is already done).
+    x0 : ndarray or list
+        Initial point for optimisation. This should already be scaled.
+    xtol : ndarray or list
+        Tolerances for each optimisation dimension. This should already be
+        scaled.
+    scaled_lb : ndarray
+        Scaled lower bounds for the optimisation.
+    scaled_ub : ndarray
+        Scaled upper bounds for the optimisation. Trial points are never
+        outside the bounds.
+    args : tuple, optional
+        A tuple of arguments to pass to the cost function.
+    maxfev : int, optional
+        Maximum function evaluations to use. Defaults to 500 times the number
+        of parameters.
+    init_step : float, optional
+        Initial step in each parameter. Defaults to MAGIC_TOL * 10.
+    noise : float, optional
+        Standard deviation of the cost function. If this is given, a trial
+        point is only accepted if it is significantly better than the best
+        point, i.e. if the values differ by more than NOISE_THRESHOLD times
+        the noise. Defaults to 0.
+    steps : ndarray, optional
+        The scaled lattice spacing of each parameter. Zero means that the
+        parameter is continuous, in which case its steps are halved until
+        they are no larger than its tolerance. Defaults to None, i.e. all
+        parameters are continuous.
+
+    target : float, optional
+        Stop the optimisation as soon as a cost function value no greater
+        than this is measured. Defaults to None, i.e. no target.
+    stagnation : tuple of (int, float), optional
+        Stop the optimisation once this many successive evaluations have not
+        improved on the best cost function value by more than the given
+        fraction of it. Defaults to None. See deco_cf() for both of these.
+
+    Returns
+    -------
+    OptResult
+        Object which contains the following attributes:
+            xbest (ndarray)   : Optimal values for the optimisation.
+            fbest (float)     : Cost function at the optimum.
+            niter (int)       : Number of iterations.
+            nfev (int)        : Number of function evaluations.
+            message (str)     : Message indicating reason for termination.
+    """
+    # Convert x0 to vector
+    x0 = np.asfarray(x0).flatten()
+    xtol = np.asfarray(xtol).flatten()
+    N = x0.size
+    if len(x0) != len(xtol):
+        raise ValueError("Compass search: x0 and xtol have incompatible"
+                         " lengths")
+
+    maxiter = 500 * N
+    if maxfev <= 0:
+        maxfev = 500 * N
+    # Decorate the cost function to raise MaxFevalsReached
+    cf = deco_cf(maxfev, target, stagnation)(cf)
+
+    # Smallest step in each parameter.
+    steps = np.zeros(N) if steps is None else np.asfarray(steps).flatten()
+    min_step = np.where(steps > 0, steps, xtol)
+    step = np.maximum(init_step, min_step)
+    threshold = NOISE_THRESHOLD * noise
+    niter = 0
+    xbest, fbest = x0, np.inf
+
+    try:
+        fbest = cf(x0, *args)
+        while True:
+            niter += 1
+            if niter > maxiter:
+                raise MaxItersReached
+            improved = False
+            for i in range(N):
+                for sign in [1, -1]:
+                    x = xbest.copy()
+                    x[i] = np.clip(x[i] + sign * step[i],
+                                   scaled_lb[i], scaled_ub[i])
+                    if x[i] == xbest[i]:
+                        continue
+                    fx = cf(x, *args)
+                    if fx < fbest - threshold:
+                        xbest, fbest = x, fx
+                        step[i] *= 2
+                        improved = True
+                        break
+            if not improved:
+                if np.all(step <= min_step):
+                    break
+                step = np.maximum(step / 2, min_step)
+    except MaxItersReached:
+        message = MESSAGE_OPT_MAXITER_REACHED
+    except MaxFevalsReached:
+        message = MESSAGE_OPT_MAXFEV_REACHED
+    except EarlyTerminationError as e:
+        message = str(e)
+    except CostFunctionError as e:
+        message = MESSAGE_OPT_PREMATURE_TERMINATION
+        if e.message.strip() != "":
+            message += ("\nReason: " + e.message)
+    else:
+        message = MESSAGE_OPT_SUCCESS
+
+    # When stopped early, the last point evaluated was never returned to the
+    # optimiser, so it may be better than the point found above.
+    if cf.fbest < fbest:
+        xbest, fbest = cf.xbest, cf.fbest
+
+    return OptResult(xbest=xbest, fbest=fbest,
+                     niter=niter, nfev=cf.calls,
+                     message=message)
+
+
 def pybobyqa_interface(cf, x0, xtol, scaled_lb, scaled_ub,
-                       args=(), maxfev=0):
+                       args=(), maxfev=0, init_step=MAGIC_TOL * 10, noise=0,
+                       target=None, stagnation=None):
     """
     Interface to pybobyqa.solve() which takes similar arguments to the other
     two optimisation functions and returns an OptResult object.
@@ -755,6 +1530,21 @@ def pybobyqa_interface(cf, x0, xtol, scaled_lb, scaled_ub,
     scaled_ub : ndarray, optional
         Scaled upper bounds for the optimisation. This is used to place an
         upper bound on the simplex size.
+    init_step : float, optional
+        Initial trust region radius (``rhobeg``). Defaults to MAGIC_TOL * 10.
+    noise : float, optional
+        Standard deviation of the cost function. If this is given, it is
+        passed to Py-BOBYQA as the additive noise level (multiplied by
+        NOISE_THRESHOLD), so that the optimisation stops once all
+        interpolation points are within the noise level. Defaults to 0.
+
+    target : float, optional
+        Stop the optimisation as soon as a cost function value no greater
+        than this is measured. Defaults to None, i.e. no target.
+    stagnation : tuple of (int, float), optional
+        Stop the optimisation once this many successive evaluations have not
+        improved on the best cost function value by more than the given
+        fraction of it. Defaults to None. See deco_cf() for both of these.
 
     Returns
     -------
@@ -780,13 +1570,28 @@ def pybobyqa_interface(cf, x0, xtol, scaled_lb, scaled_ub,
     # Run the optimisation, using PyBOBYQA's bounds keyword arguments.
     bounds = (scaled_lb, scaled_ub)
     min_ub = np.min(scaled_ub)
+    user_params = {'restarts.use_restarts': False}
+    if noise > 0:
+        user_params['noise.additive_noise_level'] = NOISE_THRESHOLD * noise
+    # Py-BOBYQA has no way of stopping at a target value or when progress
+    # stalls, so these are checked by the cost function, which then aborts
+    # Py-BOBYQA by raising an exception.
+    if target is not None or stagnation is not None:
+        if not hasattr(cf, "calls"):
+            cf = deco_count(cf)
+        cf = deco_cf(maxfev, target, stagnation)(cf)
     try:
         pb_sol = pb.solve(cf, x0, args=args,
-                          rhobeg=min(MAGIC_TOL * 10, min_ub * 0.499),
+                          rhobeg=min(init_step, min_ub * 0.499),
                           rhoend=MAGIC_TOL,
                           maxfun=maxfev,
                           bounds=bounds, objfun_has_noise=True,
-                          user_params={'restarts.use_restarts': False})
+                          user_params=user_params)
+    except EarlyTerminationError as e:
+        # The best point is stored by the cost function.
+        return OptResult(xbest=cf.xbest, fbest=cf.fbest,
+                         niter=0, nfev=cf.calls,
+                         message=str(e))
     except CostFunctionError as e:
         # If we run into a CFError, we need to turn on this flag, because
         # pb_sol won't be a valid object.
@@ -818,7 +1623,10 @@ def pybobyqa_interface(cf, x0, xtol, scaled_lb, scaled_ub,
         # We just need to coerce the returned information into our OptResult
         # format, so that the backend sees a unified interface for all
         # optimisers.  Note that niter is not applicable to PyBOBYQA.
-        if pb_sol.flag == pb_sol.EXIT_SUCCESS:
+        if (pb_sol.flag == pb_sol.EXIT_SUCCESS
+                and "noise level" in pb_sol.msg):
+            msg = MESSAGE_OPT_NOISE_LIMITED
+        elif pb_sol.flag == pb_sol.EXIT_SUCCESS:
             msg = MESSAGE_OPT_SUCCESS
         elif pb_sol.flag == pb_sol.EXIT_MAXFUN_WARNING:
             msg = MESSAGE_OPT_MAXFEV_REACHED
@@ -832,3 +1640,109 @@ def pybobyqa_interface(cf, x0, xtol, scaled_lb, scaled_ub,
     return OptResult(xbest=xbest, fbest=fbest,
                      niter=0, nfev=nfev,
                      message=msg)
+
+
+def fit_quadratic(xvals, fvals, noise=0):
+    """
+    Fits a local quadratic model to the points nearest to the best point
+    evaluated so far, using weighted least squares, and finds the minimum of
+    the model. No further evaluations are carried out.
+
+    The model is fitted to the 2p points closest to the best point (or all of
+    them, if there are fewer), where p = (n + 1)(n + 2)/2 is the number of
+    coefficients in a quadratic in n dimensions. Points are weighted using a
+    tricube function of their distance from the best point, so that the
+    points furthest away have the least influence.
+
+    Parameters
+    ----------
+    xvals : ndarray
+        The scaled points, with shape (m, n). Scaling by tolerances is
+        recommended, so that distances along all parameters are comparable.
+    fvals : ndarray
+        The cost function values at these points. Non-finite values (e.g. from
+        points which violated constraints) are ignored.
+    noise : float, optional
+        The standard deviation of the cost function. If this is zero (i.e.
+        not known), it is estimated from the residuals of the fit instead.
+
+    Returns
+    -------
+    OptResult
+        Has attributes ``xbest`` (the minimum of the model), ``fbest`` (the
+        value of the model there), ``ci`` (the half-widths of the 95%
+        confidence intervals of each component of ``xbest``), and ``npts``
+        (the number of points used in the fit). The confidence intervals are
+        ``nan`` if they could not be estimated.
+
+    Raises
+    ------
+    ValueError
+        If there are too few points, the points do not determine a quadratic,
+        or the model does not have a minimum close to the points.
+    """
+    xvals = np.asarray(xvals, dtype=float)
+    fvals = np.asarray(fvals, dtype=float)
+    finite = np.isfinite(fvals)
+    xvals, fvals = xvals[finite], fvals[finite]
+    m, n = xvals.shape
+    p = (n + 1) * (n + 2) // 2
+    if m <= p:
+        raise ValueError(f"at least {p + 1} points are needed, but only {m}"
+                         " were evaluated")
+
+    # Take the points closest to the best one.
+    xb = xvals[np.argmin(fvals)]
+    dist = np.linalg.norm(xvals - xb, axis=1)
+    nearest = np.argsort(dist, kind="stable")[:min(m, 2 * p)]
+    dx, f, dist = xvals[nearest] - xb, fvals[nearest], dist[nearest]
+    dmax = np.max(dist) * 1.1
+    if dmax == 0:
+        raise ValueError("all points coincide")
+    weights = (1 - (dist / dmax) ** 3) ** 3
+
+    # Design matrix for f = c + g.dx + 0.5 dx.H.dx. The upper triangle of H
+    # is stored row by row after c and g.
+    iu = np.triu_indices(n)
+    diag = iu[0] == iu[1]
+    cross = dx[:, iu[0]] * dx[:, iu[1]]
+    cross[:, diag] *= 0.5
+    A = np.hstack([np.ones((len(f), 1)), dx, cross])
+    sw = np.sqrt(weights)
+    coeffs, _, rank, _ = np.linalg.lstsq(A * sw[:, None], f * sw, rcond=None)
+    if rank < p:
+        raise ValueError("the points do not determine a quadratic")
+
+    def model_minimum(coeffs):
+        g = coeffs[1:n + 1]
+        H = np.zeros((n, n))
+        H[iu] = coeffs[n + 1:]
+        H = H + np.triu(H, 1).T
+        return g, H, -np.linalg.solve(H, g)
+
+    g, H, step = model_minimum(coeffs)
+    if np.any(np.linalg.eigvalsh(H) <= 0):
+        raise ValueError("the fitted quadratic has no minimum")
+    if np.linalg.norm(step) > dmax:
+        raise ValueError("the minimum of the fitted quadratic lies outside"
+                         " the region which was sampled")
+    fbest = coeffs[0] + g @ step + 0.5 * step @ H @ step
+
+    # Propagate the uncertainty in the coefficients to the minimum, using a
+    # numerical Jacobian of the minimum with respect to the coefficients.
+    dof = len(f) - p
+    resid = f - A @ coeffs
+    var = noise ** 2 if noise > 0 else np.sum(weights * resid ** 2) / dof
+    try:
+        cov = var * np.linalg.inv((A.T * weights) @ A)
+        jac = np.zeros((n, p))
+        for j in range(p):
+            h = 1e-6 * max(1, abs(coeffs[j]))
+            c = coeffs.copy()
+            c[j] += h
+            jac[:, j] = (model_minimum(c)[2] - step) / h
+        ci = 1.96 * np.sqrt(np.diag(jac @ cov @ jac.T))
+    except np.linalg.LinAlgError:
+        ci = np.full(n, np.nan)
+
+    return OptResult(xbest=xb + step, fbest=fbest, ci=ci, npts=len(f))
@@ -0,0 +1,236 @@
+"""
+server.py
+---------
+
+Backend daemon, which stays running between optimisations so that the
+frontend does not have to start a new Python process (and import numpy, scipy
+and Py-BOBYQA) for every run. It is started by the frontend when ``poise`` is
+run with ``--daemon``, and stopped with ``poise --kill``, or once it has been
+idle for some time.
+
+The daemon listens on a local TCP socket, and records the port in its
+'.pid<PID>' file, together with a random token. The file can only be read by
+the user who started the daemon, and the token must be the first line sent
+on every connection; otherwise, any user on the same computer could use the
+daemon to run AU programmes and write to datasets. The second line sent by
+the frontend is a command: ``run`` starts an optimisation, which then uses
+the same protocol as the backend subprocess does on stdin and stdout;
+``cfs`` returns the available cost functions in the format printed by
+get_cfs.py.
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+import io
+import sys
+import json
+import hmac
+import secrets
+import argparse
+import threading
+import importlib
+from time import monotonic, sleep
+from pathlib import Path
+from contextlib import contextmanager
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+
+# Enable relative imports when invoked directly as __main__ by TopSpin (see
+# backend.py).
+if __name__ == "__main__" and __package__ is None:
+    __package__ = "poise_backend"
+    sys.path.insert(1, str(Path(__file__).parents[1].resolve()))
+    __import__(__package__)
+
+from . import backend
+from . import costfunctions
+from . import costfunctions_user
+from .shared import _g, new_state
+from .get_cfs import get_all_cfs
+
+# The daemon only accepts connections from the same machine.
+HOST = "127.0.0.1"
+# Time (in seconds) after which an idle daemon exits.
+DEFAULT_IDLE = 3600
+
+
+class ThreadLocalStream():
+    """
+    Stand-in for sys.stdin or sys.stdout, which forwards everything to the
+    stream set for the current thread (using redirect()), or to the original
+    stream if none has been set.
+    """
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._local, "stream", self._default), name)
+
+    @contextmanager
+    def redirect(self, stream):
+        self._local.stream = stream
+        try:
+            yield
+        finally:
+            del self._local.stream
+
+
+_stdio_lock = threading.Lock()
+
+
+@contextmanager
+def redirect_stdio(stdin, stdout):
+    """
+    Context manager which redirects sys.stdin and sys.stdout to the given
+    streams in the current thread only. The backend talks to the frontend
+    using input() and print(), so this lets each thread talk to its own
+    frontend.
+
+    The first call replaces sys.stdin and sys.stdout for the whole process,
+    with ThreadLocalStreams that forward to the original streams in every
+    thread which has not been redirected, so that nothing else is affected.
+    """
+    with _stdio_lock:
+        for name in ["stdin", "stdout"]:
+            if not isinstance(getattr(sys, name), ThreadLocalStream):
+                setattr(sys, name, ThreadLocalStream(getattr(sys, name)))
+        real_stdin, real_stdout = sys.stdin, sys.stdout
+    with real_stdin.redirect(stdin), real_stdout.redirect(stdout):
+        yield
+
+
+class FrontendHandler(StreamRequestHandler):
+    """
+    Handles one connection from the frontend.
+    """
+    def handle(self):
+        rfile = io.TextIOWrapper(self.rfile, encoding="utf-8")
+        wfile = io.TextIOWrapper(self.wfile, encoding="utf-8",
+                                 line_buffering=True)
+        with self.server.busy():
+            try:
+                token = rfile.readline().strip()
+                if not hmac.compare_digest(token, self.server.token):
+                    print("Invalid token", file=wfile)
+                    return
+                command = rfile.readline().strip()
+                if command == "run":
+                    with redirect_stdio(rfile, wfile), new_state():
+                        _g.stale_modules = self.server.reload_costfunctions()
+                        backend.run_session()
+                elif command == "cfs":
+                    print(json.dumps(get_all_cfs()), file=wfile)
+                else:
+                    print(f"Invalid command: '{command}'", file=wfile)
+                wfile.flush()
+            except ConnectionError:
+                # The frontend went away, e.g. because it was killed. There is
+                # nobody to report this to.
+                pass
+
+
+class PoiseServer(ThreadingTCPServer):
+    """
+    Server which runs each connection in a separate thread. Each optimisation
+    gets its own State (see shared.py), so several can be run at once.
+
+    Parameters
+    ----------
+    port : int, optional
+        The port to listen on. By default, a free port is chosen.
+    token : str, optional
+        The token which clients have to send before their command. By
+        default, a random one is generated.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, token=None):
+        super().__init__((HOST, port), FrontendHandler)
+        self.token = token or secrets.token_hex(16)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.last_active = monotonic()
+        self.mtimes = {module: Path(module.__file__).stat().st_mtime
+                       for module in [costfunctions, costfunctions_user]}
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @contextmanager
+    def busy(self):
+        """
+        Context manager which marks the server as active.
+        """
+        with self.lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.last_active = monotonic()
+
+    def idle_time(self):
+        """
+        Returns the time (in seconds) since the last connection was closed,
+        or zero if a connection is open.
+        """
+        with self.lock:
+            return 0 if self.active else monotonic() - self.last_active
+
+    def reload_costfunctions(self):
+        """
+        Reloads the cost function modules if they have been modified since
+        they were last loaded, so that changes take effect without restarting
+        the daemon. (Changes to any other files do need a restart.)
+
+        Modules are only reloaded if no other connection is open, since an
+        optimisation which is already running would otherwise end up using a
+        mixture of the old and new module.
+
+        Returns
+        -------
+        list of str
+            The names of the modified modules which were not reloaded.
+        """
+        stale = []
+        with self.lock:
+            for module, mtime in self.mtimes.items():
+                new_mtime = Path(module.__file__).stat().st_mtime
+                if new_mtime == mtime:
+                    continue
+                if self.active > 1:
+                    stale.append(module.__name__)
+                else:
+                    importlib.reload(module)
+                    self.mtimes[module] = new_mtime
+        return stale
+
+
+def main():
+    """
+    Runs the daemon until it has been idle for the time given by ``--idle``.
+    """
+    parser = argparse.ArgumentParser(description="POISE backend daemon.")
+    parser.add_argument("--port", type=int, default=0,
+                        help="Port to listen on. (default: any free port)")
+    parser.add_argument("--idle", type=float, default=DEFAULT_IDLE,
+                        help=("Exit after this many seconds without any"
+                              " connections. Use 0 to never exit."
+                              f" (default: {DEFAULT_IDLE})"))
+    args = parser.parse_args()
+
+    with PoiseServer(args.port) as server:
+        pid_text = f"daemon {HOST} {server.port} {server.token}"
+        with backend.pidfile(pid_text) as _:
+            thread = threading.Thread(target=server.serve_forever,
+                                      daemon=True)
+            thread.start()
+            while args.idle <= 0 or server.idle_time() < args.idle:
+                sleep(1)
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,35 @@
 shared.py
 ---------
 
-Stores the _g class which holds global variables (to track the state of the
+Stores the _g object which holds global variables (to track the state of the
 optimisation).
 
+Each optimisation has its own State, and _g refers to the State of the
+optimisation running in the current thread. Normally there is only one, but
+the backend daemon (server.py) runs each optimisation in a separate thread.
+
 SPDX-License-Identifier: GPL-3.0-or-later
 """
 
+import threading
 from pathlib import Path
+from contextlib import contextmanager
 
 import numpy as np
 
 
-class _g():
+class State():
     """
-    Class to store the "global" variables.
+    Class to store the "global" variables of one optimisation. These are
+    accessed through ``_g``, which forwards everything to the State of the
+    optimisation running in the current thread.
 
     Attributes
     ----------
-    optimiser : str from {'nm', 'mds', 'bobyqa'}
-        The optimiser being used.
+    optimiser : str from {'nm', 'mds', 'bobyqa', 'brent', 'auto'}
+        The optimiser being used. ``'auto'`` is replaced by the optimiser
+        chosen by backend.choose_optimiser() (which is ``'brent'`` for
+        routines with only one parameter) once the noise level is known.
 
     routine_id : str
         The name of the routine being used.
@@ -40,9 +50,94 @@ class _g():
         be zero, indicating no limit (beyond the hard limit of 500 times the
         number of parameters).
 
+    maxtime : float
+        The time budget for the optimisation, in seconds. Zero means no
+        limit.
+
+    t_start : datetime.datetime
+        The time at which the optimisation started.
+
+    eval_times : list of tuple
+        For each spectrum acquired so far, a tuple of the fidelity it was
+        acquired at (see ``fidelity``) and the time it took to acquire and
+        process (in seconds).
+
+    warm : bool
+        Whether to warm-start the optimisation from the optimum of the most
+        recent completed run of the same routine.
+
+    noise_reps : int
+        The number of replicate spectra to acquire at the initial point in
+        order to estimate the noise level. Zero (or one) means that the noise
+        level is not estimated.
+
+    noise : float
+        The estimated standard deviation of the cost function. Zero if it has
+        not been estimated.
+
+    explore : dict
+        Acquisition parameters to override during the exploratory stage of a
+        multi-fidelity optimisation, e.g. ``{"NS": "1"}``. Empty if
+        multi-fidelity mode is not being used.
+
+    fidelity : dict
+        Acquisition parameters overridden for the spectrum currently being
+        acquired. Empty for full-fidelity spectra.
+
+    fidelities : list of dict
+        The value of ``fidelity`` for each point in ``xvals``.
+
+    resume : bool
+        Whether to resume an interrupted optimisation from its checkpoint.
+
+    p_checkpoint : |Path|
+        The path to the current checkpoint file.
+
+    checkpoint_settings : dict
+        The settings of the current optimisation, which are stored in the
+        checkpoint file.
+
+    replay : list of dict
+        When resuming, the recorded evaluations which have not yet been
+        replayed.
+
+    separable : bool
+        Whether to optimise groups of non-interacting parameters separately.
+
+    groups : list of list of int or None
+        In separable mode, the indices of the parameters in each group. None
+        if the groups have not been determined yet.
+
+    restarts : int
+        The maximum number of times to restart the optimisation after it has
+        converged (see backend.run_restarts()).
+
+    refine : bool
+        Whether to return the minimum of a quadratic model fitted to the
+        evaluated points as the optimum, instead of the best point sampled.
+
+    violation : function or None
+        Function which returns the amount by which a point (in unscaled
+        units) violates the constraints of the active routine. None if the
+        routine has no constraints.
+
+    acquire_calls : int
+        The number of times that backend.acquire_nmr() has been called
+        (excluding points which were not acquired).
+
+    stale_modules : list of str
+        In the backend daemon, the names of the cost function modules which
+        have been modified since they were loaded, but could not be reloaded
+        because another optimisation was running (see server.py). The
+        optimisation uses the old versions.
+
     p_poise : |Path|
         The path to the ``$TS/exp/stan/nmr/py/user/poise_backend`` folder.
 
+    p_database : |Path|
+        The path to the SQLite database in which completed optimisations are
+        recorded (``poise_backend/poise.db``).
+
     spec_f1p : float or tuple of float
         The ``F1P`` parameter. For a 1D spectrum this is a float. For a 2D
         spectrum this is a tuple of floats (``indirect, direct``) corresponding
@@ -61,15 +156,80 @@ class _g():
         The values of the cost functions calculated at each stage of the
         optimisation.
     """
-    optimiser = None
-    routine_id = None
-    p_spectrum = None
-    p_optlog = None
-    p_errlog = None
-    maxfev = 0
-    nfev = 0
+    # The location of the backend is the same for all optimisations.
     p_poise = Path(__file__).parent.resolve()
-    spec_f1p = None
-    spec_f2p = None
-    xvals = []
-    fvals = np.array([])
+    p_database = p_poise / "poise.db"
+
+    def __init__(self):
+        self.optimiser = None
+        self.routine_id = None
+        self.p_spectrum = None
+        self.p_optlog = None
+        self.p_errlog = None
+        self.maxfev = 0
+        self.maxtime = 0
+        self.t_start = None
+        self.eval_times = []
+        self.warm = False
+        self.noise_reps = 0
+        self.noise = 0
+        self.explore = {}
+        self.fidelity = {}
+        self.resume = False
+        self.p_checkpoint = None
+        self.checkpoint_settings = {}
+        self.replay = []
+        self.separable = False
+        self.groups = None
+        self.restarts = 0
+        self.refine = False
+        self.violation = None
+        self.nfev = 0
+        self.acquire_calls = 0
+        self.stale_modules = []
+        self.spec_f1p = None
+        self.spec_f2p = None
+        self.xvals = []
+        self.fvals = np.array([])
+        self.fidelities = []
+
+
+class _StateProxy():
+    """
+    Forwards attribute access to the State of the current thread.
+    """
+    def __getattr__(self, name):
+        return getattr(current_state(), name)
+
+    def __setattr__(self, name, value):
+        setattr(current_state(), name, value)
+
+
+_local = threading.local()
+_default_state = State()
+_g = _StateProxy()
+
+
+def current_state():
+    """
+    Returns the State of the current thread. Threads which have not been
+    given their own State (using `new_state()`) share a default one.
+    """
+    return getattr(_local, "state", _default_state)
+
+
+@contextmanager
+def new_state():
+    """
+    Context manager which gives the current thread a fresh State, i.e. ``_g``
+    refers to a new State inside the ``with`` block. The State is yielded.
+    """
+    saved = getattr(_local, "state", None)
+    _local.state = State()
+    try:
+        yield _local.state
+    finally:
+        if saved is None:
+            del _local.state
+        else:
+            _local.state = saved
@@ -58,6 +58,11 @@ pulprog_dict = {
     "stegp1s": ["stegp1s1d", "GPZ 6", "D 20"],
     "ledgp2s": ["ledgp2s1d", "GPZ 6", "D 20"],
 }
+# Set this to True to run the optimisations in the POISE backend daemon (see
+# `poise --daemon`), which saves starting Python 3 again for every iteration
+# of the diffusion delay loop. The daemon then stays running in the
+# background until it has been idle for an hour, or `poise --kill` is run.
+use_daemon = False
 
 
 def main():
@@ -70,6 +75,7 @@ def main():
         MSG("dosy_opt: unsupported pulse programme. New pulse programmes can"
             " be added in the dosy_opt.py script.")
         EXIT()
+    daemon_flag = " --daemon" if use_daemon else ""
 
     # Create new routines. We need to do this within this script since the
     # routine depends on the GPZ parameter being optimised; we can't hardcode
@@ -122,7 +128,8 @@ def main():
         # experiment has been recorded.
         RE(optimisation_dataset)
         PUTPAR("TI", " ")  # has to be one space, not an empty string (try it)
-        XCMD("poise dosy_aux -a nm --maxfev 1 -q", wait=WAIT_TILL_DONE)
+        XCMD("poise dosy_aux -a nm --maxfev 1 -q" + daemon_flag,
+             wait=WAIT_TILL_DONE)
         # If TI isn't a valid float, something went wrong with POISE.
         try:
             cf = float(GETPAR("TI"))
@@ -154,7 +161,7 @@ def main():
     msg_nonmodal("dosy_opt: diffusion delay set to {} seconds.\n"
                  "    now optimising gradient amplitude...".format(best_delay))
     PUTPAR("TI", " ")
-    XCMD("poise dosy -a bobyqa -q", wait=WAIT_TILL_DONE)
+    XCMD("poise dosy -a bobyqa -q" + daemon_flag, wait=WAIT_TILL_DONE)
     # Again, check to make sure that TI is a valid float.
     try:
         float(GETPAR("TI"))
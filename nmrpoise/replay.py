@@ -0,0 +1,406 @@
+"""
+replay.py
+---------
+
+Replaying optimisations against recorded spectra. If an optimisation was run
+with ``--separate``, every spectrum it acquired is kept in its own expno.
+These spectra can be used to find out how a different cost function, or
+different optimisation settings, would have performed on the same sample,
+without acquiring any more spectra: the backend is run offline (see
+simulate.py), and every time it asks for a spectrum, it is given the
+recorded spectrum which is closest to the point requested (or an
+interpolation between several of them).
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+import re
+import ast
+import shutil
+import tempfile
+from pathlib import Path
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from . import parse_log
+from .simulate import run_offline, SimulationResult
+from .synthetic import encode
+from .poise_backend.cfhelpers import (getpar, getndim, get1d_real,
+                                      get1d_imag, _get_acqu_par)
+
+
+RecordedRun = namedtuple("RecordedRun", "routine xvals fvals p_spectra time")
+RecordedRun.__doc__ = """
+The spectra acquired during an optimisation, as returned by `index_run()`.
+
+Attributes
+----------
+routine : dict
+    The routine which was used, with the same keys as the routine JSON
+    files.
+xvals : ndarray
+    The points at which spectra were acquired, one per row.
+fvals : ndarray
+    The cost function values recorded for each of these (NaN if there was
+    none).
+p_spectra : list of |Path|
+    The path to the procno folder of each spectrum.
+time : float
+    The average time taken per spectrum in seconds, or 0 if the optimisation
+    did not finish.
+"""
+
+ReplayResult = namedtuple("ReplayResult",
+                          SimulationResult._fields + ("distances",))
+ReplayResult.__doc__ = """
+The outcome of a replayed optimisation. The attributes are the same as those
+of `SimulationResult`, plus:
+
+distances : ndarray
+    For each spectrum requested, the distance to the closest recorded
+    spectrum, in units of the tolerances. Large distances mean that the
+    replay is unreliable.
+"""
+
+# Files which make up a dataset, in the expno and procno folders.
+EXPNO_FILES = ["acqus", "acqu2s", "fid", "ser"]
+PROCNO_FILES = ["procs", "proc2s", "1r", "1i", "2rr", "2ri", "2ir", "2ii"]
+# Routine fields which are given in the poise.log header, and their labels.
+HEADER_FIELDS = {"Routine name": "name",
+                 "Optimisation parameters": "pars",
+                 "Cost function": "cf",
+                 "AU programme": "au",
+                 "Initial values": "init",
+                 "Lower bounds": "lb",
+                 "Upper bounds": "ub",
+                 "Tolerances": "tol",
+                 "Transforms": "transforms",
+                 "Steps": "steps",
+                 "Constraints": "constraints",
+                 "Target": "target",
+                 "Stagnation": "stagnation"}
+
+
+def index_run(p_optlog, run=-1, procno=1):
+    """
+    Finds the spectra acquired during an optimisation run with
+    ``--separate``.
+
+    The rows of the run in ``poise.log`` are matched, in order, to the
+    expnos starting from the one containing ``poise.log``. Rows which were
+    not acquired (because the point was outside the bounds or violated the
+    constraints, which are logged with a cost function of ``inf``) are
+    skipped. Where the acquisition parameters of a spectrum can be read from
+    its ``acqus`` file, they are checked against the log.
+
+    Parameters
+    ----------
+    p_optlog : |Path| or str
+        Path to the ``poise.log`` file, or the expno folder containing it.
+    run : int, optional
+        Index of the run in the file (including runs which did not finish).
+        Defaults to the last one.
+    procno : int, optional
+        The procno containing the processed spectra.
+
+    Returns
+    -------
+    RecordedRun
+        The routine and the spectra acquired.
+
+    Raises
+    ------
+    ValueError
+        If the spectra do not exist or do not match the log (e.g. because
+        ``--separate`` was not used).
+    """
+    p_optlog = Path(p_optlog).resolve()
+    if p_optlog.is_dir():
+        p_optlog = p_optlog / "poise.log"
+    with open(p_optlog, "r") as fp:
+        runs = fp.read().split("=" * 40 + "\n")[1:]
+    if not runs:
+        raise ValueError(f"No optimisations found in '{p_optlog}'.")
+    lines = runs[run].splitlines()
+
+    routine = {}
+    time, nfev = 0, None
+    for line in lines:
+        label, _, value = line.partition(" - ")
+        label = label.strip()
+        if label in HEADER_FIELDS:
+            value = value.strip()
+            if label in ["Routine name", "Cost function", "AU programme"]:
+                routine[HEADER_FIELDS[label]] = value
+            else:
+                routine[HEADER_FIELDS[label]] = ast.literal_eval(value)
+        elif label == "Number of spectra ran":
+            nfev = int(value)
+        elif label == "Total time taken":
+            h, m, s = [int(i) for i in value.split(":")]
+            time = 3600 * h + 60 * m + s
+    if "pars" not in routine:
+        raise ValueError(f"Could not read the routine from '{p_optlog}'.")
+
+    # Rows contain the values of the parameters and (optionally) the cost
+    # function.
+    npars = len(routine["pars"])
+    xvals, fvals = [], []
+    for line in lines:
+        try:
+            row = [float(v) for v in line.split()]
+        except ValueError:
+            continue
+        if len(row) not in [npars, npars + 1]:
+            continue
+        if len(row) == npars:
+            row.append(np.nan)
+        if np.isinf(row[-1]):
+            continue
+        xvals.append(row[:-1])
+        fvals.append(row[-1])
+    if not xvals:
+        raise ValueError(f"No spectra were acquired in run {run} of"
+                         f" '{p_optlog}'.")
+
+    first_expno = int(p_optlog.parent.name)
+    p_data = p_optlog.parents[1]
+    p_spectra = []
+    for i, x in enumerate(xvals):
+        p_spec = p_data / str(first_expno + i) / "pdata" / str(procno)
+        if not (p_spec / "procs").exists():
+            raise ValueError(f"The spectrum {p_spec} does not exist. Note that"
+                             " the spectra are only kept if the optimisation"
+                             " was run with --separate.")
+        for par, value in zip(routine["pars"], x):
+            recorded = _get_acqu_par(par, p_spec.parents[1] / "acqus")
+            if (recorded is not None
+                    and not np.isclose(recorded, value, rtol=1e-4,
+                                       atol=1e-4)):
+                raise ValueError(f"The value of {par} in {p_spec.parents[1]}"
+                                 f" ({recorded}) does not match the value in"
+                                 f" '{p_optlog}' ({value}).")
+        p_spectra.append(p_spec)
+
+    time = time / nfev if nfev else 0
+    return RecordedRun(routine, np.array(xvals), np.array(fvals), p_spectra,
+                       time)
+
+
+def nearest(recorded, x, k=1):
+    """
+    Finds the recorded spectra which are closest to a point. Distances are
+    measured in units of the tolerances of the routine.
+
+    Parameters
+    ----------
+    recorded : RecordedRun
+        The recorded spectra.
+    x : list of float
+        The point.
+    k : int, optional
+        The number of spectra to return.
+
+    Returns
+    -------
+    indices : ndarray
+        The indices of the *k* closest spectra, closest first.
+    distances : ndarray
+        The distance of each of these to *x*.
+    """
+    tol = np.array(recorded.routine["tol"], dtype=float)
+    d = np.linalg.norm((recorded.xvals - np.asarray(x)) / tol, axis=1)
+    indices = np.argsort(d, kind="stable")[:k]
+    return indices, d[indices]
+
+
+def replay(recorded, p_work, changes=None, interpolate=False, **options):
+    """
+    Runs an optimisation offline, using the recorded spectra.
+
+    Whenever the backend asks for a spectrum, the recorded spectrum closest
+    to the requested point is copied to ``<p_work>/1/pdata/1``, which is
+    where the cost function reads it from. Each spectrum is assumed to take
+    the same time as it did in the recorded run. Any acquisition parameters
+    which are overridden in multi-fidelity mode are ignored.
+
+    Parameters
+    ----------
+    recorded : RecordedRun
+        The recorded spectra, as returned by `index_run()`.
+    p_work : |Path| or str
+        Folder in which the optimisation is carried out. ``poise.log`` is
+        written to ``<p_work>/1``.
+    changes : dict, optional
+        Changes to the routine, e.g. ``{"cf": "my_new_cf"}`` or
+        ``{"tol": [0.5]}``. The parameters cannot be changed.
+    interpolate : bool, optional
+        Instead of the closest spectrum, use a weighted average of the
+        *N* + 1 closest spectra (where *N* is the number of parameters), with
+        weights inversely proportional to their distances from the requested
+        point. The 1r and 1i files are averaged, but the FID is that of the
+        closest spectrum. This only works for 1D spectra; for 2D spectra the
+        closest spectrum is always used.
+    options
+        Options for the optimisation, passed on to `run_offline()` (e.g.
+        *algorithm*, *maxfev*, or *noise_reps*).
+
+    Returns
+    -------
+    ReplayResult
+        The result of the optimisation.
+    """
+    changes = dict(changes or {})
+    if "pars" in changes:
+        raise ValueError("The parameters of a recorded run cannot be"
+                         " changed.")
+    routine = dict(recorded.routine, **changes)
+    p_expno = Path(p_work).resolve() / "1"
+    k = len(routine["pars"]) + 1 if interpolate else 1
+    distances = []
+
+    def acquire(values):
+        x = [float(values[par]) for par in routine["pars"]]
+        indices, d = nearest(recorded, x, k)
+        p_spec = _copy_dataset(recorded.p_spectra[indices[0]], p_expno)
+        if interpolate and d[0] > 0 and getndim(p_spec) == 1:
+            weights = 1 / d
+            _interpolate_1d([recorded.p_spectra[i] for i in indices],
+                            weights / np.sum(weights), p_spec)
+        distances.append(d[0])
+        return p_spec, recorded.time
+
+    result = run_offline(routine, acquire, p_work, **options)
+    # The first distance is for the starting dataset.
+    return ReplayResult(*result, distances=np.array(distances[1:]))
+
+
+def compare(recorded, alternatives, interpolate=False, p_work=None):
+    """
+    Replays a recorded optimisation with several alternative routines or
+    settings, and tabulates the results next to the original run.
+
+    Parameters
+    ----------
+    recorded : RecordedRun
+        The recorded spectra, as returned by `index_run()`.
+    alternatives : list of dict
+        The alternatives to try. Each is a dict whose keys are either routine
+        fields (which are passed to `replay()` as *changes*) or options for
+        `run_offline()`, e.g. ``[{"algorithm": "nm"}, {"cf": "my_new_cf",
+        "algorithm": "nm"}]``.
+    interpolate : bool, optional
+        Passed to `replay()`.
+    p_work : |Path| or str, optional
+        Folder in which the replays are carried out (each in its own
+        subfolder). Defaults to a temporary folder which is deleted
+        afterwards.
+
+    Returns
+    -------
+    compare_df : :class:`DataFrame <pandas.DataFrame>`
+        DataFrame with one row for the recorded run, followed by one row per
+        alternative. The first columns are the same as those returned by
+        `parse_log()`; these are followed by the termination message, the
+        maximum and mean distance between the requested points and the
+        recorded spectra used (in units of the tolerances), and a
+        description of the alternative (``"recorded"`` for the original
+        run).
+    """
+    routine = recorded.routine
+    xbest = recorded.xvals[np.nanargmin(recorded.fvals)]
+
+    def unlist(x):
+        # Same as parse_log(): remove the list if it's a singleton
+        x = np.asarray(x).tolist() if x is not None else None
+        return x[0] if isinstance(x, list) and len(x) == 1 else x
+
+    rows = [{"routine": routine["name"], "initial": unlist(routine["init"]),
+             "param": routine["pars"], "lb": unlist(routine["lb"]),
+             "ub": unlist(routine["ub"]), "tol": unlist(routine["tol"]),
+             "algorithm": None, "costfn": routine["cf"],
+             "auprog": routine["au"], "optimum": unlist(xbest),
+             "fbest": np.nanmin(recorded.fvals),
+             "nfev": len(recorded.xvals),
+             "time": recorded.time * len(recorded.xvals),
+             "message": None, "max_distance": 0, "mean_distance": 0,
+             "alternative": "recorded"}]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        p_work = Path(p_work or tmpdir)
+        for i, alternative in enumerate(alternatives):
+            changes = {k: v for k, v in alternative.items()
+                       if k in HEADER_FIELDS.values()}
+            options = {k: v for k, v in alternative.items()
+                       if k not in changes}
+            row = dict(rows[0], alternative=str(alternative))
+            try:
+                result = replay(recorded, p_work / str(i), changes=changes,
+                                interpolate=interpolate, **options)
+            except RuntimeError as e:
+                row.update(optimum=None, fbest=None, nfev=None, time=None,
+                           message=str(e), max_distance=None,
+                           mean_distance=None)
+                rows.append(row)
+                continue
+            log_df = parse_log(result.p_optlog)
+            if len(log_df) > 0:
+                row.update(log_df.iloc[-1].to_dict())
+            else:
+                row.update(optimum=None, fbest=None)
+            distances = result.distances if result.nfev else [np.nan]
+            row.update(nfev=result.nfev, time=result.time,
+                       message=result.message,
+                       max_distance=np.max(distances),
+                       mean_distance=np.mean(distances))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def _copy_dataset(p_spec, p_expno):
+    """
+    Copies the dataset files (but nothing else) of the procno folder
+    *p_spec*, and its expno folder, to procno 1 of *p_expno*. Returns the new
+    procno folder.
+    """
+    p_dest = p_expno / "pdata" / "1"
+    p_dest.mkdir(parents=True, exist_ok=True)
+    for folder, dest, fnames in [(p_spec.parents[1], p_expno, EXPNO_FILES),
+                                 (p_spec, p_dest, PROCNO_FILES)]:
+        for fname in fnames:
+            if (dest / fname).exists():
+                (dest / fname).unlink()
+            if (folder / fname).exists():
+                shutil.copyfile(folder / fname, dest / fname)
+    return p_dest
+
+
+def _interpolate_1d(p_specs, weights, p_dest):
+    """
+    Replaces the 1r and 1i files in *p_dest* by a weighted average of those
+    in the procno folders *p_specs*, and updates NC_proc accordingly. The
+    spectra are read with the same helpers as cost functions use (so their
+    DTYPP and BYTORDP are honoured), and the result is written in the format
+    of the dataset in *p_dest*.
+    """
+    spec = 0
+    for p_spec, weight in zip(p_specs, weights):
+        # Explicit bounds, so that F1P and F2P are ignored.
+        spec = spec + weight * (
+            get1d_real(bounds=(None, None), p_spec=p_spec)
+            + 1j * get1d_imag(bounds=(None, None), p_spec=p_spec)
+        )
+    dtypp = int(getpar("DTYPP", p_dest) or 0)
+    bytordp = int(getpar("BYTORDP", p_dest) or 0)
+    _, nc_proc = encode(np.concatenate([spec.real, spec.imag]), dtypp,
+                        bytordp)
+    for fname, part in [("1r", spec.real), ("1i", spec.imag)]:
+        encoded, _ = encode(part, dtypp, bytordp, nc=nc_proc)
+        encoded.tofile(p_dest / fname)
+    p_procs = p_dest / "procs"
+    text = p_procs.read_text()
+    text = re.sub(r"^##\$NC_proc=.*$", f"##$NC_proc= {nc_proc}", text,
+                  flags=re.MULTILINE | re.IGNORECASE)
+    p_procs.write_text(text)
@@ -0,0 +1,390 @@
+"""
+simulate.py
+-----------
+
+Offline simulation of POISE optimisations. The backend is run as a
+subprocess, exactly as it is by TopSpin, but the frontend is replaced by
+`run_offline()`, which answers every request for a spectrum without a
+spectrometer. `simulate()` does this by writing a synthetic dataset
+calculated from a model of the experiment, which allows optimisers, cost
+functions and settings to be compared end to end.
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+import os
+import sys
+import json
+import builtins
+import subprocess
+from datetime import datetime, timedelta
+from pathlib import Path
+from collections import namedtuple
+
+import numpy as np
+
+from .synthetic import write_1d
+
+
+# A single Lorentzian line. *shift* is in ppm, *width* (full width at half
+# maximum) in Hz, and *t1* in seconds.
+Line = namedtuple("Line", "shift width amplitude t1")
+Line.__new__.__defaults__ = (1.0, 1.0)
+
+SimulationResult = namedtuple("SimulationResult",
+                              "xbest message nfev time xvals fvals p_optlog")
+SimulationResult.__doc__ = """
+The outcome of a simulated optimisation.
+
+Attributes
+----------
+xbest : ndarray or None
+    The optimum returned by the backend. None if the optimisation was
+    terminated before any spectra were acquired.
+message : str
+    The message returned by the backend.
+nfev : int
+    The number of spectra acquired.
+time : float
+    The modelled time taken for all the acquisitions, in seconds.
+xvals : list of ndarray
+    The points at which spectra were acquired, in chronological order.
+fvals : ndarray
+    The cost function values reported by the backend for each of these.
+p_optlog : |Path|
+    The path to the ``poise.log`` file written by the backend, which can be
+    read using `parse_log()`.
+"""
+
+# Lines sent to the backend which advance its clock (see _run_backend()).
+CLOCK_PREFIX = "clock:"
+
+
+class Experiment():
+    """
+    Parametric model of a 1D pulse--acquire experiment, which is used to
+    calculate the FID acquired with a given set of acquisition parameters.
+
+    Each line is excited by a pulse of length ``P1`` with a flip angle of
+    90 * P1 / *p90* degrees. The B1 field is inhomogeneous (with a Gaussian
+    distribution of relative width *b1_inhom*), so that the nutation curve is
+    damped. Between scans, the magnetisation recovers for ``D1`` plus the
+    acquisition time, with the steady state given by the Ernst equation. The
+    signals of ``NS`` scans are added together, together with Gaussian noise
+    of standard deviation *noise* (per scan, per point).
+
+    Acquisition parameters are given as a dict of (case-insensitive) TopSpin
+    parameter names, e.g. ``{"P1": 12.0, "D1": 1.0, "NS": 8}``. Parameters
+    which the model does not use are still written to the acqus file, so that
+    cost functions can read them using `getpar()`. Parameters that the
+    built-in model does not know about can affect the spectrum through the
+    *response* function.
+
+    Parameters
+    ----------
+    lines : list of Line
+        The lines in the spectrum.
+    p90 : float, optional
+        The 90° pulse length in µs.
+    b1_inhom : float, optional
+        Relative width of the B1 distribution.
+    noise : float, optional
+        Standard deviation of the noise in each scan.
+    pars : dict, optional
+        Default acquisition parameters (for example, the values which are not
+        optimised).
+    response : function, optional
+        Function which is passed the dict of acquisition parameters and
+        returns an extra (complex) factor by which the amplitude of each line
+        is multiplied. It can return either a number or an array with one
+        entry per line.
+    overhead : float, optional
+        Time (in seconds) taken for each spectrum in addition to the scans,
+        e.g. for starting the acquisition and processing.
+    seed : int, optional
+        Seed for the random number generator used for the noise.
+    """
+    def __init__(self, lines, p90=10.0, b1_inhom=0.05, noise=0.0, pars=None,
+                 response=None, overhead=2.0, seed=None):
+        self.lines = [Line(*line) for line in lines]
+        self.p90 = p90
+        self.b1_inhom = b1_inhom
+        self.noise = noise
+        self.pars = {"TD": 8192, "SW_H": 5000.0, "SFO1": 500.0, "O1": 2500.0,
+                     "NS": 1, "DS": 0, "P1": p90, "D1": 1.0}
+        self.pars.update({k.upper(): v for k, v in (pars or {}).items()})
+        self.response = response
+        self.overhead = overhead
+        self.rng = np.random.default_rng(seed)
+
+    def acquisition_pars(self, values=None):
+        """
+        Returns the acquisition parameters for an acquisition: the defaults,
+        updated with *values* (a dict of parameter names and values).
+        """
+        pars = dict(self.pars)
+        pars.update({k.upper(): float(v) for k, v in (values or {}).items()})
+        for par in ["TD", "NS", "DS"]:
+            pars[par] = int(pars[par])
+        return pars
+
+    def amplitudes(self, pars):
+        """
+        Returns the complex amplitude of each line (per scan) with the given
+        acquisition parameters.
+        """
+        # Quadrature over the B1 distribution.
+        b1, weights = np.polynomial.hermite_e.hermegauss(15)
+        b1 = 1 + self.b1_inhom * b1
+        weights = weights / np.sum(weights)
+        theta = (np.pi / 2) * (pars["P1"] / self.p90) * b1
+        t1 = np.array([line.t1 for line in self.lines])
+        tr = pars["D1"] + pars["TD"] / (2 * pars["SW_H"])
+        e1 = np.exp(-tr / t1)[:, np.newaxis]
+        mss = (1 - e1) * np.sin(theta) / (1 - e1 * np.cos(theta))
+        amps = (np.array([line.amplitude for line in self.lines])
+                * np.sum(mss * weights, axis=1))
+        if self.response is not None:
+            amps = amps * self.response(pars)
+        return amps
+
+    def fid(self, pars):
+        """
+        Returns the FID (the sum of ``NS`` scans) acquired with the given
+        acquisition parameters.
+        """
+        npts = pars["TD"] // 2
+        t = np.arange(npts) / pars["SW_H"]
+        o1p = pars["O1"] / pars["SFO1"]
+        fid = np.zeros(npts, dtype=np.complex128)
+        for line, amp in zip(self.lines, self.amplitudes(pars)):
+            freq = (line.shift - o1p) * pars["SFO1"]
+            fid += amp * np.exp((2j * np.pi * freq - np.pi * line.width) * t)
+        fid = fid * pars["NS"]
+        if self.noise > 0:
+            sd = self.noise * np.sqrt(pars["NS"])
+            fid += sd * (self.rng.standard_normal(npts)
+                         + 1j * self.rng.standard_normal(npts))
+        return fid
+
+    def acquisition_time(self, pars):
+        """
+        Returns the time (in seconds) taken to acquire and process a spectrum
+        with the given acquisition parameters.
+        """
+        scan = (pars["D1"] + pars["P1"] * 1e-6
+                + pars["TD"] / (2 * pars["SW_H"]))
+        return self.overhead + (pars["NS"] + pars["DS"]) * scan
+
+    def write(self, p_expno, pars):
+        """
+        Acquires a spectrum with the given acquisition parameters and writes
+        it to *p_expno*. Returns the path to the procno folder.
+        """
+        return write_1d(p_expno, self.fid(pars), acqus=pars,
+                        procs={"SI": pars["TD"] // 2})
+
+
+def simulate(routine, experiment, p_sim, **options):
+    """
+    Runs an optimisation offline, using the real backend, with spectra
+    calculated from a model of the experiment.
+
+    Whenever the backend asks for a spectrum, the acquisition parameters are
+    set to the values requested, and the resulting synthetic dataset is
+    written to ``<p_sim>/1`` (i.e. expno 1, procno 1 is always overwritten,
+    as without ``--separate``). Each spectrum takes the time given by
+    `Experiment.acquisition_time()`.
+
+    Parameters
+    ----------
+    routine : dict or |Path| or str
+        The routine, either as a dict (with the same keys as the routine JSON
+        files) or as the path to a routine JSON file.
+    experiment : Experiment
+        Model of the experiment.
+    p_sim : |Path| or str
+        Folder in which the simulation is carried out (see `run_offline()`).
+    options
+        Options for the optimisation, passed on to `run_offline()`.
+
+    Returns
+    -------
+    SimulationResult
+        The result of the optimisation.
+    """
+    p_expno = Path(p_sim).resolve() / "1"
+
+    def acquire(values):
+        pars = experiment.acquisition_pars(values)
+        return (experiment.write(p_expno, pars),
+                experiment.acquisition_time(pars))
+
+    return run_offline(routine, acquire, p_sim, **options)
+
+
+def run_offline(routine, acquire, p_sim, algorithm="bobyqa", maxfev=0,
+                warm=False, noise_reps=0, explore_ns=0, resume=False,
+                maxtime=0, separable=False, refine=False, restarts=0,
+                timeout=None):
+    """
+    Runs an optimisation using the real backend, with the frontend replaced
+    by a function which provides the spectra.
+
+    The backend is started as a subprocess and communicates through the same
+    stdin/stdout protocol as it does with the frontend in TopSpin. Whenever
+    it asks for a spectrum, *acquire* is called with the requested values,
+    and must return the path to a dataset containing the spectrum, as well as
+    the time it (nominally) took to acquire.
+
+    The backend clock is replaced by a simulated one, which only advances by
+    the acquisition times returned by *acquire*, so that ``--maxtime`` and
+    the times in ``poise.log`` behave as they would on a spectrometer.
+
+    Parameters
+    ----------
+    routine : dict or |Path| or str
+        The routine, either as a dict (with the same keys as the routine JSON
+        files) or as the path to a routine JSON file.
+    acquire : function
+        Function which is passed a dict of acquisition parameters to set
+        (the values of the routine parameters, plus any parameters overridden
+        in multi-fidelity mode, e.g. ``{"p1": 12.0, "NS": "1"}``). It must
+        return the path to the procno folder of the spectrum and the
+        acquisition time in seconds. It is called once before the backend
+        is started, with the initial values of the routine, in order to
+        create the dataset that the optimisation starts from; this spectrum
+        does not count as an evaluation. ``poise.log`` is written to the
+        expno folder of this first dataset.
+    p_sim : |Path| or str
+        Folder in which the optimisation is carried out. The routine and the
+        run database are stored here, so a fresh folder should be used for
+        independent optimisations.
+    algorithm, maxfev, warm, noise_reps, explore_ns, resume, maxtime,
+    separable, refine, restarts : optional
+        The same as the corresponding options of the frontend (see
+        :doc:`frontend`). *maxtime* is given in seconds.
+    timeout : float, optional
+        Maximum real time (in seconds) to wait for the backend to exit once
+        the optimisation has finished.
+
+    Returns
+    -------
+    SimulationResult
+        The result of the optimisation.
+
+    Raises
+    ------
+    RuntimeError
+        If the backend raised an exception or printed an invalid message.
+    """
+    p_sim = Path(p_sim).resolve()
+    if not isinstance(routine, dict):
+        with open(routine, "r") as fp:
+            routine = json.load(fp)
+    p_routines = p_sim / "poise_backend" / "routines"
+    p_routines.mkdir(parents=True, exist_ok=True)
+    with open(p_routines / f"{routine['name']}.json", "w") as fp:
+        json.dump(routine, fp)
+
+    # The dataset must already exist when the backend starts.
+    p_spectrum, _ = acquire(dict(zip(routine["pars"], routine["init"])))
+    p_optlog = Path(p_spectrum).parents[1] / "poise.log"
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [str(Path(__file__).parents[1])]
+        + [p for p in [env.get("PYTHONPATH")] if p])
+    backend = subprocess.Popen(
+        [sys.executable, "-u", "-c",
+         "from nmrpoise.simulate import _run_backend; _run_backend()",
+         str(p_sim / "poise_backend"), str(p_sim / "poise.db")],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+        universal_newlines=True)
+
+    def send(*lines):
+        for line in lines:
+            print(line, file=backend.stdin)
+        backend.stdin.flush()
+
+    explore = f"NS={explore_ns}" if explore_ns > 0 else ""
+    xvals, fvals, total_time = [], [], 0
+    try:
+        send(algorithm, routine["name"], p_spectrum, maxfev, int(warm),
+             noise_reps, explore, int(resume), maxtime, int(separable),
+             int(refine), restarts)
+        while True:
+            line = backend.stdout.readline().strip()
+            if line.startswith("optima:"):
+                xbest = np.array([float(v) for v in line.split()[1:]])
+                message = backend.stdout.readline().strip()
+                break
+            elif line == "terminated":
+                xbest, message = None, "The optimisation was terminated."
+                break
+            elif line.startswith("cf:"):
+                fvals.append(float(line.split()[1]))
+            elif line.startswith("values:"):
+                line, _, fidelity = line.partition("|")
+                point = [float(v) for v in line.split()[1:]]
+                values = dict(zip(routine["pars"], point))
+                values.update(f.split("=") for f in fidelity.split())
+                p_spectrum, t_acq = acquire(values)
+                total_time += t_acq
+                xvals.append(np.array(point))
+                send(f"{CLOCK_PREFIX} {t_acq}", "done", p_spectrum)
+            elif line.startswith("Backend exception: "):
+                raise RuntimeError(line)
+            else:
+                raise RuntimeError(f"Invalid message from backend: '{line}'."
+                                   " Please see error log for more"
+                                   " information.")
+        backend.wait(timeout=timeout)
+    finally:
+        if backend.poll() is None:
+            backend.kill()
+        backend.stdin.close()
+        backend.stdout.close()
+
+    return SimulationResult(xbest, message, len(xvals), total_time, xvals,
+                            np.array(fvals), p_optlog)
+
+
+def _run_backend():
+    """
+    Entry point for the backend subprocess started by `run_offline()`. The
+    command-line arguments are the folder containing the routines, and the
+    path to the run database.
+
+    Before running the backend (without the '.pid<PID>' file used by the
+    frontend), the clock seen by the backend is replaced by a simulated one.
+    This starts at the real time, and only advances when the simulated
+    frontend sends a line ``clock: <seconds>``, which is not passed on to the
+    backend.
+    """
+    from .poise_backend import backend
+    from .poise_backend.shared import _g
+
+    _g.p_poise = Path(sys.argv[1])
+    _g.p_database = Path(sys.argv[2])
+    clock = [datetime.now()]
+
+    class SimulatedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock[0]
+
+    real_input = builtins.input
+
+    def simulated_input(*args):
+        line = real_input(*args)
+        while line.startswith(CLOCK_PREFIX):
+            clock[0] += timedelta(seconds=float(line.split()[1]))
+            line = real_input(*args)
+        return line
+
+    backend.datetime = SimulatedDatetime
+    builtins.input = simulated_input
+    # No .pid file is written: it would end up in the installed package, and
+    # be left behind whenever run_offline() kills the backend.
+    backend.run_session()
@@ -0,0 +1,325 @@
+"""
+study.py
+--------
+
+Monte Carlo studies of optimisation settings. Many simulated optimisations
+(see simulate.py) are run in parallel for every combination of algorithm and
+settings, and the number of spectra needed, the error in the optimum found,
+and the failure rate are summarised for each combination.
+
+Run ``python -m nmrpoise.study -h`` for the command-line options.
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+import sys
+import json
+import argparse
+import itertools
+import tempfile
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import parse_log
+from .simulate import simulate, Experiment
+
+
+# A run counts as a failure if the optimum it returns is further than this
+# many tolerances away from the true optimum (in any parameter).
+FAIL_TOL = 3
+# Columns of the table returned by run_study(), apart from the settings. The
+# first ones are the same as those returned by parse_log().
+LOG_COLUMNS = ["routine", "initial", "param", "lb", "ub", "tol", "algorithm",
+               "costfn", "auprog", "optimum", "fbest", "nfev", "time"]
+RUN_COLUMNS = LOG_COLUMNS + ["requested", "message", "seed", "error",
+                             "failed"]
+# Settings which can be varied in a study (apart from the algorithm). All of
+# them except for noise and tol_scale are passed on to simulate().
+SETTINGS = ["noise", "tol_scale", "maxfev", "maxtime", "noise_reps",
+            "explore_ns", "separable", "refine", "restarts"]
+
+
+def run_study(routine, model, algorithms=("nm", "mds", "bobyqa"),
+              settings=None, reps=10, optimum=None, random_init=False,
+              fail_tol=FAIL_TOL, seed=0, processes=None):
+    """
+    Runs simulated optimisations for every combination of algorithm and
+    settings.
+
+    Parameters
+    ----------
+    routine : dict
+        The routine, with the same keys as the routine JSON files.
+    model : dict
+        Keyword arguments used to construct the `Experiment` which models the
+        spectra, e.g. ``{"lines": [[1.0, 3.0]], "p90": 11.7}``. The noise
+        level and random seed are set separately for each run.
+    algorithms : list of str, optional
+        The algorithms to compare. (For routines with one parameter, ``auto``
+        uses Brent's method.)
+    settings : dict, optional
+        The settings to vary (see `SETTINGS`), as a dict of lists of values.
+        Every combination of these is studied. ``noise`` is the noise level of
+        the model, and ``tol_scale`` multiplies the tolerances of the routine
+        (which also scales the initial simplex or trust region).
+    reps : int, optional
+        The number of optimisations run for each combination.
+    optimum : list of float, optional
+        The true optimum. If not given, the median of the optima found by all
+        the successful runs is used.
+    random_init : bool, optional
+        Whether to start each optimisation at a random point within the
+        bounds, instead of the initial values of the routine.
+    fail_tol : float, optional
+        A run is considered to have failed if it did not return an optimum,
+        or if its optimum is more than this many tolerances (of the original
+        routine) from the true optimum.
+    seed : int, optional
+        Seed for the noise and the initial points. Run *i* of each
+        combination uses seed ``seed + i``, so that all combinations see the
+        same noise realisations.
+    processes : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    runs_df : :class:`DataFrame <pandas.DataFrame>`
+        DataFrame with one row per run. The first columns are the same as
+        those returned by `parse_log()`, where ``algorithm`` is the optimiser
+        which was actually used (e.g. ``brent`` for ``auto``); these are
+        followed by the algorithm which was requested, the termination
+        message, the seed, the settings, the error (the largest
+        distance between the optimum found and the true optimum, in units of
+        the tolerance), and whether the run failed.
+    """
+    settings = {k: list(v) for k, v in (settings or {}).items()}
+    for name in settings:
+        if name not in SETTINGS:
+            raise ValueError(f"Unknown setting '{name}'.")
+    combinations = [dict(zip(settings, values))
+                    for values in itertools.product(*settings.values())]
+    jobs = [(routine, model, algorithm, combination, seed + i, random_init)
+            for algorithm in algorithms
+            for combination in combinations
+            for i in range(reps)]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        rows = list(executor.map(_run_one, jobs))
+    runs_df = pd.DataFrame(rows, columns=RUN_COLUMNS + list(settings))
+    # Settings go before the results.
+    runs_df = runs_df[RUN_COLUMNS[:-2] + list(settings) + RUN_COLUMNS[-2:]]
+
+    # Evaluate the errors.
+    tol = np.array(routine["tol"], dtype=float)
+    finished = runs_df["optimum"].notna()
+    if optimum is None:
+        if not finished.any():
+            raise RuntimeError("None of the optimisations returned an"
+                               " optimum.")
+        optimum = np.median([np.atleast_1d(x)
+                             for x in runs_df["optimum"][finished]], axis=0)
+    optimum = np.atleast_1d(np.asarray(optimum, dtype=float))
+    runs_df["error"] = [
+        np.max(np.abs(np.atleast_1d(x) - optimum) / tol) if done else np.nan
+        for x, done in zip(runs_df["optimum"], finished)]
+    runs_df["failed"] = ~(runs_df["error"] <= fail_tol)
+    return runs_df
+
+
+def _run_one(job):
+    """
+    Runs one simulated optimisation in a temporary folder and returns the
+    results as a dict. This is the function executed by the worker processes
+    in run_study().
+    """
+    routine, model, algorithm, setting, seed, random_init = job
+    routine = dict(routine)
+    kwargs = dict(setting)
+    model = dict(model, noise=kwargs.pop("noise", model.get("noise", 0)),
+                 seed=seed)
+    tol_scale = kwargs.pop("tol_scale", 1)
+    routine["tol"] = [t * tol_scale for t in routine["tol"]]
+    if random_init:
+        rng = np.random.default_rng(seed)
+        routine["init"] = rng.uniform(routine["lb"], routine["ub"]).tolist()
+
+    def unlist(x):
+        # Same as parse_log(): remove the list if it's a singleton
+        return x[0] if len(x) == 1 else x
+
+    row = {"routine": routine["name"], "initial": unlist(routine["init"]),
+           "param": routine["pars"], "lb": unlist(routine["lb"]),
+           "ub": unlist(routine["ub"]), "tol": unlist(routine["tol"]),
+           "algorithm": None, "costfn": routine["cf"],
+           "auprog": routine["au"], "optimum": None, "requested": algorithm,
+           "seed": seed}
+    row.update(setting)
+    with tempfile.TemporaryDirectory() as p_sim:
+        try:
+            result = simulate(routine, Experiment(**model), p_sim,
+                              algorithm=algorithm, **kwargs)
+        except RuntimeError as e:
+            row["message"] = str(e)
+            return row
+        row["message"] = result.message
+        log_df = parse_log(result.p_optlog)
+        if len(log_df) > 0:
+            row.update(log_df.iloc[-1].to_dict())
+        # Use the modelled time instead of the one in the log, which is
+        # rounded to whole seconds.
+        row["time"] = result.time
+        row["nfev"] = result.nfev
+    return row
+
+
+def summarise(runs_df):
+    """
+    Summarises the results of a study for each combination of requested
+    algorithm and settings.
+
+    Parameters
+    ----------
+    runs_df : :class:`DataFrame <pandas.DataFrame>`
+        The DataFrame returned by `run_study()`.
+
+    Returns
+    -------
+    summary_df : :class:`DataFrame <pandas.DataFrame>`
+        DataFrame with one row per combination, containing the algorithms
+        which were actually used (comma-separated), the number of runs, the
+        mean, median and 90th percentile of the number of spectra, the mean
+        time, the median and 90th percentile of the error, and the fraction
+        of runs which failed.
+    """
+    by = ["requested"] + [c for c in SETTINGS if c in runs_df.columns]
+    grouped = runs_df.groupby(by, sort=False, dropna=False)
+    summary_df = pd.DataFrame({
+        "algorithm": grouped["algorithm"].agg(
+            lambda x: ", ".join(sorted(x.dropna().unique()))),
+        "runs": grouped.size(),
+        "nfev_mean": grouped["nfev"].mean(),
+        "nfev_median": grouped["nfev"].median(),
+        "nfev_p90": grouped["nfev"].quantile(0.9),
+        "time_mean": grouped["time"].mean(),
+        "error_median": grouped["error"].median(),
+        "error_p90": grouped["error"].quantile(0.9),
+        "fail_rate": grouped["failed"].mean(),
+    })
+    return summary_df.reset_index()
+
+
+def main(argv=None):
+    """
+    Command-line interface.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m nmrpoise.study",
+        description=("Run simulated POISE optimisations for several"
+                     " algorithms and settings, and summarise how many"
+                     " spectra they need and how accurate they are.")
+    )
+    parser.add_argument(
+        "routine",
+        help="Path to the routine JSON file."
+    )
+    parser.add_argument(
+        "model",
+        help=("Path to a JSON file with the model of the experiment: an"
+              " object containing the arguments to Experiment(), e.g."
+              ' {"lines": [[1.0, 3.0], [3.0, 5.0, 0.5]], "p90": 11.7,'
+              ' "noise": 0.01, "pars": {"NS": 8}}.')
+    )
+    parser.add_argument(
+        "-a",
+        "--algorithms",
+        nargs="+",
+        default=["nm", "mds", "bobyqa"],
+        choices=["nm", "mds", "bobyqa", "auto"],
+        help=("Algorithms to compare. For routines with one parameter, "
+              "'auto' uses Brent's method. (default: nm mds bobyqa)")
+    )
+    parser.add_argument(
+        "-n",
+        "--reps",
+        type=int,
+        default=10,
+        help="Number of optimisations for each combination. (default: 10)"
+    )
+    parser.add_argument(
+        "-j",
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of worker processes. (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--optimum",
+        type=float,
+        nargs="+",
+        default=None,
+        help=("The true optimum. If not given, the median optimum found by"
+              " all the runs is used.")
+    )
+    parser.add_argument(
+        "--random-init",
+        action="store_true",
+        help="Start each optimisation at a random point within the bounds."
+    )
+    parser.add_argument(
+        "--fail-tol",
+        type=float,
+        default=FAIL_TOL,
+        help=("A run fails if its optimum is further than this many"
+              f" tolerances from the true optimum. (default: {FAIL_TOL})")
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the noise and initial points. (default: 0)"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="Save the results of all the individual runs to a CSV file."
+    )
+    # Settings which can be varied. Every combination of the values given is
+    # studied.
+    for name, type_ in [("noise", float), ("tol_scale", float),
+                        ("maxfev", int), ("maxtime", float),
+                        ("noise_reps", int), ("explore_ns", int),
+                        ("separable", int), ("refine", int),
+                        ("restarts", int)]:
+        parser.add_argument(
+            "--" + name.replace("_", "-"),
+            type=type_,
+            nargs="+",
+            help=(f"Values of the {name} setting to study (see the"
+                  " documentation).")
+        )
+    args = parser.parse_args(argv)
+
+    with open(args.routine, "r") as fp:
+        routine = json.load(fp)
+    with open(args.model, "r") as fp:
+        model = json.load(fp)
+    settings = {name: getattr(args, name) for name in SETTINGS
+                if getattr(args, name) is not None}
+    runs_df = run_study(routine, model, algorithms=args.algorithms,
+                        settings=settings, reps=args.reps,
+                        optimum=args.optimum, random_init=args.random_init,
+                        fail_tol=args.fail_tol, seed=args.seed,
+                        processes=args.processes)
+    if args.output is not None:
+        runs_df.to_csv(Path(args.output), index=False)
+    with pd.option_context("display.max_columns", None,
+                           "display.width", 200):
+        print(summarise(runs_df).to_string(index=False))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
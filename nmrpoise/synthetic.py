@@ -0,0 +1,439 @@
+"""
+synthetic.py
+------------
+
+Functions for writing synthetic datasets in the Bruker (TopSpin) format, so
+that the cost functions and the backend can be tested (and benchmarked)
+without a spectrometer. 1D datasets (``acqus``, ``fid``, ``procs``, ``1r``,
+``1i``) and 2D datasets (``acqus``, ``acqu2s``, ``ser``, ``procs``,
+``proc2s``, ``2rr``, ...) can be written, with the data stored either as
+32-bit integers or as doubles, in either byte order.
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+
+# Acquisition parameters which TopSpin stores as arrays (e.g. P1 is element 1
+# of the array P), and the number of elements stored in acqus.
+LIST_PARAMS = {"CNST": 64, "D": 64, "GPZ": 32, "IN": 64, "INP": 64, "L": 32,
+               "P": 64, "PLW": 64, "SPOFFS": 64, "SPW": 64}
+# The largest integer that is written to the binary files. TopSpin scales the
+# data by 2 ** NC (or NC_proc) such that it fits into a 32-bit integer; a bit
+# of headroom is left here.
+INT32_MAX = 2 ** 29
+# Data types used for the binary files, i.e. the values of DTYPA and DTYPP.
+# BYTORDA and BYTORDP are 0 for little-endian and 1 for big-endian.
+DTYPES = {0: "i4", 2: "f8"}
+
+
+def to_int32(data):
+    """
+    Scales real-valued data such that it can be stored as 32-bit integers,
+    in the same way as TopSpin does.
+
+    Parameters
+    ----------
+    data : ndarray
+        Real-valued data.
+
+    Returns
+    -------
+    ints : ndarray
+        The scaled data, as 32-bit integers.
+    nc : int
+        The exponent used for the scaling, i.e. ``data`` is (approximately)
+        ``ints * 2 ** nc``. This is the value of NC or NC_proc.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    maxabs = np.max(np.abs(data)) if data.size else 0
+    if maxabs == 0:
+        return np.zeros(data.shape, dtype=np.int32), 0
+    nc = int(np.ceil(np.log2(maxabs / INT32_MAX)))
+    return np.round(data / 2.0 ** nc).astype(np.int32), nc
+
+
+def write_jcamp(path, pars, title="Parameter file"):
+    """
+    Writes a parameter file (acqus, procs, ...) in the JCAMP-DX format used by
+    TopSpin.
+
+    Parameters
+    ----------
+    path : |Path| or str
+        Path to the file.
+    pars : dict
+        Parameters to write. Keys are parameter names (case-insensitive).
+        Values may be numbers, strings (which are written enclosed in angle
+        brackets), or, for the array parameters in `LIST_PARAMS`, lists of
+        numbers. Parameters such as ``"P1"`` or ``"CNST20"`` are written into
+        the corresponding element of the array.
+    title : str, optional
+        Title written at the top of the file.
+    """
+    scalars, arrays = {}, {}
+    for name, value in pars.items():
+        name = name.upper()
+        stem = name.rstrip("0123456789")
+        if stem in LIST_PARAMS and stem != name:
+            index = int(name[len(stem):])
+            arrays.setdefault(stem, [0] * LIST_PARAMS[stem])[index] = value
+        elif name in LIST_PARAMS and not np.isscalar(value):
+            arrays[name] = list(value)
+        else:
+            scalars[name] = value
+
+    with open(path, "w") as fp:
+        print(f"##TITLE= {title}", file=fp)
+        print("##JCAMPDX= 5.0", file=fp)
+        for name, value in sorted(scalars.items()):
+            if isinstance(value, str):
+                value = f"<{value}>"
+            print(f"##${name}= {value}", file=fp)
+        for name, values in sorted(arrays.items()):
+            print(f"##${name}= (0..{len(values) - 1})", file=fp)
+            print(" ".join(f"{v:g}" for v in values), file=fp)
+        print("##END=", file=fp)
+
+
+def process_1d(fid, si=None):
+    """
+    Fourier transforms a FID in the same way as TopSpin's ``ft``: the FID is
+    zero-filled to *si* points, its first point is halved, and the spectrum
+    is ordered from high to low frequency. No window function or phase
+    correction is applied.
+
+    Parameters
+    ----------
+    fid : ndarray
+        Complex-valued FID.
+    si : int, optional
+        Number of points in the spectrum. Defaults to the size of the FID.
+
+    Returns
+    -------
+    ndarray
+        Complex-valued spectrum.
+    """
+    fid = np.array(fid, dtype=np.complex128)
+    si = si or fid.size
+    fid[0] = fid[0] / 2
+    return np.fft.fftshift(np.fft.fft(fid, n=si))[::-1]
+
+
+def encode(data, dtype=0, byteorder=0, nc=None):
+    """
+    Converts real-valued data to the format in which it is stored in a
+    binary file.
+
+    Parameters
+    ----------
+    data : ndarray
+        Real-valued data.
+    dtype : int, optional
+        The value of DTYPA or DTYPP: 0 for 32-bit integers, scaled by 2 ** NC
+        (see `to_int32()`), or 2 for doubles.
+    byteorder : int, optional
+        The value of BYTORDA or BYTORDP: 0 for little-endian, 1 for
+        big-endian.
+    nc : int, optional
+        For integers, the value of NC to use, instead of the one chosen by
+        `to_int32()`. This allows several arrays to share the same NC.
+
+    Returns
+    -------
+    encoded : ndarray
+        The data, with the data type to be written to the file.
+    nc : int
+        The value of NC (or NC_proc). This is always 0 for doubles.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Invalid data type {dtype}: must be 0 (int) or 2"
+                         " (double).")
+    if byteorder not in [0, 1]:
+        raise ValueError(f"Invalid byte order {byteorder}: must be 0 (little"
+                         " endian) or 1 (big endian).")
+    dt = ("<" if byteorder == 0 else ">") + DTYPES[dtype]
+    if dtype == 0 and nc is None:
+        data, nc = to_int32(data)
+    elif dtype == 0:
+        data = np.round(np.asarray(data) / 2.0 ** nc)
+    else:
+        data, nc = np.asarray(data, dtype=np.float64), 0
+    return data.astype(dt), nc
+
+
+def to_submatrices(data, xdim):
+    """
+    Rearranges a 2D spectrum into the order in which TopSpin stores it: the
+    spectrum is divided into submatrices of size *xdim*, which are stored one
+    after another (row by row), each of them being stored row by row.
+
+    Parameters
+    ----------
+    data : ndarray
+        2D array with shape ``(SI1, SI2)``.
+    xdim : tuple of int
+        The values of XDIM in F1 and F2. These must divide SI1 and SI2.
+
+    Returns
+    -------
+    ndarray
+        1D array with the points in the order in which they are stored.
+    """
+    si1, si2 = data.shape
+    xdim1, xdim2 = xdim
+    if si1 % xdim1 != 0 or si2 % xdim2 != 0:
+        raise ValueError(f"XDIM {tuple(xdim)} does not divide the size of"
+                         f" the spectrum {data.shape}.")
+    blocks = data.reshape(si1 // xdim1, xdim1, si2 // xdim2, xdim2)
+    return blocks.transpose(0, 2, 1, 3).ravel()
+
+
+def write_fid(p_expno, fid, acqus=None, acqu2s=None, dtypa=0, bytorda=0):
+    """
+    Writes the raw data and acquisition parameters of a 1D or 2D dataset.
+
+    A 1D FID is written to ``fid``, and a 2D array of FIDs (one per row) to
+    ``ser``, in which case each FID is padded with zeros to a multiple of
+    1024 bytes, as TopSpin does.
+
+    Parameters
+    ----------
+    p_expno : |Path| or str
+        Path to the expno folder. This is created if it does not exist.
+    fid : ndarray
+        Complex-valued FID, or 2D array of FIDs.
+    acqus : dict, optional
+        Acquisition parameters, which are added to (or override) the ones
+        which describe the data (e.g. ``TD``, ``NC``). At least ``SW_h``,
+        ``SFO1`` and ``O1`` should be given to get a meaningful chemical shift
+        axis.
+    acqu2s : dict, optional
+        Acquisition parameters for the indirect dimension of a 2D dataset.
+    dtypa : int, optional
+        Data type: 0 for 32-bit integers, or 2 for doubles.
+    bytorda : int, optional
+        Byte order: 0 for little-endian, or 1 for big-endian.
+    """
+    p_expno = Path(p_expno)
+    p_expno.mkdir(parents=True, exist_ok=True)
+    fid = np.asarray(fid, dtype=np.complex128)
+    if fid.ndim not in [1, 2]:
+        raise ValueError("Only 1D and 2D data can be written.")
+    # Interleaved real and imaginary points.
+    interleaved = np.stack([fid.real, fid.imag], axis=-1)
+    interleaved = interleaved.reshape(fid.shape[:-1] + (-1,))
+    td = interleaved.shape[-1]
+    data, nc = encode(interleaved, dtypa, bytorda)
+    if fid.ndim == 2:
+        row_size = -(-td * data.itemsize // 1024) * 1024 // data.itemsize
+        data = np.pad(data, [(0, 0), (0, row_size - td)])
+    data.tofile(p_expno / ("fid" if fid.ndim == 1 else "ser"))
+
+    acqus = {k.upper(): v for k, v in (acqus or {}).items()}
+    sw_h = acqus.get("SW_H", 10000.0)
+    sfo1 = acqus.get("SFO1", 500.0)
+    acqpars = {"PARMODE": fid.ndim - 1, "TD": td, "NC": nc,
+               "DTYPA": dtypa, "BYTORDA": bytorda, "GRPDLY": 0,
+               "SW_H": sw_h, "SFO1": sfo1, "BF1": sfo1,
+               "SW": sw_h / sfo1, "O1": 0.0}
+    acqpars.update(acqus)
+    write_jcamp(p_expno / "acqus", acqpars, title="Parameter file, acqus")
+    if fid.ndim == 2:
+        acqu2s = {k.upper(): v for k, v in (acqu2s or {}).items()}
+        sw_h = acqu2s.get("SW_H", sw_h)
+        sfo1 = acqu2s.get("SFO1", sfo1)
+        acqpars = {"PARMODE": 1, "TD": fid.shape[0], "SW_H": sw_h,
+                   "SFO1": sfo1, "BF1": sfo1, "SW": sw_h / sfo1, "O1": 0.0}
+        acqpars.update(acqu2s)
+        write_jcamp(p_expno / "acqu2s", acqpars,
+                    title="Parameter file, acqu2s")
+
+
+def write_1d(p_expno, fid, acqus=None, procs=None, procno=1, dtypa=0,
+             bytorda=0, dtypp=0, bytordp=0):
+    """
+    Writes a 1D dataset. The FID is processed using `process_1d`, and both
+    the FID and the spectrum are written.
+
+    Parameters
+    ----------
+    p_expno : |Path| or str
+        Path to the expno folder. This is created if it does not exist.
+    fid : ndarray
+        Complex-valued FID.
+    acqus : dict, optional
+        Acquisition parameters (see `write_fid()`).
+    procs : dict, optional
+        Processing parameters, which are added to (or override) the ones which
+        describe the data (e.g. ``SI``, ``NC_proc``).
+    procno : int, optional
+        The procno to write the spectrum to.
+    dtypa, bytorda : int, optional
+        Data type and byte order of the FID (see `write_fid()`).
+    dtypp, bytordp : int, optional
+        Data type and byte order of the spectrum (see `write_spectrum()`).
+
+    Returns
+    -------
+    |Path|
+        Path to the procno folder.
+    """
+    acqus = {k.upper(): v for k, v in (acqus or {}).items()}
+    procs = {k.upper(): v for k, v in (procs or {}).items()}
+    fid = np.asarray(fid, dtype=np.complex128)
+    write_fid(p_expno, fid, acqus=acqus, dtypa=dtypa, bytorda=bytorda)
+    spec = process_1d(fid, int(procs.get("SI", fid.size)))
+    return write_spectrum(p_expno, spec, acqus=acqus, procs=procs,
+                          procno=procno, dtypp=dtypp, bytordp=bytordp)
+
+
+def write_spectrum(p_expno, spec, acqus=None, procs=None, proc2s=None,
+                   procno=1, xdim=None, dtypp=0, bytordp=0):
+    """
+    Writes a processed 1D or 2D spectrum and its processing parameters.
+
+    A 1D spectrum is written to ``1r`` and ``1i``. A 2D spectrum is written
+    to ``2rr``, and if it is hypercomplex, also to ``2ri``, ``2ir`` and
+    ``2ii``; all of these are divided into submatrices (see
+    `to_submatrices()`). The intensities of all the files are scaled by the
+    same ``NC_proc``.
+
+    Parameters
+    ----------
+    p_expno : |Path| or str
+        Path to the expno folder.
+    spec : ndarray or dict
+        For 1D spectra, a complex-valued array. For 2D spectra, either a
+        real-valued 2D array with shape ``(SI1, SI2)`` (the F1 axis going
+        down the rows, and both axes from high to low frequency), which is
+        written to ``2rr``, or a dict of such arrays keyed by the file name
+        (``"2rr"``, ``"2ri"``, ``"2ir"``, ``"2ii"``).
+    acqus : dict, optional
+        The acquisition parameters, from which ``SF``, ``SW_p`` and
+        ``OFFSET`` are calculated (for a 2D spectrum, those of the direct
+        dimension). Not written.
+    procs : dict, optional
+        Processing parameters, which are added to (or override) the ones
+        which describe the data (e.g. ``SI``, ``NC_proc``).
+    proc2s : dict, optional
+        Processing parameters for the indirect dimension of a 2D spectrum.
+        ``SF``, ``SW_p`` and ``OFFSET`` in F1 should be given here.
+    procno : int, optional
+        The procno to write the spectrum to.
+    xdim : tuple of int, optional
+        Size of the submatrices (``XDIM``) of a 2D spectrum, in F1 and F2.
+        Defaults to the whole spectrum, i.e. no submatrices.
+    dtypp : int, optional
+        Data type: 0 for 32-bit integers, or 2 for doubles.
+    bytordp : int, optional
+        Byte order: 0 for little-endian, or 1 for big-endian.
+
+    Returns
+    -------
+    |Path|
+        Path to the procno folder.
+    """
+    p_procno = Path(p_expno) / "pdata" / str(procno)
+    p_procno.mkdir(parents=True, exist_ok=True)
+    acqus = {k.upper(): v for k, v in (acqus or {}).items()}
+    procs = {k.upper(): v for k, v in (procs or {}).items()}
+    if isinstance(spec, dict):
+        parts = {k: np.asarray(v, dtype=np.float64) for k, v in spec.items()}
+    else:
+        spec = np.asarray(spec)
+        if spec.ndim == 1:
+            spec = spec.astype(np.complex128)
+            parts = {"1r": spec.real, "1i": spec.imag}
+        else:
+            parts = {"2rr": spec.astype(np.float64)}
+    shape = next(iter(parts.values())).shape
+    if len(shape) == 2:
+        xdim = tuple(xdim or shape)
+        parts = {k: to_submatrices(v, xdim) for k, v in parts.items()}
+
+    # All the files must use the same NC_proc.
+    _, nc_proc = encode(np.concatenate(list(parts.values())), dtypp, bytordp)
+    for fname, part in parts.items():
+        encoded, _ = encode(part, dtypp, bytordp, nc=nc_proc)
+        encoded.tofile(p_procno / fname)
+
+    sfo1 = acqus.get("SFO1", 500.0)
+    sw_h = acqus.get("SW_H", 10000.0)
+    o1p = acqus.get("O1", 0.0) / sfo1
+    procpars = {"SI": shape[-1], "NC_PROC": nc_proc, "DTYPP": dtypp,
+                "BYTORDP": bytordp, "SF": sfo1, "SW_P": sw_h,
+                "OFFSET": o1p + 0.5 * sw_h / sfo1, "F1P": 0, "F2P": 0,
+                "PHC0": 0, "PHC1": 0}
+    if len(shape) == 2:
+        procpars["XDIM"] = xdim[1]
+    procpars.update(procs)
+    write_jcamp(p_procno / "procs", procpars, title="Parameter file, procs")
+    if len(shape) == 2:
+        proc2pars = {"SI": shape[0], "XDIM": xdim[0], "NC_PROC": nc_proc,
+                     "DTYPP": dtypp, "BYTORDP": bytordp, "SF": sfo1,
+                     "SW_P": sw_h, "OFFSET": o1p + 0.5 * sw_h / sfo1,
+                     "F1P": 0, "F2P": 0, "PHC0": 0, "PHC1": 0}
+        proc2pars.update({k.upper(): v for k, v in (proc2s or {}).items()})
+        write_jcamp(p_procno / "proc2s", proc2pars,
+                    title="Parameter file, proc2s")
+    return p_procno
+
+
+def write_2d(p_expno, spec, ser=None, acqus=None, acqu2s=None, procs=None,
+             proc2s=None, procno=1, xdim=None, dtypa=0, bytorda=0, dtypp=0,
+             bytordp=0):
+    """
+    Writes a 2D dataset.
+
+    Unlike for `write_1d()`, the spectrum is not calculated from the raw
+    data, but has to be given. If no raw data are given, a ``ser`` file
+    containing zeros is written.
+
+    Parameters
+    ----------
+    p_expno : |Path| or str
+        Path to the expno folder. This is created if it does not exist.
+    spec : ndarray or dict
+        The spectrum (see `write_spectrum()`).
+    ser : ndarray, optional
+        Complex-valued raw data, with one FID per row.
+    acqus, acqu2s : dict, optional
+        Acquisition parameters of the direct and indirect dimensions. At
+        least ``SW_h``, ``SFO1`` and ``O1`` should be given for both.
+    procs, proc2s : dict, optional
+        Processing parameters of the direct and indirect dimensions.
+    procno : int, optional
+        The procno to write the spectrum to.
+    xdim : tuple of int, optional
+        Size of the submatrices in F1 and F2.
+    dtypa, bytorda, dtypp, bytordp : int, optional
+        Data types and byte orders of the raw data and the spectrum.
+
+    Returns
+    -------
+    |Path|
+        Path to the procno folder.
+    """
+    acqus = {k.upper(): v for k, v in (acqus or {}).items()}
+    acqu2s = {k.upper(): v for k, v in (acqu2s or {}).items()}
+    shape = np.shape(spec if not isinstance(spec, dict)
+                     else next(iter(spec.values())))
+    if ser is None:
+        ser = np.zeros((shape[0], shape[1]), dtype=np.complex128)
+    write_fid(p_expno, ser, acqus=acqus, acqu2s=acqu2s, dtypa=dtypa,
+              bytorda=bytorda)
+    # SF, SW_p and OFFSET in F1 are calculated from acqu2s.
+    sfo1 = acqu2s.get("SFO1", acqus.get("SFO1", 500.0))
+    sw_h = acqu2s.get("SW_H", acqus.get("SW_H", 10000.0))
+    o1p = acqu2s.get("O1", 0.0) / sfo1
+    proc2s = dict({"SF": sfo1, "SW_P": sw_h,
+                   "OFFSET": o1p + 0.5 * sw_h / sfo1},
+                  **{k.upper(): v for k, v in (proc2s or {}).items()})
+    return write_spectrum(p_expno, spec, acqus=acqus, procs=procs,
+                          proc2s=proc2s, procno=procno, xdim=xdim,
+                          dtypp=dtypp, bytordp=bytordp)
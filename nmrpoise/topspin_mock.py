@@ -0,0 +1,418 @@
+"""
+topspin_mock.py
+---------------
+
+Pure-Python stand-in for the parts of TopSpin which the frontend (poise.py)
+uses. `MockTopSpin` sets up a fake TopSpin installation (with the frontend,
+backend and AU programmes installed in the usual places) and a fake dataset
+tree, and implements TopSpin's Python builtins (``XCMD``, ``GETPAR``,
+``PUTPAR``, ``CURDATA``, ...) on top of these. The frontend can then be run
+under CPython, which allows the whole optimisation loop to be tested, and its
+overhead to be measured, without a spectrometer.
+
+AU programmes are replaced by Python functions, which by default write a
+synthetic spectrum calculated from a model of the experiment (see
+simulate.py).
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+import re
+import sys
+import types
+import runpy
+import platform
+from shutil import copy2 as cp
+from time import perf_counter, sleep
+from pathlib import Path
+
+from .simulate import Experiment, Line
+from .topspin_install import cp_r
+
+
+# Modules imported by the frontend which only exist inside TopSpin.
+JAVA_MODULES = ["de", "de.bruker", "de.bruker.nmr", "de.bruker.nmr.mfw",
+                "de.bruker.nmr.mfw.root", "de.bruker.nmr.mfw.root.UtilPath",
+                "de.bruker.nmr.prsc", "de.bruker.nmr.prsc.dbxml",
+                "de.bruker.nmr.prsc.dbxml.ParfileLocator",
+                "java", "java.lang", "java.lang.System"]
+# TopSpin's return value for a dialog box which was closed with Escape.
+ESCAPE = -27
+
+
+class MockTopSpin():
+    """
+    A fake TopSpin installation and dataset tree, together with
+    implementations of the TopSpin builtins used by the frontend.
+
+    The folder *p_root* ends up containing two subfolders: ``topspin``, which
+    is the TopSpin installation (``poise.py`` and ``poise_backend`` are
+    installed to ``topspin/exp/stan/nmr/py/user``, so routines and the run
+    database are also kept there), and ``data``, which contains the dataset.
+    The dataset starts off with a single expno (1), which contains a
+    spectrum acquired with the default parameters of the experiment.
+
+    Acquisition parameters are kept in memory, as strings, separately for
+    every expno. ``PUTPAR`` and ``GETPAR`` use the foreground parameters,
+    and every AU programme copies these to the status parameters (read by
+    ``GETPARSTAT``) once it has finished, as TopSpin does after a complete
+    acquisition.
+
+    Parameters
+    ----------
+    p_root : |Path| or str
+        Folder in which the installation and the data are created.
+    experiment : Experiment, optional
+        Model of the experiment, used by the default AU programmes to
+        calculate the spectra. Defaults to a single noiseless line with a 90°
+        pulse of 12 µs. The model's default parameters are the initial
+        acquisition parameters of the dataset.
+    name : str, optional
+        The name of the dataset.
+    pulprog : str, optional
+        The pulse programme (which is created in the user pulse programme
+        directory if it does not already exist).
+    dialogs : list, optional
+        Scripted answers to dialog boxes, in order. ``SELECT`` takes the
+        index of a button, and ``INPUT_DIALOG`` a list of strings. Once the
+        answers are used up, all dialog boxes are closed without an answer.
+
+    Attributes
+    ----------
+    au_programmes : dict
+        Functions which are run instead of AU programmes, keyed by the name of
+        the AU programme. They are called with the `MockTopSpin` as their only
+        argument. ``poise_1d``, ``poise_1d_noapk`` and ``poisecal`` are
+        preset to `acquire()`; others can be added (or replaced) before
+        calling `run()`.
+    messages : list of (str, str)
+        The title and text of every message shown (``MSG``, and non-modal
+        messages).
+    errors : list of (str, str)
+        The title and text of every error message shown (``ERRMSG``).
+    texts : list of (str, str)
+        The title and text of every text window shown (``VIEWTEXT``).
+    commands : list of str
+        Every command executed using ``XCMD``.
+    au_times : list of (float, float)
+        The start and end times (from `time.perf_counter()`) of every AU
+        programme run in the last call to `run()`.
+    """
+    def __init__(self, p_root, experiment=None, name="poise_test",
+                 pulprog="zg", dialogs=None):
+        p_root = Path(p_root).resolve()
+        self.p_home = p_root / "topspin"
+        self.p_user = self.p_home / "exp/stan/nmr/py/user"
+        self.p_frontend = self.p_user / "poise.py"
+        self.p_poise = self.p_user / "poise_backend"
+        self.p_au = self.p_home / "exp/stan/nmr/au/src/user"
+        self.p_pp = self.p_home / "exp/stan/nmr/lists/pp/user"
+        self.p_data = p_root / "data"
+        self.experiment = experiment or Experiment([Line(1.0, 3.0)], p90=12.0)
+        self.au_programmes = {"poise_1d": MockTopSpin.acquire,
+                              "poise_1d_noapk": MockTopSpin.acquire,
+                              "poisecal": MockTopSpin.acquire}
+        self.messages = []
+        self.errors = []
+        self.texts = []
+        self.commands = []
+        self.au_times = []
+        self.dialogs = list(dialogs or [])
+        self.install(pulprog)
+
+        # Parameters of each expno: {expno: {"fg": {...}, "status": {...}}}.
+        # Keys are (name, axis) tuples, e.g. ("P1", 0) or ("TD", 1).
+        self.pars = {}
+        self.dataset = [name, "1", "1", str(self.p_data), "user"]
+        fg = {(k, 0): _format(v)
+              for k, v in self.experiment.acquisition_pars().items()}
+        fg[("PULPROG", 0)] = pulprog
+        self.pars["1"] = {"fg": fg, "status": {}}
+        self.acquire()
+
+    def install(self, pulprog):
+        """
+        Installs the frontend, backend and AU programmes into the fake
+        TopSpin installation, like topspin_install.py does.
+        """
+        dirname = Path(__file__).parent.resolve()
+        self.p_user.mkdir(parents=True, exist_ok=True)
+        # Point the frontend at the current Python executable.
+        with open(dirname / "poise.py", "r") as infile, \
+                open(self.p_frontend, "w") as outfile:
+            for line in infile:
+                if line.startswith("p_python3 = "):
+                    line = f"p_python3 = r\"{Path(sys.executable)}\""
+                print(line.rstrip(), file=outfile)
+        cp_r(dirname / "poise_backend", self.p_poise)
+        if not (self.p_poise / "costfunctions_user.py").exists():
+            cp(dirname / "poise_backend" / "costfunctions_user.py",
+               self.p_poise / "costfunctions_user.py")
+        self.p_au.mkdir(parents=True, exist_ok=True)
+        for au in self.au_programmes:
+            cp(dirname / "au" / au, self.p_au / au)
+        self.p_pp.mkdir(parents=True, exist_ok=True)
+        if not (self.p_pp / pulprog).exists():
+            (self.p_pp / pulprog).write_text("; pulse programme\n")
+
+    def run(self, *args, timeout=10):
+        """
+        Runs the frontend with the given command-line arguments, e.g.
+        ``run("p1cal", "-a", "nm")``.
+
+        The frontend exits as soon as it has received the optimum, while the
+        backend is still writing to ``poise.log``, so this then waits (for at
+        most *timeout* seconds) until the backend has exited too, i.e. until
+        its ``.pid`` file has been removed. (With ``--daemon``, the frontend
+        itself waits for the daemon to finish.)
+
+        `au_times` is cleared at the start of each run, so that `overheads`
+        refers to the last run only.
+        """
+        self.au_times = []
+        self._run_frontend(args, timeout)
+
+    def _run_frontend(self, args, timeout=10):
+        """
+        Runs the frontend. This is also used for ``XCMD("xpy poise ...")``.
+        """
+        # The frontend checks that the AU programmes exist, although they
+        # are never really run.
+        for au in self.au_programmes:
+            if not (self.p_au / au).exists():
+                (self.p_au / au).write_text("QUIT\n")
+        saved_argv = sys.argv
+        saved_modules = {name: sys.modules.get(name) for name in JAVA_MODULES}
+        sys.argv = ["poise"] + [str(arg) for arg in args]
+        sys.modules.update(self._java_modules())
+        try:
+            runpy.run_path(str(self.p_frontend), init_globals=self.builtins(),
+                           run_name="__main__")
+        except SystemExit:
+            pass
+        finally:
+            sys.argv = saved_argv
+            for name, module in saved_modules.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+        deadline = perf_counter() + timeout
+        while self.backends() and perf_counter() < deadline:
+            sleep(0.01)
+
+    def backends(self):
+        """
+        Returns the paths to the ``.pid`` files of the backends which are
+        running, not including the daemon (whose ``.pid`` file is not empty).
+        """
+        return [p for p in self.p_poise.glob(".pid*")
+                if _read_pidfile(p) == ""]
+
+    def daemons(self):
+        """
+        Returns the paths to the ``.pid`` files of the backend daemons which
+        are running.
+        """
+        return [p for p in self.p_poise.glob(".pid*")
+                if (_read_pidfile(p) or "").startswith("daemon")]
+
+    def builtins(self):
+        """
+        Returns a dict of the TopSpin builtins, which is used as the globals
+        of the frontend.
+        """
+        mock = self
+
+        class BInfo():
+            # The dialog used for non-modal messages.
+            def setMessage(self, message):
+                self.message = message
+
+            def setTitle(self, title):
+                self.title = title
+
+            def setBlocking(self, blocking):
+                pass
+
+            def show(self):
+                mock.messages.append((self.title, self.message))
+
+        return {"XCMD": self.XCMD, "PUTPAR": self.PUTPAR,
+                "GETPAR": self.GETPAR, "GETPARSTAT": self.GETPARSTAT,
+                "GETACQUDIM": self.GETACQUDIM, "RE": self.RE,
+                "RE_IEXPNO": self.RE_IEXPNO, "CURDATA": self.CURDATA,
+                "MSG": self.MSG, "ERRMSG": self.ERRMSG,
+                "VIEWTEXT": self.VIEWTEXT, "SELECT": self.SELECT,
+                "INPUT_DIALOG": self.INPUT_DIALOG, "EXIT": self.EXIT,
+                "mfw": types.SimpleNamespace(BInfo=BInfo),
+                "Error": JavaError}
+
+    def _java_modules(self):
+        """
+        Returns fake versions of the Java modules imported by the frontend.
+        """
+        modules = {name: types.ModuleType(name) for name in JAVA_MODULES}
+        modules["de.bruker.nmr.mfw.root.UtilPath"].getTopspinHome = \
+            lambda: str(self.p_home)
+        # 0 is the pulse programme directories, 2 the AU directories.
+        dirs = {0: [str(self.p_pp)], 2: [str(self.p_au)]}
+        modules["de.bruker.nmr.prsc.dbxml.ParfileLocator"].getParfileDirs = \
+            lambda i: dirs.get(i, [])
+        modules["java.lang.System"].getProperty = \
+            lambda name: {"os.name": platform.system()}.get(name, "")
+        return modules
+
+    @property
+    def p_expno(self):
+        """
+        Path to the current expno folder.
+        """
+        return self.p_data / self.dataset[0] / self.dataset[1]
+
+    def acquire(self):
+        """
+        The default AU programme. Acquires a spectrum with the model of the
+        experiment, using the current acquisition parameters (all those with
+        numerical values), and writes it to the current expno.
+        """
+        fg = self.pars[self.dataset[1]]["fg"]
+        values = {}
+        for (name, axis), value in fg.items():
+            try:
+                if axis == 0:
+                    values[name] = float(value)
+            except ValueError:
+                pass
+        self.experiment.write(self.p_expno,
+                              self.experiment.acquisition_pars(values))
+        self.pars[self.dataset[1]]["status"] = dict(fg)
+
+    @property
+    def overheads(self):
+        """
+        The time elapsed between the end of each AU programme and the start of
+        the next one, i.e. the time taken by the frontend and backend in each
+        iteration of the optimisation (apart from acquisition).
+        """
+        return [start - end for (_, end), (start, _)
+                in zip(self.au_times[:-1], self.au_times[1:])]
+
+    def XCMD(self, cmd, *args, **kwargs):
+        """
+        Executes a TopSpin command. Only ``xau``, ``iexpno``, and ``xpy poise
+        ...`` do anything; other commands are just recorded.
+        """
+        self.commands.append(cmd)
+        words = cmd.split()
+        if words[0] == "xau":
+            if words[1] not in self.au_programmes:
+                raise RuntimeError(f"AU programme {words[1]} not found.")
+            start = perf_counter()
+            self.au_programmes[words[1]](self)
+            self.au_times.append((start, perf_counter()))
+        elif words[0] == "iexpno":
+            self._iexpno()
+        elif words[:2] == ["xpy", "poise"]:
+            self._run_frontend(words[2:])
+
+    def _iexpno(self):
+        """
+        Creates the next expno with the same parameters as the current one,
+        and makes it the current dataset.
+        """
+        new_expno = str(int(self.dataset[1]) + 1)
+        p_new = self.p_data / self.dataset[0] / new_expno
+        p_new.mkdir(parents=True)
+        if (self.p_expno / "acqus").exists():
+            cp(self.p_expno / "acqus", p_new / "acqus")
+        p_procno = Path("pdata") / self.dataset[2]
+        if (self.p_expno / p_procno / "procs").exists():
+            (p_new / p_procno).mkdir(parents=True)
+            cp(self.p_expno / p_procno / "procs", p_new / p_procno / "procs")
+        self.pars[new_expno] = {k: dict(v)
+                                for k, v in self.pars[self.dataset[1]].items()}
+        self.dataset[1] = new_expno
+
+    def PUTPAR(self, name, value):
+        self._pars("fg")[_key(name)] = str(value)
+
+    def GETPAR(self, name, axis=0):
+        return self._pars("fg").get(_key(name, axis), "")
+
+    def GETPARSTAT(self, name, axis=0):
+        return self._pars("status").get(_key(name, axis), "")
+
+    def _pars(self, kind):
+        return self.pars.setdefault(self.dataset[1],
+                                    {"fg": {}, "status": {}})[kind]
+
+    def GETACQUDIM(self):
+        return 1
+
+    def CURDATA(self):
+        return list(self.dataset)
+
+    def RE(self, dataset, show="y"):
+        self.dataset = [str(x) for x in dataset]
+
+    def RE_IEXPNO(self, show="y"):
+        self.dataset[1] = str(int(self.dataset[1]) + 1)
+
+    def MSG(self, message="", title=None):
+        self.messages.append((title, message))
+
+    def ERRMSG(self, message="", title=None, details=None, modal=0):
+        self.errors.append((title, message))
+
+    def VIEWTEXT(self, title="", header="", text="", modal=1):
+        self.texts.append((title, text))
+
+    def SELECT(self, title="", message="", buttons=None, mnemonics=None):
+        return self.dialogs.pop(0) if self.dialogs else ESCAPE
+
+    def INPUT_DIALOG(self, title="", header="", items=None, values=None,
+                     comments=None, types=None, mnemonics=None, columns=30):
+        return self.dialogs.pop(0) if self.dialogs else None
+
+    def EXIT(self):
+        raise SystemExit()
+
+
+class JavaError(Exception):
+    """
+    Stand-in for java.lang.Error, which the frontend catches in order to clean
+    up when it is killed from within TopSpin.
+    """
+
+
+def _key(name, axis=0):
+    """
+    Converts a parameter name as accepted by GETPAR() and PUTPAR() (e.g.
+    "CNST 1", "PLdB 1", "1 TD") to a (name, axis) tuple, e.g. ("CNST1", 0).
+    """
+    name = name.strip()
+    m = re.match(r"(\d)\s+(\S+)$", name)
+    if m:
+        axis, name = int(m.group(1)), m.group(2)
+    return name.replace(" ", "").upper(), axis
+
+
+def _format(value):
+    """
+    Formats a parameter value as TopSpin would show it.
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _read_pidfile(p_pidfile):
+    """
+    Returns the contents of a ``.pid`` file, or None if it has just been
+    removed.
+    """
+    try:
+        return p_pidfile.read_text()
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,21 @@
+import pytest
+
+
+@pytest.fixture
+def p1cal():
+    """
+    The p1cal routine (see the example routines), as a dict. The optimum is
+    at four times the 90° pulse of the simulated experiment.
+    """
+    return {"name": "p1cal", "pars": ["p1"], "lb": [40.0], "ub": [56.0],
+            "init": [48.0], "tol": [0.2], "cf": "minabsint", "au": "poise_1d"}
+
+
+@pytest.fixture
+def p1cal_args(p1cal):
+    """
+    The arguments to ``poise --create`` which create the p1cal routine.
+    """
+    return [p1cal["name"], p1cal["pars"][0]] + [
+        f"{p1cal[key][0]:g}" for key in ["lb", "ub", "init", "tol"]
+    ] + [p1cal["cf"], p1cal["au"]]
@@ -1,7 +1,9 @@
 import os
+from datetime import datetime, timedelta
 from pathlib import Path
 
 import numpy as np
+import pytest
 
 from nmrpoise.poise_backend import backend as be
 
@@ -19,6 +21,10 @@ def test_get_routine_cf():
     assert routine.tol == [0.2]
     assert routine.cf == "minabsint"
     assert routine.au == "poise_1d"
+    assert routine.constraints is None
+    assert routine.transforms is None
+    assert routine.target is None
+    assert routine.stagnation is None
 
 
 def test_pidfile():
@@ -33,3 +39,487 @@ def test_pidfile():
         assert pid_fname.exists()
     # Check that it is deleted.
     assert not pid_fname.exists()
+
+
+def test_get_previous_optimum(tmp_path):
+    p_routine_dir = Path(__file__).parent / "test_data"
+    routine, _ = be.get_routine_cf("p1cal", p_routine_dir)
+    p_optlog = tmp_path / "poise.log"
+    assert be.get_previous_optimum(routine, p_optlog) is None
+
+    def run_header(name, cf):
+        return ("\n\n\n\n========================================\n"
+                "2021-05-01 12:00:00\n"
+                f"Routine name              - {name}\n"
+                "Optimisation parameters   - ['p1']\n"
+                f"Cost function             - {cf}\n"
+                "AU programme              - poise_1d\n"
+                "Initial values            - [48]\n"
+                "Lower bounds              - [40]\n"
+                "Upper bounds              - [56]\n"
+                "Tolerances                - [0.2]\n"
+                "Optimisation algorithm    - brent\n\n"
+                "    p1          cf     \n"
+                "------------------------\n"
+                " 48.0000    5000.0000  \n")
+
+    def run_footer(xbest):
+        return ("\n"
+                f"Best values found           - [{xbest}]\n"
+                "Cost function at minimum    - 3000.0\n"
+                "Number of spectra ran       - 9\n"
+                "Total time taken            - 0:01:10\n")
+
+    with open(p_optlog, "w") as fp:
+        fp.write(run_header("p1cal", "minabsint") + run_footer(47.5))
+        fp.write(run_header("p1cal", "minabsint") + run_footer(48.125))
+        # Different cost function: should be ignored
+        fp.write(run_header("p1cal", "maxabsint") + run_footer(45.0))
+        # Incomplete run: should be ignored
+        fp.write(run_header("p1cal", "minabsint"))
+    assert be.get_previous_optimum(routine, p_optlog) == [48.125]
+
+
+def test_parse_format_fidelity():
+    assert be.parse_fidelity("") == {}
+    fidelity = be.parse_fidelity("NS=1 DS=0")
+    assert fidelity == {"NS": "1", "DS": "0"}
+    assert be.format_fidelity(fidelity) == "NS=1 DS=0"
+
+
+def test_check_fidelity():
+    be.check_fidelity({}, 1)
+    be.check_fidelity({"NS": "1"}, 1)
+    be.check_fidelity({"NS": "2", "TD1": "4"}, 2)
+    with pytest.raises(ValueError, match="2D"):
+        be.check_fidelity({"TD1": "4"}, 1)
+    with pytest.raises(ValueError, match="Invalid value"):
+        be.check_fidelity({"NS": "0"}, 1)
+    with pytest.raises(ValueError, match="cannot be overridden"):
+        be.check_fidelity({"PULPROG": "zg"}, 1)
+
+
+@pytest.fixture
+def fake_frontend(tmp_path, monkeypatch):
+    """
+    Replaces the frontend with a function that records the points which the
+    backend asks to acquire, and answers "done". Returns the list of points.
+    By default the cost function is (x - 5)^2 summed over all parameters, but
+    another function of the point can be passed to start(). The clock
+    seen by the backend is also faked, and every spectrum takes one minute.
+    """
+    from nmrpoise.poise_backend.shared import _g
+    # Make sure that the global state is restored afterwards.
+    for attr in ["optimiser", "p_spectrum", "p_optlog", "p_checkpoint",
+                 "checkpoint_settings", "replay", "xvals", "fvals",
+                 "fidelities", "fidelity", "nfev", "violation", "maxfev",
+                 "maxtime", "t_start", "eval_times", "separable", "groups",
+                 "refine", "restarts"]:
+        monkeypatch.setattr(_g, attr, getattr(_g, attr))
+
+    clock = [datetime(2021, 5, 1, 12, 0, 0)]
+
+    class FakeDatetime(datetime):
+        @classmethod
+        def now(cls):
+            return clock[0]
+
+    monkeypatch.setattr(be, "datetime", FakeDatetime)
+
+    p_spectrum = tmp_path / "1" / "pdata" / "1"
+    p_spectrum.mkdir(parents=True)
+    acquired = []
+    frontend_replies = []
+
+    def fake_print(*args, **kwargs):
+        if "file" in kwargs:
+            print(*args, **kwargs)
+        elif args[0].startswith("values:"):
+            acquired.append([float(v) for v in args[0].split()[1:]])
+            frontend_replies.extend(["done", str(p_spectrum)])
+
+    def fake_input():
+        reply = frontend_replies.pop(0)
+        if reply == "done":
+            clock[0] += timedelta(minutes=1)
+        return reply
+
+    monkeypatch.setattr(be, "print", fake_print, raising=False)
+    monkeypatch.setattr("builtins.input", fake_input)
+
+    cost = [None]
+
+    def cost_function():
+        return cost[0](np.array(acquired[-1]))
+
+    def start(optimiser, routine, replay=(), maxtime=0, separable=False,
+              cost_fn=None, restarts=0):
+        cost[0] = cost_fn or (lambda x: np.sum((x - 5) ** 2))
+        _g.optimiser = optimiser
+        _g.p_spectrum = p_spectrum
+        _g.p_optlog = tmp_path / "1" / "poise.log"
+        _g.p_checkpoint = tmp_path / "1" / be.CHECKPOINT_FNAME
+        _g.checkpoint_settings = {"routine": routine._asdict()}
+        _g.replay = list(replay)
+        _g.xvals, _g.fvals, _g.fidelities, _g.fidelity = [], [], [], {}
+        _g.violation = None
+        _g.maxfev, _g.maxtime = 0, maxtime
+        _g.t_start, _g.eval_times = clock[0], []
+        _g.separable, _g.groups = separable, None
+        _g.restarts = restarts
+        if routine.constraints:
+            _g.violation = be.make_violation_function(routine.constraints,
+                                                      routine.pars)
+        be.acquire_nmr.calls = 0
+        acquired.clear()
+        return (cost_function, routine)
+
+    fake_frontend.start = start
+    fake_frontend.acquired = acquired
+    return fake_frontend
+
+
+def test_checkpoint_resume(fake_frontend):
+    from nmrpoise.poise_backend.optpoise import nelder_mead, scale
+    from nmrpoise.poise_backend.shared import _g
+
+    routine = be.Routine(name="test", pars=["p1", "p2"], lb=[0, 0],
+                         ub=[10, 10], init=[3, 4], tol=[0.1, 0.1],
+                         cf="test", au="poise_1d")
+    x0, lb, ub, xtol = scale(routine.init, routine.lb, routine.ub,
+                             routine.tol, scaleby="tols")
+    acquired = fake_frontend.acquired
+
+    def run(maxfev, replay=()):
+        args = fake_frontend.start("nm", routine, replay)
+        return nelder_mead(be.acquire_nmr, x0, xtol, lb, ub,
+                           args=args, maxfev=maxfev)
+
+    # Uninterrupted run.
+    full = run(maxfev=0)
+    n_full = len(acquired)
+    # Interrupted run, after which the checkpoint should exist.
+    run(maxfev=6)
+    checkpoint = be.load_checkpoint(_g.p_checkpoint)
+    assert len(checkpoint["history"]) == 6
+    assert checkpoint["routine"] == routine._asdict()
+    # Resumed run: only the remaining spectra should be acquired, and the
+    # result should be exactly the same.
+    resumed = run(maxfev=0, replay=checkpoint["history"])
+    assert len(acquired) == n_full - 6
+    assert np.array_equal(resumed.xbest, full.xbest)
+    assert len(_g.fvals) == n_full
+    be.remove_checkpoint()
+    assert not _g.p_checkpoint.exists()
+
+
+@pytest.mark.parametrize("optimiser", ["nm", "mds", "bobyqa"])
+def test_constraints(optimiser, fake_frontend):
+    from nmrpoise.poise_backend.optpoise import (scale, nelder_mead,
+                                                 multid_search,
+                                                 pybobyqa_interface)
+    # The unconstrained optimum (5, 5) is infeasible.
+    routine = be.Routine(name="test", pars=["p1", "p2"], lb=[0, 0],
+                         ub=[10, 10], init=[3, 4], tol=[0.1, 0.1],
+                         cf="test", au="poise_1d",
+                         constraints=["p1 + p2 <= 8"])
+    x0, lb, ub, xtol = scale(routine.init, routine.lb, routine.ub,
+                             routine.tol, scaleby="tols")
+    optimfn = {"nm": nelder_mead, "mds": multid_search,
+               "bobyqa": pybobyqa_interface}[optimiser]
+    args = fake_frontend.start(optimiser, routine)
+    opt_result = optimfn(be.acquire_nmr, x0, xtol, lb, ub, args=args)
+    be.remove_checkpoint()
+
+    # Infeasible points are never acquired, and don't count as spectra.
+    acquired = fake_frontend.acquired
+    assert len(acquired) > 0
+    assert all(sum(x) <= 8 + 1e-9 for x in acquired)
+    assert be.acquire_nmr.calls == len(acquired)
+    # The constrained optimum is (4, 4).
+    xbest = be.unscale(opt_result.xbest, routine.lb, routine.ub,
+                       routine.tol, scaleby="tols")
+    assert np.allclose(xbest, [4, 4], atol=0.5)
+
+
+def test_apply_steps():
+    routine = be.Routine(name="test", pars=["l3", "p1", "d8"],
+                         lb=[1, 40, 0.01], ub=[20, 56, 2],
+                         init=[8, 48, 0.3], tol=[0.5, 0.2, 0.05],
+                         cf="test", au="poise_1d",
+                         transforms=[None, None, "log"],
+                         steps=[1, 0.0125, 0.1])
+    assert be.apply_steps(routine).tol == [1, 0.2, 0.05]
+    no_steps = routine._replace(steps=None)
+    assert be.apply_steps(no_steps) is no_steps
+    with pytest.raises(ValueError, match="no multiples"):
+        be.apply_steps(routine._replace(steps=[100, None, None]))
+    with pytest.raises(ValueError, match="positive"):
+        be.apply_steps(routine._replace(steps=[-1, None, None]))
+    with pytest.raises(ValueError, match="steps were given"):
+        be.apply_steps(routine._replace(steps=[1]))
+
+
+@pytest.mark.parametrize("optimiser", ["nm", "mds", "bobyqa"])
+def test_discrete_parameters(optimiser, fake_frontend):
+    from nmrpoise.poise_backend.optpoise import (scale, nelder_mead,
+                                                 multid_search,
+                                                 pybobyqa_interface)
+    routine = be.Routine(name="test", pars=["l3", "l4"], lb=[0, 0],
+                         ub=[12, 12], init=[1, 9], tol=[0.1, 0.1],
+                         cf="test", au="poise_1d", steps=[1, 1])
+    routine = be.apply_steps(routine)
+    x0, lb, ub, xtol = scale(routine.init, routine.lb, routine.ub,
+                             routine.tol, scaleby="tols")
+    optimfn = {"nm": nelder_mead, "mds": multid_search,
+               "bobyqa": pybobyqa_interface}[optimiser]
+    args = fake_frontend.start(optimiser, routine)
+    opt_result = optimfn(be.acquire_nmr, x0, xtol, lb, ub, args=args)
+    be.remove_checkpoint()
+
+    # Only integers are acquired, and never twice.
+    acquired = fake_frontend.acquired
+    assert all(float(v).is_integer() for x in acquired for v in x)
+    assert len({tuple(x) for x in acquired}) == len(acquired)
+    assert be.acquire_nmr.calls == len(acquired)
+    xbest = be.unscale(opt_result.xbest, routine.lb, routine.ub,
+                       routine.tol, scaleby="tols")
+    assert np.allclose(xbest, [5, 5], atol=1)
+
+
+def test_time_budget(fake_frontend):
+    from nmrpoise.poise_backend.optpoise import (
+        scale, nelder_mead, MESSAGE_OPT_PREMATURE_TERMINATION)
+    from nmrpoise.poise_backend.shared import _g
+    routine = be.Routine(name="test", pars=["p1", "p2"], lb=[0, 0],
+                         ub=[10, 10], init=[1, 9], tol=[0.01, 0.01],
+                         cf="test", au="poise_1d")
+    x0, lb, ub, xtol = scale(routine.init, routine.lb, routine.ub,
+                             routine.tol, scaleby="tols")
+    # Each spectrum takes one minute, so only five fit into the budget.
+    args = fake_frontend.start("nm", routine, maxtime=300)
+    opt_result = nelder_mead(be.acquire_nmr, x0, xtol, lb, ub, args=args)
+    be.remove_checkpoint()
+    assert len(fake_frontend.acquired) == 5
+    assert opt_result.message.startswith(MESSAGE_OPT_PREMATURE_TERMINATION)
+    assert "time budget" in opt_result.message
+    with open(_g.p_optlog) as log:
+        predictions = [line for line in log
+                       if line.startswith("Predicted finish")]
+    assert predictions[0] == ("Predicted finish by 12:05:00"
+                              " (4 more spectra at most)\n")
+    assert predictions[-1] == ("Predicted finish by 12:05:00"
+                               " (0 more spectra at most)\n")
+
+
+def test_choose_optimiser():
+    from nmrpoise.poise_backend.optpoise import (
+        MESSAGE_OPT_SUCCESS, MESSAGE_OPT_PREMATURE_TERMINATION)
+    routine = be.Routine(name="test", pars=["p1", "p2"], lb=[0, 0],
+                         ub=[10, 10], init=[3, 4], tol=[0.1, 0.1],
+                         cf="test", au="poise_1d")
+    assert be.choose_optimiser(routine._replace(pars=["p1"]))[0] == "brent"
+    assert be.choose_optimiser(routine)[0] == "bobyqa"
+    # Shape of the routine.
+    assert be.choose_optimiser(routine._replace(steps=[1, None]))[0] == "nm"
+    assert be.choose_optimiser(routine._replace(steps=[None, None]))[0] \
+        == "bobyqa"
+    assert be.choose_optimiser(
+        routine._replace(constraints=["p1 < p2"]))[0] == "nm"
+    # Noise level.
+    assert be.choose_optimiser(routine, 1, [100, 101])[0] == "bobyqa"
+    assert be.choose_optimiser(routine, 10, [100, 101])[0] == "nm"
+
+    # History.
+    def run(algorithm, nfev, fbest, message=MESSAGE_OPT_SUCCESS):
+        return {"algorithm": algorithm, "nfev": nfev, "fbest": fbest,
+                "message": message}
+    runs = [run("nm", 20, 1.0), run("nm", 22, 1.1), run("nm", 18, 0.9),
+            run("mds", 30, 1.0), run("mds", 30, 1.0), run("mds", 31, 1.0),
+            run("bobyqa", 5, 1.0), run("bobyqa", 6, 1.0)]
+    # Not enough BOBYQA runs yet, and history takes precedence over noise.
+    optimiser, reason = be.choose_optimiser(routine, 10, [100, 101], runs)
+    assert optimiser == "nm"
+    assert "previous runs" in reason
+    # Prematurely terminated runs don't count.
+    runs.append(run("bobyqa", 2, 1.0, MESSAGE_OPT_PREMATURE_TERMINATION))
+    assert be.choose_optimiser(routine, runs=runs)[0] == "nm"
+    runs.append(run("bobyqa", 7, 1.0))
+    assert be.choose_optimiser(routine, runs=runs)[0] == "bobyqa"
+    # Unless BOBYQA gets worse results.
+    runs += [run("bobyqa", 5, 2.0)] * 3
+    assert be.choose_optimiser(routine, runs=runs)[0] == "nm"
+
+
+def test_separable(fake_frontend):
+    from nmrpoise.poise_backend.optpoise import scale, nelder_mead
+    from nmrpoise.poise_backend.shared import _g
+    routine = be.Routine(name="test", pars=["p1", "p2", "p3"],
+                         lb=[0, 0, 0], ub=[10, 10, 10], init=[3, 4, 6],
+                         tol=[0.1, 0.1, 0.1], cf="test", au="poise_1d")
+    x0, lb, ub, xtol = scale(routine.init, routine.lb, routine.ub,
+                             routine.tol, scaleby="tols")
+    acquired = fake_frontend.acquired
+
+    def unscaled_xbest(opt_result):
+        return be.unscale(opt_result.xbest, routine.lb, routine.ub,
+                          routine.tol, scaleby="tols")
+
+    # p1 and p2 interact, p3 is independent.
+    def cost_fn(x):
+        return (x[0] - 5) ** 2 + (x[1] - 5) ** 2 + (x[0] - x[1]) ** 2 \
+            + (x[2] - 5) ** 2
+
+    args = fake_frontend.start("nm", routine, cost_fn=cost_fn)
+    joint = nelder_mead(be.acquire_nmr, x0, xtol, lb, ub, args=args)
+    be.remove_checkpoint()
+
+    args = fake_frontend.start("nm", routine, separable=True,
+                               cost_fn=cost_fn)
+    opt_result = be.run_separable(be.get_optimfn("nm"), x0, xtol, lb, ub,
+                                  args, budget=0)
+    be.remove_checkpoint()
+    assert _g.groups == [[0, 1], [2]]
+    assert np.allclose(unscaled_xbest(opt_result), [5, 5, 5], atol=0.3)
+    assert np.allclose(unscaled_xbest(joint), [5, 5, 5], atol=0.3)
+    # Nothing is acquired twice.
+    assert len({tuple(x) for x in acquired}) == len(acquired)
+
+    # Fully separable cost function: much cheaper than optimising jointly.
+    args = fake_frontend.start("nm", routine)
+    nelder_mead(be.acquire_nmr, x0, xtol, lb, ub, args=args)
+    n_joint = len(acquired)
+    be.remove_checkpoint()
+    args = fake_frontend.start("nm", routine, separable=True)
+    opt_result = be.run_separable(be.get_optimfn("nm"), x0, xtol, lb, ub,
+                                  args, budget=0)
+    be.remove_checkpoint()
+    assert _g.groups == [[0], [1], [2]]
+    assert np.allclose(unscaled_xbest(opt_result), [5, 5, 5], atol=0.1)
+    assert len(acquired) < n_joint
+
+    # With a budget, the optimisation stops in the middle.
+    args = fake_frontend.start("nm", routine, separable=True,
+                               cost_fn=cost_fn)
+    opt_result = be.run_separable(be.get_optimfn("nm"), x0, xtol, lb, ub,
+                                  args, budget=12)
+    be.remove_checkpoint()
+    assert len(acquired) == 12
+    assert opt_result.message == be.MESSAGE_OPT_MAXFEV_REACHED
+
+    # Non-separable cost function.
+    args = fake_frontend.start("nm", routine, separable=True,
+                               cost_fn=lambda x: np.sum(x - 5) ** 2
+                               + np.sum((x - 5) ** 2))
+    be.run_separable(be.get_optimfn("nm"), x0, xtol, lb, ub, args, budget=0)
+    be.remove_checkpoint()
+    assert _g.groups == [[0, 1, 2]]
+
+
+@pytest.mark.parametrize("interaction, groups", [
+    (0, [[0], [1]]), (0.38, [[0], [1]]), (0.40, [[0, 1]]), (2, [[0, 1]])
+])
+def test_find_groups_noise(fake_frontend, interaction, groups):
+    from nmrpoise.poise_backend.optpoise import scale
+    routine = be.Routine(name="test", pars=["p1", "p2"], lb=[0, 0],
+                         ub=[10, 10], init=[3, 4], tol=[0.1, 0.1],
+                         cf="test", au="poise_1d")
+    x0, lb, ub, xtol = scale(routine.init, routine.lb, routine.ub,
+                             routine.tol, scaleby="tols")
+
+    # A weak separable part, plus an interaction term which only appears
+    # when both parameters are moved away from the initial point. With a
+    # noise level of 0.1, the threshold for 95% confidence is 1.96 * 2 * 0.1
+    # = 0.392.
+    def cost_fn(x):
+        moved = not np.isclose(x[0], 3) and not np.isclose(x[1], 4)
+        return (0.01 * ((x[0] - 5) ** 2 + (x[1] - 5) ** 2)
+                + interaction * moved)
+
+    args = fake_frontend.start("nm", routine, cost_fn=cost_fn)
+    assert be.find_groups(x0, xtol, lb, ub, args, be.MAGIC_TOL * 10,
+                          noise=0.1) == groups
+    be.remove_checkpoint()
+    # Without noise, any interaction counts.
+    args = fake_frontend.start("nm", routine, cost_fn=cost_fn)
+    assert be.find_groups(x0, xtol, lb, ub, args, be.MAGIC_TOL * 10) == (
+        [[0], [1]] if interaction == 0 else [[0, 1]])
+    be.remove_checkpoint()
+
+
+def test_refine_optimum(fake_frontend):
+    from nmrpoise.poise_backend.optpoise import scale, nelder_mead
+    from nmrpoise.poise_backend.shared import _g
+    routine = be.Routine(name="test", pars=["p1", "p2"], lb=[0, 0],
+                         ub=[10, 10], init=[3, 4], tol=[0.2, 0.2],
+                         cf="test", au="poise_1d")
+    x0, lb, ub, xtol = scale(routine.init, routine.lb, routine.ub,
+                             routine.tol, scaleby="tols")
+    # The true minimum is off the points that will be sampled.
+    cost_fn = (lambda x: (x[0] - 5.03) ** 2 + (x[1] - 4.97) ** 2
+               + 0.5 * (x[0] - 5.03) * (x[1] - 4.97))
+    args = fake_frontend.start("nm", routine, cost_fn=cost_fn)
+    nelder_mead(be.acquire_nmr, x0, xtol, lb, ub, args=args)
+    be.remove_checkpoint()
+    _g.fvals = np.array(_g.fvals)
+    n_acquired = len(fake_frontend.acquired)
+
+    indices = np.arange(len(_g.fvals))
+    refined = be.refine_optimum(routine, indices)
+    assert np.allclose(refined.xbest, [5.03, 4.97])
+    assert np.all(refined.ci_lower <= refined.xbest)
+    assert np.all(refined.ci_upper >= refined.xbest)
+    # Nothing is acquired.
+    assert len(fake_frontend.acquired) == n_acquired
+    # Discrete parameters are rounded.
+    refined = be.refine_optimum(routine._replace(steps=[0.1, None]), indices)
+    assert np.allclose(refined.xbest, [5.0, 4.97])
+    # Constraints are respected.
+    _g.violation = be.make_violation_function(["p1 <= 5"], routine.pars)
+    with pytest.raises(ValueError, match="constraints"):
+        be.refine_optimum(routine, indices)
+
+
+def test_restarts(fake_frontend):
+    from nmrpoise.poise_backend.optpoise import scale
+    from nmrpoise.poise_backend.shared import _g
+    routine = be.Routine(name="test", pars=["p1", "p2"], lb=[0, 0],
+                         ub=[10, 10], init=[3, 4], tol=[0.1, 0.1],
+                         cf="test", au="poise_1d")
+    x0, lb, ub, xtol = scale(routine.init, routine.lb, routine.ub,
+                             routine.tol, scaleby="tols")
+    acquired = fake_frontend.acquired
+
+    # Local minimum at (3, 3), global minimum at (8, 8).
+    def cost_fn(x):
+        return min(np.sum((x - 3) ** 2), np.sum((x - 8) ** 2) - 1)
+
+    args = fake_frontend.start("nm", routine, cost_fn=cost_fn)
+    be.run_optimiser(be.get_optimfn("nm"), x0, xtol, lb, ub, args, budget=0)
+    be.remove_checkpoint()
+    assert be.best_full_fidelity()[1] > -0.5
+    n_single = len(acquired)
+
+    args = fake_frontend.start("nm", routine, cost_fn=cost_fn, restarts=4)
+    opt_result = be.run_restarts(be.run_optimiser, be.get_optimfn("nm"),
+                                 x0, xtol, lb, ub, args, budget=0,
+                                 restarts=4)
+    be.remove_checkpoint()
+    xbest, fbest = be.best_full_fidelity()
+    assert fbest < -0.9
+    assert np.allclose(xbest, [8, 8], atol=0.3)
+    assert opt_result.message == be.MESSAGE_OPT_SUCCESS
+    assert opt_result.nfev == len(acquired) > n_single
+    # Nothing is acquired twice.
+    assert len({tuple(x) for x in acquired}) == len(acquired)
+    with open(_g.p_optlog) as log:
+        assert "Restart 2 (from" in log.read()
+
+    # All restarts share the same budget.
+    args = fake_frontend.start("nm", routine, cost_fn=cost_fn, restarts=4)
+    opt_result = be.run_restarts(be.run_optimiser, be.get_optimfn("nm"),
+                                 x0, xtol, lb, ub, args, budget=n_single + 5,
+                                 restarts=4)
+    be.remove_checkpoint()
+    assert len(acquired) == n_single + 5
+    assert opt_result.message == be.MESSAGE_OPT_MAXFEV_REACHED
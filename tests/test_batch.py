@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from nmrpoise.poise_backend.optpoise import (nelder_mead,
+                                             multid_search,
+                                             deco_count,
+                                             MESSAGE_OPT_MAXFEV_REACHED,
+                                             MESSAGE_OPT_NOISE_LIMITED)
+from nmrpoise.poise_backend.batch import (nelder_mead_batch,
+                                          multid_search_batch)
+
+
+RNG_SEED = 5
+
+
+def rosenbrock(x):
+    # Vectorised over the first axis.
+    return np.sum(100.0 * (x[:, 1:] - x[:, :-1] ** 2.0) ** 2.0
+                  + (1 - x[:, :-1]) ** 2.0, axis=1)
+
+
+def bumpy(x):
+    # Quadratic with deterministic "noise".
+    return np.sum(x ** 2, axis=1) + 0.05 * np.sin(1000 * np.sum(x, axis=1))
+
+
+def boxed(x):
+    # Infinite outside the unit box, like acquire_nmr() for NM.
+    f = np.sum((x - 0.9) ** 2, axis=1)
+    return np.where(np.any((x < 0) | (x > 1), axis=1), np.inf, f)
+
+
+def scalar_version(fn):
+    @deco_count
+    def cf(x):
+        return fn(np.asarray(x)[None, :])[0]
+    return cf
+
+
+def compare(batch_result, scalar_results):
+    """
+    Checks that a batch result is identical to a list of scalar ones.
+    """
+    for i, r in enumerate(scalar_results):
+        assert batch_result.message[i] == r.message
+        assert batch_result.nfev[i] == r.nfev
+        assert batch_result.niter[i] == r.niter
+        assert batch_result.fbest[i] == r.fbest
+        assert np.array_equal(batch_result.xbest[i], r.xbest)
+        assert np.array_equal(batch_result.simplex[i], r.simplex)
+        assert np.array_equal(batch_result.fvals[i], r.fvals)
+
+
+@pytest.mark.parametrize("optimisers", [(nelder_mead, nelder_mead_batch),
+                                        (multid_search, multid_search_batch)])
+@pytest.mark.parametrize("fn, kwargs", [
+    (rosenbrock, {}),
+    (rosenbrock, {"simplex_method": "axis", "maxfev": 60}),
+    (rosenbrock, {"simplex_method": "random", "seed": RNG_SEED}),
+    (bumpy, {"noise": 0.05}),
+    (boxed, {}),
+    (boxed, {"bounds_method": "reflect", "init_step": 0.5}),
+])
+def test_batch_matches_scalar(optimisers, fn, kwargs):
+    scalar_opt, batch_opt = optimisers
+    rng = np.random.default_rng(RNG_SEED)
+    n = 3
+    x0 = rng.uniform(0.1, 0.9, size=(20, n))
+    xtol = np.full(n, 1e-3)
+    lb, ub = np.zeros(n), np.ones(n)
+
+    cf = scalar_version(fn)
+    scalar_results = [scalar_opt(cf, x, xtol, lb, ub, **kwargs) for x in x0]
+    batch_result = batch_opt(fn, x0, xtol, lb, ub, **kwargs)
+    compare(batch_result, scalar_results)
+
+
+def test_batch_messages():
+    rng = np.random.default_rng(RNG_SEED)
+    x0 = rng.uniform(0.1, 0.9, size=(50, 2))
+    # Per-optimisation tolerances: some converge, the others run out of
+    # function evaluations.
+    xtol = np.where(np.arange(50)[:, None] < 25, 1e-2, 1e-9)
+    result = nelder_mead_batch(bumpy, x0, xtol, [-1, -1], [1, 1], maxfev=80)
+    assert all(n <= 80 for n in result.nfev)
+    assert MESSAGE_OPT_MAXFEV_REACHED in result.message[25:]
+    # The noise level stops the optimisations which would otherwise have run
+    # out of evaluations.
+    result = nelder_mead_batch(bumpy, x0, xtol, [-1, -1], [1, 1], maxfev=80,
+                               noise=0.05)
+    assert MESSAGE_OPT_NOISE_LIMITED in result.message[25:]
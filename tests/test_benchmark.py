@@ -0,0 +1,84 @@
+import json
+
+import numpy as np
+import pytest
+
+from nmrpoise.benchmark import (measure, bench_readers, bench_optimisers,
+                                compare_results, main, sphere, OPTIMISERS)
+from nmrpoise.poise_backend.shared import _g
+
+
+def test_measure():
+    result = measure(lambda: np.zeros(100000), repeats=2)
+    assert result["time"] > 0
+    assert result["peak_memory"] >= 800000
+
+
+def test_bench_readers(tmp_path):
+    p_spectrum = _g.p_spectrum
+    results = bench_readers(tmp_path, sizes_1d=[1024, 4096],
+                            sizes_2d=[(128, 512)], repeats=1)
+    assert "get1d_real[1024]" in results
+    assert "cf:minabsint[4096]" in results
+    assert "_get_2d[128x512]" in results
+    # Reading a larger spectrum takes more memory.
+    assert (results["get1d_fid[4096]"]["peak_memory"]
+            > results["get1d_fid[1024]"]["peak_memory"])
+    assert results["_get_2d[128x512]"]["peak_memory"] > 128 * 512 * 8
+    # The active spectrum is restored afterwards.
+    assert _g.p_spectrum is p_spectrum
+
+
+def test_bench_optimisers():
+    results = bench_optimisers(functions={"sphere": (sphere, (-2, 2), 0.5)},
+                               dimensions=[2], noise=[0, 0.01], repeats=1)
+    assert len(results) == len(OPTIMISERS) * 2
+    for name, result in results.items():
+        assert result["nfev"] > 0
+        if name.endswith(",0]"):
+            assert result["error"] < 1
+    # The noise is reproducible.
+    again = bench_optimisers(functions={"sphere": (sphere, (-2, 2), 0.5)},
+                             dimensions=[2], noise=[0.01], repeats=1)
+    for name, result in again.items():
+        assert result["nfev"] == results[name]["nfev"]
+
+
+def test_compare(tmp_path, capsys):
+    baseline = {"metadata": {}, "results": {
+        "a": {"time": 1.0, "peak_memory": 100, "nfev": 10},
+        "b": {"time": 1.0, "peak_memory": 100},
+        "c": {"time": 1.0, "peak_memory": 100}}}
+    new = {"metadata": {}, "results": {
+        "a": {"time": 1.1, "peak_memory": 100, "nfev": 11},
+        "b": {"time": 2.0, "peak_memory": 90}}}
+    compare_df = compare_results(baseline, new)
+    assert len(compare_df) == 5
+    regressions = compare_df[compare_df["regression"]]
+    assert list(zip(regressions["benchmark"], regressions["metric"])) == [
+        ("a", "nfev"), ("b", "time")]
+    compare_df = compare_results(baseline, new, {"nfev": 0.2, "time": 1.5})
+    assert not compare_df["regression"].any()
+
+    p_baseline, p_new = tmp_path / "baseline.json", tmp_path / "new.json"
+    p_baseline.write_text(json.dumps(baseline))
+    p_new.write_text(json.dumps(new))
+    assert main(["compare", str(p_baseline), str(p_new)]) == 1
+    assert "2 regression(s) found" in capsys.readouterr().out
+    assert main(["compare", str(p_baseline), str(p_new),
+                 "--time-tol", "2", "--nfev-tol", "0.5"]) == 0
+
+
+def test_cli(tmp_path, capsys):
+    p_out = tmp_path / "results.json"
+    assert main(["run", "--quick", "-n", "1", "-k", "^nm:sphere",
+                 "-o", str(p_out)]) == 0
+    results = json.loads(p_out.read_text())
+    assert set(results["results"]) == {"nm:sphere[2,0]", "nm:sphere[2,0.01]",
+                                       "nm:sphere[4,0]", "nm:sphere[4,0.01]"}
+    assert "numpy" in results["metadata"]
+    # Comparing a run against itself (the nfev should be identical)
+    assert main(["run", "--quick", "-n", "1", "-k", "^nm:sphere",
+                 "--compare", str(p_out), "--time-tol", "100",
+                 "--peak-memory-tol", "100"]) == 0
+    assert "No regressions found" in capsys.readouterr().out
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from nmrpoise.poise_backend.constraints import make_violation_function
+
+
+def test_make_violation_function():
+    pars = ["d1", "P1"]
+    violation = make_violation_function(["d1 >= p1 * 1e-6 + 0.001",
+                                         "0 < D1 - 0.0005 <= 0.1"], pars)
+    assert violation([0.002, 10]) == 0
+    assert violation([0.1005, 10]) == 0
+    # First constraint violated by 1e-5.
+    assert np.isclose(violation([0.001, 10]), 1e-5)
+    # Upper limit of second constraint violated by 0.1.
+    assert np.isclose(violation([0.2005, 10]), 0.1)
+    # Functions and arithmetic.
+    violation = make_violation_function(["sqrt(abs(d1)) + max(d1, p1) ** 2"
+                                         " <= -(-4)"], pars)
+    assert violation([1, 1]) == 0
+    assert np.isclose(violation([4, 1]), 14)
+    # Numeric literals (which older Pythons parse differently).
+    violation = make_violation_function(["p1 + 2*d1 <= 10", "-1.5 < d1"],
+                                        pars)
+    assert violation([3, 2]) == 0
+    assert violation([4, 3]) == 1
+    assert violation([-2, 0]) == 0.5
+    # No constraints.
+    assert make_violation_function(None, pars)([1, 1]) == 0
+    assert make_violation_function([], pars)([1, 1]) == 0
+
+
+@pytest.mark.parametrize("constraint", ["d1 +", "d1", "d1 == p1",
+                                        "d1 != p1", "d1 < d2",
+                                        "d1 < __import__('os')",
+                                        "d1 < p1.real", "d1 < 'a'",
+                                        "d1 < [1][0]", "d1 < (p1 < 1)",
+                                        "d1 < max(d1, key=abs)",
+                                        "d1 < p1 // 2",
+                                        ])
+def test_invalid_constraints(constraint):
+    with pytest.raises(ValueError):
+        make_violation_function([constraint], ["d1", "p1"])
+
+
+@pytest.mark.parametrize("constraint, what", [("d1 < p1.real", "Attribute"),
+                                              ("d1 < p1 // 2", "FloorDiv"),
+                                              ("d1 < 'a'", "Constant|Str"),
+                                              ("d1 < [1][0]", "Subscript")])
+def test_disallowed_node(constraint, what):
+    # The message names what is not allowed.
+    with pytest.raises(ValueError, match=f"({what}) is not allowed"):
+        make_violation_function([constraint], ["d1", "p1"])
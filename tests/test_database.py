@@ -0,0 +1,79 @@
+from pathlib import Path
+
+import numpy as np
+
+from nmrpoise import parse_db
+from nmrpoise.poise_backend import database as db
+from nmrpoise.poise_backend import backend as be
+
+
+def make_run(**kwargs):
+    run = dict(date="2021-05-01 12:00:00", routine="p1cal", pars=["p1"],
+               cf="minabsint", au="poise_1d", algorithm="brent", init=[48],
+               lb=[40], ub=[56], tol=[0.2], optimum=np.array([48.125]),
+               fbest=3000.0, nfev=9, time=70.0, message="Optimisation done",
+               probe="PA TBO", solvent="DMSO", instrument="avx500",
+               sample="poise_demo", spectrum="/data/poise_demo/1/pdata/1",
+               xvals=[np.array([48.0]), np.array([48.125])],
+               fvals=np.array([5000.0, 3000.0]))
+    run.update(kwargs)
+    return run
+
+
+def test_record_get_runs(tmp_path):
+    p_db = tmp_path / "poise.db"
+    assert db.get_runs(p_db) == []
+
+    db.record_run(p_db, **make_run())
+    db.record_run(p_db, **make_run(cf="maxabsint", optimum=[45.0]))
+    db.record_run(p_db, **make_run(optimum=[47.5], solvent="CDCl3"))
+
+    runs = db.get_runs(p_db)
+    assert len(runs) == 3
+    # Most recent first
+    assert runs[0]["optimum"] == [47.5]
+    assert runs[0]["solvent"] == "CDCl3"
+
+    runs = db.get_runs(p_db, routine="p1cal", cf="minabsint")
+    assert [run["optimum"] for run in runs] == [[47.5], [48.125]]
+    assert runs[1]["xvals"] == [[48.0], [48.125]]
+    assert runs[1]["fvals"] == [5000.0, 3000.0]
+    assert runs[1]["nfev"] == 9
+
+    assert len(db.get_runs(p_db, cf="maxabsint")) == 1
+    assert len(db.get_runs(p_db, pars=["p1"], limit=2)) == 2
+    assert db.get_runs(p_db, pars=["cnst20"]) == []
+
+
+def test_parse_db(tmp_path):
+    p_db = tmp_path / "poise.db"
+    db.record_run(p_db, **make_run())
+    db.record_run(p_db, **make_run(cf="maxabsint", optimum=[45.0]))
+
+    df = parse_db(p_db)
+    assert len(df) == 2
+    # Chronological order, and singleton lists are unwrapped as in parse_log
+    assert df["optimum"].tolist() == [48.125, 45.0]
+    assert df["initial"].tolist() == [48, 48]
+    assert df["param"].tolist() == [["p1"], ["p1"]]
+    assert df["probe"].tolist() == ["PA TBO", "PA TBO"]
+    assert len(parse_db(p_db, cf="maxabsint")) == 1
+
+
+def test_get_acqus_string():
+    p_acqus = Path(__file__).parent / "test_data" / "101" / "acqus"
+    assert db.get_acqus_string("SOLVENT", p_acqus) == "DMSO"
+    assert db.get_acqus_string("instrum", p_acqus) == "av600"
+    assert db.get_acqus_string("NONEXISTENT", p_acqus) is None
+    assert db.get_acqus_string("SOLVENT", p_acqus.parent / "nope") is None
+
+
+def test_get_previous_optimum_db(tmp_path):
+    p_routine_dir = Path(__file__).parent / "test_data"
+    routine, _ = be.get_routine_cf("p1cal", p_routine_dir)
+    p_optlog = tmp_path / "poise.log"
+    p_db = tmp_path / "poise.db"
+    assert be.get_previous_optimum(routine, p_optlog, p_db) is None
+    db.record_run(p_db, **make_run(optimum=[47.5]))
+    db.record_run(p_db, **make_run(cf="maxabsint", optimum=[45.0]))
+    assert be.get_previous_optimum(routine, p_optlog, p_db) == [47.5]
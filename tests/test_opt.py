@@ -4,12 +4,24 @@ import pytest
 from nmrpoise.poise_backend.optpoise import (nelder_mead,
                                              multid_search,
                                              pybobyqa_interface,
+                                             brent,
+                                             compass_search,
                                              deco_count,
+                                             Simplex,
                                              scale,
                                              unscale,
+                                             register_transform,
+                                             round_to_steps,
+                                             fit_quadratic,
+                                             TRANSFORMS,
+                                             within_noise,
+                                             NOISE_THRESHOLD,
                                              MESSAGE_OPT_SUCCESS,
                                              MESSAGE_OPT_MAXFEV_REACHED,
-                                             MESSAGE_OPT_MAXITER_REACHED)
+                                             MESSAGE_OPT_MAXITER_REACHED,
+                                             MESSAGE_OPT_NOISE_LIMITED,
+                                             MESSAGE_OPT_TARGET_REACHED,
+                                             MESSAGE_OPT_STAGNATED)
 from nmrpoise.poise_backend.cfhelpers import CostFunctionError
 
 
@@ -70,6 +82,39 @@ def test_scale_unscale():
     assert scale(val, lb, ub, tol, scaleby="bounds") is None
 
 
+def test_scale_transforms(monkeypatch):
+    lb, val, ub = [1e-3, 0.1, -5], [0.1, 0.5, 0], [10, 0.9, 5]
+    tol = [0.05, 0.1, 0.2]
+    transforms = ["log", "logit", None]
+    sval, slb, sub, stol = scale(val, lb, ub, tol, scaleby="tols",
+                                 transforms=transforms)
+    assert np.allclose(slb, 0)
+    assert np.allclose(stol, 0.03)
+    # The tolerance applies to the transformed values.
+    assert np.isclose(sval[0], np.log(100) * 0.03 / 0.05)
+    assert np.isclose(sub[0], np.log(1e4) * 0.03 / 0.05)
+    assert np.isclose(sval[1], np.log(9) * 0.03 / 0.1)
+    assert np.isclose(sval[2], 5 * 0.03 / 0.2)
+    # Round trip.
+    usval = unscale(sval, lb, ub, tol, scaleby="tols", transforms=transforms)
+    assert np.allclose(usval, val)
+    # Bounds outside the domain of the transform.
+    with pytest.raises(ValueError, match="not defined"):
+        scale(val, [0, 0.1, -5], ub, tol, transforms=transforms)
+    with pytest.raises(ValueError, match="Invalid transform"):
+        scale(val, lb, ub, tol, transforms=["log", "penguins", None])
+    with pytest.raises(ValueError, match="transforms"):
+        scale(val, lb, ub, tol, transforms=["log"])
+    # Custom transforms.
+    monkeypatch.setitem(TRANSFORMS, "sqrt", TRANSFORMS["linear"])
+    register_transform("sqrt", np.sqrt, np.square)
+    sval, _, _, _ = scale([4], [1], [9], [0.1], scaleby="tols",
+                          transforms=["sqrt"])
+    assert np.isclose(sval[0], 0.3)
+    assert np.allclose(unscale(sval, [1], [9], [0.1], scaleby="tols",
+                               transforms=["sqrt"]), [4])
+
+
 def test_deco_count():
     @deco_count
     def peep():
@@ -188,6 +233,71 @@ def test_bobyqa_accuracy():
     assert np.allclose(unscaled_xbest, np.zeros(len(x0)), atol=2e-2)
 
 
+def test_brent_accuracy():
+    for x0_1d in [1.3, -4.9, 5.0]:
+        quadratic.calls = 0  # reset fevals
+        optResult = brent(cf=quadratic, x0=[x0_1d], xtol=xtol[:1],
+                          scaled_lb=lb[:1], scaled_ub=ub[:1])
+        assert optResult.message == MESSAGE_OPT_SUCCESS
+        assert np.allclose(optResult.xbest, [0], atol=1e-2)
+        assert optResult.nfev == quadratic.calls
+
+
+def test_brent_fevals():
+    # Brent should need fewer function evaluations than a 1D Nelder-Mead.
+    quadratic.calls = 0
+    brentResult = brent(cf=quadratic, x0=x0[:1], xtol=xtol[:1],
+                        scaled_lb=lb[:1], scaled_ub=ub[:1])
+    quadratic.calls = 0
+    nmResult = nelder_mead(cf=quadratic, x0=x0[:1], xtol=xtol[:1],
+                           scaled_lb=lb[:1], scaled_ub=ub[:1])
+    assert brentResult.nfev < nmResult.nfev
+    # It should also stay within bounds even if the minimum is outside them.
+    quadratic.calls = 0
+    optResult = brent(cf=quadratic, x0=[4.5], xtol=[0.03],
+                      scaled_lb=[1], scaled_ub=[5])
+    assert np.allclose(optResult.xbest, [1], atol=0.03)
+    with pytest.raises(ValueError):
+        brent(cf=quadratic, x0=x0, xtol=xtol, scaled_lb=lb, scaled_ub=ub)
+
+
+@deco_count
+def lattice_quadratic(x):
+    # The first parameter is rounded to multiples of 0.5, as acquire_nmr()
+    # does for discrete parameters. The best point on the lattice is
+    # (1.0, 0.35).
+    a, b = np.round(x[0] / 0.5) * 0.5, x[1]
+    return (a - 1.2) ** 2 + (b - 0.3) ** 2 + 0.5 * (a - 1.2) * (b - 0.3)
+
+
+def test_compass_search():
+    quadratic.calls = 0
+    optResult = compass_search(cf=quadratic, x0=x0, xtol=xtol,
+                               scaled_lb=lb, scaled_ub=ub)
+    assert optResult.message == MESSAGE_OPT_SUCCESS
+    assert np.allclose(optResult.xbest, np.zeros(len(x0)), atol=1e-2)
+    assert optResult.nfev == quadratic.calls
+
+    # With a discrete parameter, it only stops once none of the neighbouring
+    # lattice points is better.
+    optResult = compass_search(cf=lattice_quadratic, x0=[3.0, -2.0],
+                               xtol=[0.5, 0.01], scaled_lb=lb[:2],
+                               scaled_ub=ub[:2], steps=[0.5, 0])
+    assert optResult.message == MESSAGE_OPT_SUCCESS
+    assert np.round(optResult.xbest[0] / 0.5) * 0.5 == 1.0
+    assert optResult.xbest[1] == pytest.approx(0.35, abs=0.02)
+
+    # The bounds are respected, and the budget is shared with maxfev.
+    quadratic.calls = 0
+    optResult = compass_search(cf=quadratic, x0=[4.5], xtol=[0.03],
+                               scaled_lb=[1], scaled_ub=[5])
+    assert np.allclose(optResult.xbest, [1], atol=0.03)
+    optResult = compass_search(cf=quadratic, x0=x0, xtol=[1e-6] * len(x0),
+                               scaled_lb=lb, scaled_ub=ub, maxfev=10)
+    assert optResult.message == MESSAGE_OPT_MAXFEV_REACHED
+    assert optResult.nfev == 10
+
+
 def test_maxfevals_reached():
     MAXFEV = 10
 
@@ -203,6 +313,20 @@ def test_maxfevals_reached():
     assert optResult.message == MESSAGE_OPT_MAXFEV_REACHED
     assert optResult.nfev == MAXFEV
 
+    # The limit only applies to evaluations made by this optimisation, not
+    # any made before it.
+    optResult = nelder_mead(cf=quadratic, x0=x0, xtol=([1e-6] * len(x0)),
+                            scaled_lb=lb, scaled_ub=ub, maxfev=MAXFEV)
+    assert optResult.nfev == MAXFEV
+    assert quadratic.calls == 2 * MAXFEV
+
+    # Brent converges on a 1D quadratic in fewer than 10 evaluations.
+    quadratic.calls = 0
+    optResult = brent(cf=quadratic, x0=x0[:1], xtol=[1e-6],
+                      scaled_lb=lb[:1], scaled_ub=ub[:1], maxfev=3)
+    assert optResult.message == MESSAGE_OPT_MAXFEV_REACHED
+    assert optResult.nfev == 3
+
 
 def test_CostFunctionError():
     for method in ["spendley", "axis", "random"]:
@@ -212,6 +336,11 @@ def test_CostFunctionError():
                                 simplex_method=method, seed=RNG_SEED)
         assert "Cost function is below 0.3" in optResult.message
         assert optResult.fbest >= 0.3
+    quadratic_with_error.calls = 0  # reset fevals
+    optResult = brent(cf=quadratic_with_error, x0=x0[:1], xtol=xtol[:1],
+                      scaled_lb=lb[:1], scaled_ub=ub[:1])
+    assert "Cost function is below 0.3" in optResult.message
+    assert optResult.fbest >= 0.3
     for method in ["spendley", "axis", "random"]:
         quadratic_with_error.calls = 0  # reset fevals
         optResult = multid_search(cf=quadratic_with_error, x0=x0, xtol=xtol,
@@ -219,3 +348,180 @@ def test_CostFunctionError():
                                   simplex_method=method, seed=RNG_SEED)
         assert "Cost function is below 0.3" in optResult.message
         assert optResult.fbest >= 0.3
+
+
+def test_within_noise():
+    assert not within_noise([1, 1, 1], 0)
+    assert within_noise([1, 1 + NOISE_THRESHOLD * 0.09], 0.1)
+    assert not within_noise([1, 1 + NOISE_THRESHOLD * 0.11], 0.1)
+    assert not within_noise([1, np.inf], 0.1)
+
+
+def test_noise_limited():
+    # Quadratic with additive Gaussian noise. With the noise level supplied,
+    # every optimiser should stop earlier than it otherwise would, but still
+    # get reasonably close to the optimum.
+    noise = 0.05
+    rng = np.random.default_rng(RNG_SEED)
+
+    @deco_count
+    def noisy_quadratic(x, *args):
+        return np.sum(x ** 2) + rng.normal(scale=noise)
+
+    tight_xtol = [1e-4] * len(x0)
+    for optimiser in [nelder_mead, multid_search]:
+        noisy_quadratic.calls = 0
+        optResult = optimiser(cf=noisy_quadratic, x0=x0, xtol=tight_xtol,
+                              scaled_lb=lb, scaled_ub=ub, noise=noise)
+        assert optResult.message == MESSAGE_OPT_NOISE_LIMITED
+        noisy_nfev = optResult.nfev
+        assert np.sum(optResult.xbest ** 2) < 0.5
+        noisy_quadratic.calls = 0
+        optResult = optimiser(cf=noisy_quadratic, x0=x0, xtol=tight_xtol,
+                              scaled_lb=lb, scaled_ub=ub)
+        assert optResult.message != MESSAGE_OPT_NOISE_LIMITED
+        assert noisy_nfev < optResult.nfev
+
+    noisy_quadratic.calls = 0
+    optResult = brent(cf=noisy_quadratic, x0=x0[:1], xtol=[1e-6],
+                      scaled_lb=lb[:1], scaled_ub=ub[:1], noise=noise)
+    assert optResult.message == MESSAGE_OPT_NOISE_LIMITED
+    assert abs(optResult.xbest[0]) < 0.5
+
+    # BOBYQA needs the bounds to be positive, and the noise to be large
+    # enough that it is reached before rhoend.
+    noise = 1
+    rng = np.random.default_rng(RNG_SEED)
+
+    @deco_count
+    def shifted_noisy_quadratic(x, *args):
+        return np.sum((x - 5) ** 2) + rng.normal(scale=noise)
+
+    optResult = pybobyqa_interface(cf=shifted_noisy_quadratic, x0=x0 + 5,
+                                   xtol=xtol, scaled_lb=lb + 5,
+                                   scaled_ub=ub + 5, noise=noise)
+    assert optResult.message == MESSAGE_OPT_NOISE_LIMITED
+
+
+@pytest.mark.parametrize("optimiser", [nelder_mead, multid_search, brent,
+                                       pybobyqa_interface])
+def test_target_stagnation(optimiser):
+    # BOBYQA needs the bounds to be positive. The power is chosen so that
+    # Brent's method doesn't find the minimum immediately.
+    @deco_count
+    def shifted_fn(x, *args):
+        return np.sum(np.abs(x - 5) ** 1.5)
+
+    n = 1 if optimiser is brent else len(x0)
+    args = (x0[:n] + 5, xtol[:n], lb[:n] + 5, ub[:n] + 5)
+    full = optimiser(shifted_fn, *args)
+
+    # The best point is returned as soon as the target is reached.
+    shifted_fn.calls = 0
+    optResult = optimiser(shifted_fn, *args, target=0.1)
+    assert optResult.message == MESSAGE_OPT_TARGET_REACHED
+    assert optResult.fbest <= 0.1
+    assert optResult.nfev == shifted_fn.calls < full.nfev
+    assert np.isclose(shifted_fn(optResult.xbest), optResult.fbest)
+
+    # Stopping once there is no more significant improvement.
+    shifted_fn.calls = 0
+    optResult = optimiser(shifted_fn, *args, stagnation=(3, 0.5))
+    assert optResult.message == MESSAGE_OPT_STAGNATED
+    assert np.isclose(shifted_fn(optResult.xbest), optResult.fbest)
+    assert optResult.nfev < full.nfev
+
+
+def test_bounds_method():
+    # Minimum outside the bounds: with bounds_method set, no point outside
+    # the bounds should ever be evaluated.
+    box_lb, box_ub = np.array([1.0, 1.0]), np.array([5.0, 5.0])
+
+    @deco_count
+    def bounded_quadratic(x):
+        assert np.all(x >= box_lb) and np.all(x <= box_ub)
+        return np.sum(x ** 2)
+
+    for method in ["project", "reflect"]:
+        for x0_2d in [[4.9, 4.9], [4.9, 1.05], [3, 3]]:
+            bounded_quadratic.calls = 0
+            optResult = nelder_mead(cf=bounded_quadratic, x0=x0_2d,
+                                    xtol=[0.01, 0.01], scaled_lb=box_lb,
+                                    scaled_ub=box_ub, init_step=0.3,
+                                    bounds_method=method)
+            assert np.allclose(optResult.xbest, box_lb, atol=0.03)
+    # MDS can get stuck with a degenerate simplex, so only check the bounds.
+    for method in ["project", "reflect"]:
+        multid_search(cf=bounded_quadratic, x0=[4.9, 4.9], xtol=[0.01, 0.01],
+                      scaled_lb=box_lb, scaled_ub=box_ub, init_step=0.3,
+                      bounds_method=method)
+
+    with pytest.raises(ValueError):
+        nelder_mead(cf=bounded_quadratic, x0=[2, 2], xtol=[0.01, 0.01],
+                    scaled_lb=box_lb, scaled_ub=box_ub,
+                    bounds_method="penguin")
+
+
+def test_simplex_bounds():
+    box_lb, box_ub = np.array([0.0, 0.0]), np.array([1.0, 1.0])
+    for method in ["spendley", "axis"]:
+        # Vertices are reflected through x0 if they would be outside.
+        sim = Simplex([0.9, 0.9], method=method, length=0.3,
+                      lb=box_lb, ub=box_ub)
+        assert np.all(sim.x >= box_lb) and np.all(sim.x <= box_ub)
+        unbounded = Simplex([0.5, 0.5], method=method, length=0.3)
+        offsets = unbounded.x - [0.5, 0.5]
+        expected = np.where(offsets + 0.9 > 1, 0.9 - offsets, 0.9 + offsets)
+        assert np.allclose(sim.x, expected)
+        # If the box is too small for that, they are clipped.
+        sim = Simplex([0.5, 0.5], method=method, length=0.8,
+                      lb=box_lb, ub=box_ub)
+        assert np.all(sim.x >= box_lb) and np.all(sim.x <= box_ub)
+
+
+def test_round_to_steps():
+    x = round_to_steps([48.013, 3.4, 0.7, 5.123, 9.9],
+                       [0.0125, 1, 1, None, 2],
+                       [40, 0, 0.3, 0, 0], [56, 10, 9, 10, 9])
+    # Lattice points are multiples of the step, inside the bounds. Values are
+    # free of floating-point noise.
+    assert list(x) == [48.0125, 3, 1, 5.123, 8]
+    # Bounds which lie on the lattice are kept.
+    assert list(round_to_steps([0.3], [0.1], [0.3], [0.9])) == [0.3]
+    assert list(round_to_steps([0.9], [0.1], [0.3], [0.9])) == [0.9]
+
+
+def test_fit_quadratic():
+    rng = np.random.default_rng(RNG_SEED)
+    xmin = np.array([0.3, -0.2])
+    H = np.array([[2, 0.5], [0.5, 1]])
+
+    def f(x):
+        d = x - xmin
+        return 1 + 0.5 * np.einsum("...i,ij,...j", d, H, d)
+
+    # Exact quadratic: the minimum is found exactly, with no uncertainty.
+    x = rng.uniform(-1, 1, size=(20, 2))
+    fit = fit_quadratic(x, f(x))
+    assert np.allclose(fit.xbest, xmin)
+    assert np.isclose(fit.fbest, 1)
+    assert np.allclose(fit.ci, 0, atol=1e-6)
+    assert fit.npts == 12
+    # Noisy values: the confidence interval should contain the true minimum.
+    fit = fit_quadratic(x, f(x) + rng.normal(0, 0.01, 20), noise=0.01)
+    assert np.all(fit.ci > 0)
+    assert np.all(np.abs(fit.xbest - xmin) < fit.ci)
+    # Non-finite values are ignored.
+    fvals = f(x)
+    fvals[:5] = np.inf
+    assert np.allclose(fit_quadratic(x, fvals).xbest, xmin)
+    # Failures.
+    with pytest.raises(ValueError, match="points are needed"):
+        fit_quadratic(x[:6], f(x[:6]))
+    with pytest.raises(ValueError, match="no minimum"):
+        fit_quadratic(x, -f(x))
+    with pytest.raises(ValueError, match="outside"):
+        fit_quadratic(x, f(x - 5))
+    with pytest.raises(ValueError, match="do not determine"):
+        x[:, 1] = 0
+        fit_quadratic(x, f(x))
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+from nmrpoise.simulate import run_offline, Experiment, Line
+from nmrpoise.replay import (index_run, nearest, replay, compare,
+                             _copy_dataset, _interpolate_1d)
+from nmrpoise.synthetic import write_1d, process_1d
+from nmrpoise.poise_backend.cfhelpers import get1d_real, get1d_imag, getpar
+
+
+@pytest.fixture
+def recorded_run(tmp_path, p1cal):
+    """
+    Runs a simulated optimisation which keeps every spectrum in its own
+    expno, like the frontend does with --separate. Returns the result and
+    the path to the data folder.
+    """
+    exp = Experiment([Line(1.0, 3.0), Line(3.0, 5.0, 0.5)], p90=11.7,
+                     noise=0.01, seed=1)
+    p_data = tmp_path / "data"
+    calls = [0]
+
+    def acquire(values):
+        # The starting dataset is overwritten by the first spectrum.
+        expno = max(calls[0], 1)
+        calls[0] += 1
+        pars = exp.acquisition_pars(values)
+        return exp.write(p_data / str(expno), pars), 10.0
+
+    result = run_offline(p1cal, acquire, tmp_path / "sim")
+    return result, p_data
+
+
+def test_index_run(recorded_run, tmp_path, p1cal):
+    result, p_data = recorded_run
+    recorded = index_run(p_data / "1")
+    assert recorded.routine == p1cal
+    assert np.allclose(recorded.xvals, result.xvals, atol=1e-4)
+    assert np.allclose(recorded.fvals, result.fvals, rtol=1e-6)
+    assert recorded.p_spectra == [p_data / str(i) / "pdata" / "1"
+                                  for i in range(1, result.nfev + 1)]
+    assert recorded.time == pytest.approx(10, abs=1)
+
+    indices, d = nearest(recorded, result.xvals[2], k=2)
+    assert indices[0] == 2
+    assert d[0] < 1e-3 and d[1] > d[0]
+
+    # Spectra missing (as without --separate)
+    (p_data / "2" / "pdata" / "1" / "procs").unlink()
+    with pytest.raises(ValueError, match="--separate"):
+        index_run(p_data / "1" / "poise.log")
+
+
+def test_replay(recorded_run, tmp_path):
+    result, p_data = recorded_run
+    recorded = index_run(p_data / "1")
+    # With the same settings, the same optimisation is carried out.
+    replayed = replay(recorded, tmp_path / "replay")
+    assert replayed.nfev == result.nfev
+    assert np.allclose(replayed.fvals, result.fvals, rtol=1e-6)
+    assert np.all(replayed.distances < 1e-3)
+    assert replayed.time == pytest.approx(result.nfev * recorded.time)
+    # The recorded data are left untouched.
+    assert not (p_data / "1" / "poise_checkpoint.json").exists()
+    assert len(index_run(p_data / "1").xvals) == result.nfev
+
+    # Larger tolerances
+    replayed = replay(recorded, tmp_path / "replay2",
+                      changes={"tol": [1.0]})
+    assert replayed.nfev < result.nfev
+    assert abs(replayed.xbest[0] - result.xbest[0]) < 1.5
+    with pytest.raises(ValueError, match="cannot be changed"):
+        replay(recorded, tmp_path / "replay3", changes={"pars": ["p2"]})
+
+
+def test_replay_interpolate(recorded_run, tmp_path):
+    result, p_data = recorded_run
+    recorded = index_run(p_data / "1")
+    # Interpolating halfway between two spectra
+    x = np.mean(recorded.xvals[:2], axis=0)
+    indices, _ = nearest(recorded, x, k=2)
+    assert sorted(indices) == [0, 1]
+    replayed = replay(recorded, tmp_path / "replay", interpolate=True,
+                      changes={"init": x.tolist()}, maxfev=1)
+    spec = get1d_real(p_spec=tmp_path / "replay" / "1" / "pdata" / "1")
+    expected = np.mean([get1d_real(p_spec=recorded.p_spectra[i])
+                        for i in [0, 1]], axis=0)
+    assert np.allclose(spec, expected, atol=np.max(np.abs(expected)) * 1e-6)
+    assert replayed.distances[0] > 0
+
+
+@pytest.mark.parametrize("dtypp, bytordp", [(2, 0), (2, 1), (0, 1)])
+def test_interpolate_formats(tmp_path, dtypp, bytordp):
+    # The spectra are read according to DTYPP and BYTORDP, and the result is
+    # written in the format of the first one (the second is always ints).
+    rng = np.random.default_rng(0)
+    fids = [1e3 * (rng.normal(size=64) + 1j * rng.normal(size=64))
+            for _ in range(2)]
+    p_specs = [write_1d(tmp_path / "1", fids[0], dtypp=dtypp,
+                        bytordp=bytordp),
+               write_1d(tmp_path / "2", fids[1])]
+    p_dest = _copy_dataset(p_specs[0], tmp_path / "3")
+    _interpolate_1d(p_specs, [0.25, 0.75], p_dest)
+    assert getpar("DTYPP", p_dest) == dtypp
+    assert getpar("BYTORDP", p_dest) == bytordp
+    expected = 0.25 * process_1d(fids[0]) + 0.75 * process_1d(fids[1])
+    spec = get1d_real(p_spec=p_dest) + 1j * get1d_imag(p_spec=p_dest)
+    assert np.allclose(spec, expected, atol=np.max(np.abs(expected)) * 1e-6)
+
+
+def test_compare(recorded_run):
+    result, p_data = recorded_run
+    recorded = index_run(p_data / "1")
+    compare_df = compare(recorded, [{}, {"tol": [1.0]},
+                                    {"cf": "no_such_cf"}])
+    assert list(compare_df["alternative"]) == [
+        "recorded", "{}", "{'tol': [1.0]}", "{'cf': 'no_such_cf'}"]
+    assert compare_df["nfev"][0] == compare_df["nfev"][1] == result.nfev
+    assert compare_df["optimum"][1] == pytest.approx(result.xbest[0])
+    assert compare_df["nfev"][2] < result.nfev
+    assert "AttributeError" in compare_df["message"][3]
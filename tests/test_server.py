@@ -0,0 +1,230 @@
+import io
+import os
+import json
+import socket
+import importlib
+import threading
+
+import pytest
+
+from nmrpoise import parse_log
+from nmrpoise.simulate import Experiment, Line
+from nmrpoise.topspin_mock import MockTopSpin
+from nmrpoise.poise_backend.shared import State, _g, current_state, new_state
+from nmrpoise.poise_backend.server import PoiseServer, ThreadLocalStream
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(State, "p_poise", tmp_path / "poise_backend")
+    monkeypatch.setattr(State, "p_database", tmp_path / "poise.db")
+    (tmp_path / "poise_backend" / "routines").mkdir(parents=True)
+    server = PoiseServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def connect(server, command, token=None):
+    sock = socket.create_connection(("127.0.0.1", server.port))
+    rfile = sock.makefile("r")
+    wfile = sock.makefile("w")
+    print(token or server.token, file=wfile)
+    print(command, file=wfile)
+    wfile.flush()
+    return sock, rfile, wfile
+
+
+def run_optimisation(server, routine, experiment, p_expno, started=None,
+                     resume=None):
+    """
+    Acts as the frontend for one optimisation run in the daemon. Returns the
+    optimum and the message. If the events *started* and *resume* are given,
+    the first spectrum requested is not acquired until *resume* is set, and
+    *started* is set as soon as it is requested.
+    """
+    p_routine = State.p_poise / "routines" / f"{routine['name']}.json"
+    p_routine.write_text(json.dumps(routine))
+    pars = experiment.acquisition_pars({"P1": routine["init"][0]})
+    p_spectrum = experiment.write(p_expno, pars)
+    sock, rfile, wfile = connect(server, "run")
+    with sock, rfile, wfile:
+        for item in ["nm", routine["name"], p_spectrum, 0, 0, 0, "", 0, 0,
+                     0, 0, 0]:
+            print(item, file=wfile)
+        wfile.flush()
+        while True:
+            line = rfile.readline().strip()
+            if line.startswith("values:"):
+                if started is not None and not started.is_set():
+                    started.set()
+                    resume.wait(timeout=60)
+                pars = experiment.acquisition_pars({"P1": line.split()[1]})
+                print("done", file=wfile)
+                print(experiment.write(p_expno, pars), file=wfile)
+                wfile.flush()
+            elif line.startswith("optima:"):
+                optimum = float(line.split()[1])
+                message = rfile.readline().strip()
+                # The daemon closes the connection when it is finished.
+                assert rfile.read() == ""
+                return optimum, message
+            elif not line.startswith("cf:"):
+                raise RuntimeError(line)
+
+
+def test_new_state():
+    default = current_state()
+    with new_state() as state:
+        assert current_state() is state and state is not default
+        _g.maxfev = 7
+        assert state.maxfev == 7 and default.maxfev == 0
+        # Other threads are not affected.
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(_g.maxfev))
+        thread.start()
+        thread.join()
+        assert seen == [0]
+        with new_state():
+            assert _g.maxfev == 0 and _g.eval_times is not state.eval_times
+        assert current_state() is state
+    assert current_state() is default
+
+
+def test_thread_local_stream():
+    default, other = io.StringIO(), io.StringIO()
+    stream = ThreadLocalStream(default)
+    print("a", file=stream)
+    with stream.redirect(other):
+        print("b", file=stream)
+        thread = threading.Thread(target=lambda: print("c", file=stream))
+        thread.start()
+        thread.join()
+    print("d", file=stream)
+    assert default.getvalue() == "a\nc\nd\n" and other.getvalue() == "b\n"
+
+
+def test_cfs(server):
+    sock, rfile, wfile = connect(server, "cfs")
+    with sock, rfile, wfile:
+        cfs = json.loads(rfile.readline())
+    assert "minabsint" in cfs and "maxrealint" in cfs
+    sock, rfile, wfile = connect(server, "nonsense")
+    with sock, rfile, wfile:
+        assert rfile.readline().startswith("Invalid command")
+
+
+def test_token(server):
+    assert len(server.token) == 32
+    assert PoiseServer(token="abc").token == "abc"
+    # Nothing is done without the right token.
+    sock, rfile, wfile = connect(server, "cfs", token="0" * 32)
+    with sock, rfile, wfile:
+        assert rfile.readline().strip() == "Invalid token"
+        assert rfile.read() == ""
+
+
+def test_concurrent_runs(server, tmp_path, p1cal):
+    # Two optimisations, with different optima, at the same time.
+    p90s = [11.7, 12.5]
+    results = [None, None]
+
+    def run(i):
+        exp = Experiment([Line(1.0, 3.0), Line(3.0, 5.0, 0.5)], p90=p90s[i])
+        routine = dict(p1cal, name=f"p1cal{i}")
+        results[i] = run_optimisation(server, routine, exp,
+                                      tmp_path / f"data{i}" / "1")
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+
+    for i, p90 in enumerate(p90s):
+        optimum, message = results[i]
+        assert optimum == pytest.approx(4 * p90, abs=0.2)
+        assert message.startswith("Optimisation terminated successfully")
+        log_df = parse_log(tmp_path / f"data{i}" / "1")
+        assert len(log_df) == 1
+        assert log_df["routine"][0] == f"p1cal{i}"
+        assert log_df["optimum"][0] == pytest.approx(optimum)
+    # The runs share the database, though.
+    assert State.p_database.exists()
+    assert server.idle_time() > 0
+
+
+def test_reload_while_busy(server, tmp_path, p1cal, monkeypatch):
+    reloaded = []
+    monkeypatch.setattr(importlib, "reload",
+                        lambda module: reloaded.append(module.__name__))
+    exp = Experiment([Line(1.0, 3.0)], p90=11.7)
+    started, resume = threading.Event(), threading.Event()
+    first = threading.Thread(target=run_optimisation, args=(
+        server, p1cal, exp, tmp_path / "data0" / "1", started, resume))
+    first.start()
+    assert started.wait(timeout=60)
+    # The cost functions are modified while the first run is in progress.
+    server.mtimes = dict.fromkeys(server.mtimes, 0)
+    optimum, _ = run_optimisation(server, dict(p1cal, name="p1cal1"), exp,
+                                  tmp_path / "data1" / "1")
+    assert optimum == pytest.approx(46.8, abs=0.2)
+    # The second run must not reload them, but says so in poise.log.
+    assert reloaded == []
+    log = (tmp_path / "data1" / "1" / "poise.log").read_text()
+    assert "Warning: nmrpoise.poise_backend.costfunctions_user has" in log
+    assert len(parse_log(tmp_path / "data1" / "1")) == 1
+    resume.set()
+    first.join(timeout=60)
+    # Once nothing else is running, they are reloaded.
+    run_optimisation(server, dict(p1cal, name="p1cal2"), exp,
+                     tmp_path / "data2" / "1")
+    assert sorted(reloaded) == ["nmrpoise.poise_backend.costfunctions",
+                                "nmrpoise.poise_backend.costfunctions_user"]
+    assert 0 not in server.mtimes.values()
+    log = (tmp_path / "data2" / "1" / "poise.log").read_text()
+    assert "Warning" not in log
+
+
+@pytest.fixture
+def topspin(tmp_path, p1cal_args):
+    exp = Experiment([Line(1.0, 3.0), Line(3.0, 5.0, 0.5)], p90=11.7)
+    topspin = MockTopSpin(tmp_path, exp)
+    topspin.run("--create", *p1cal_args)
+    yield topspin
+    topspin.run("--kill")
+
+
+def test_frontend_daemon(topspin):
+    topspin.run("p1cal", "--daemon")
+    assert topspin.errors == []
+    assert float(topspin.GETPAR("P 1")) == pytest.approx(46.8, abs=0.2)
+    daemons = topspin.daemons()
+    assert len(daemons) == 1 and topspin.backends() == []
+    # Only the owner can read the token.
+    if os.name == "posix":
+        assert daemons[0].stat().st_mode & 0o777 == 0o600
+    assert len(daemons[0].read_text().split()) == 4
+    # The same daemon is used for the next run, and for getting the cost
+    # functions.
+    topspin.PUTPAR("P 1", "48")
+    topspin.run("p1cal", "--daemon", "--maxfev", "3")
+    assert topspin.errors == []
+    assert topspin.messages[-1][1].startswith("Maximum function evaluations")
+    assert topspin.daemons() == daemons
+    topspin.run("--list")
+    assert "minabsint" in topspin.texts[-1][1]
+    log_df = parse_log(topspin.p_data / "poise_test" / "1")
+    assert list(log_df["nfev"]) == [9, 3]
+    # A run which fails doesn't stop the daemon.
+
+    def stopped(topspin):
+        topspin.PUTPAR("NS", "2")
+    topspin.au_programmes["poise_1d"] = stopped
+    topspin.run("p1cal", "-d")
+    assert "Acquisition stopped prematurely" in topspin.errors[-1][1]
+    assert topspin.daemons() == daemons
+    topspin.run("--kill")
+    assert topspin.daemons() == []
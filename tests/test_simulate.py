@@ -0,0 +1,166 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import nmrpoise
+
+from nmrpoise import parse_log
+from nmrpoise.simulate import simulate, run_offline, Experiment, Line
+from nmrpoise.poise_backend.backend import CHECKPOINT_FNAME
+from nmrpoise.poise_backend.cfhelpers import (getpar, get1d_real, get1d_fid,
+                                              make_p_spec)
+
+
+def test_experiment(tmp_path):
+    exp = Experiment([Line(1.0, 3.0), Line(3.0, 5.0, 0.5)], p90=12,
+                     b1_inhom=0)
+    # Nutation curve, fully relaxed
+    pars = exp.acquisition_pars({"p1": 12, "d1": 100})
+    assert np.allclose(exp.amplitudes(pars), [1, 0.5])
+    pars = exp.acquisition_pars({"p1": 48, "d1": 100})
+    assert np.allclose(exp.amplitudes(pars), [0, 0], atol=1e-12)
+    # Partial saturation with a short recovery delay
+    pars = exp.acquisition_pars({"p1": 12, "d1": 0})
+    assert np.all(exp.amplitudes(pars) < [1, 0.5])
+    # Acquisition time: overhead plus NS + DS scans
+    pars = exp.acquisition_pars({"NS": 4, "DS": 2, "D1": 1, "TD": 10000,
+                                 "SW_H": 5000})
+    assert exp.acquisition_time(pars) == pytest.approx(2 + 6 * (2 + 12e-6))
+
+    # Written dataset can be read back in by the cost function helpers.
+    pars = exp.acquisition_pars({"NS": 8, "CNST20": 2.5})
+    p_spec = exp.write(tmp_path / "1", pars)
+    assert p_spec == make_p_spec(path=tmp_path, expno=1, procno=1)
+    assert getpar("NS", p_spec) == 8
+    assert getpar("CNST20", p_spec) == 2.5
+    assert getpar("P1", p_spec) == 12
+    fid = get1d_fid(p_spec=p_spec)
+    assert np.allclose(fid, exp.fid(pars), atol=np.max(np.abs(fid)) * 1e-6)
+    # The tallest peak is at 1 ppm.
+    spec = get1d_real(p_spec=p_spec)
+    sw, o1p = getpar("SW", p_spec), getpar("O1", p_spec) / 500
+    shifts = np.linspace(o1p + sw / 2, o1p - sw / 2, spec.size)
+    assert shifts[np.argmax(spec)] == pytest.approx(1.0, abs=0.01)
+
+
+def test_simulate(tmp_path, p1cal):
+    exp = Experiment([Line(1.0, 3.0), Line(3.0, 5.0, 0.5)], p90=11.7,
+                     noise=0.01, seed=1)
+    result = simulate(p1cal, exp, tmp_path)
+    assert result.message == ("Optimisation terminated successfully due to"
+                              " convergence.")
+    assert result.xbest[0] == pytest.approx(46.8, abs=0.2)
+    assert result.nfev == len(result.xvals) == len(result.fvals)
+    assert result.time == pytest.approx(result.nfev * exp.acquisition_time(
+        exp.acquisition_pars()), rel=1e-4)
+    # The log is written using the simulated clock.
+    log_df = parse_log(result.p_optlog)
+    assert len(log_df) == 1
+    assert log_df["optimum"][0] == pytest.approx(result.xbest[0])
+    assert log_df["nfev"][0] == result.nfev
+    assert abs(log_df["time"][0] - result.time) <= 1
+
+
+def test_simulate_algorithm(tmp_path, p1cal):
+    # One-parameter routines only use Brent's method in auto mode.
+    exp = Experiment([Line(1.0, 3.0)], p90=11.7)
+    for algorithm, used in [("bobyqa", "bobyqa"), ("auto", "brent"),
+                            ("nm", "nm")]:
+        result = simulate(p1cal, exp, tmp_path / algorithm,
+                          algorithm=algorithm)
+        assert f"Optimisation algorithm    - {used}\n" in (
+            result.p_optlog.read_text())
+        assert result.xbest[0] == pytest.approx(46.8, abs=0.3)
+
+
+@pytest.mark.parametrize("algorithm", ["nm", "mds", "bobyqa"])
+@pytest.mark.parametrize("steps", [[1, None], [0.5, None], [1, 0.2]])
+def test_simulate_steps(tmp_path, algorithm, steps):
+    # The intensity is largest at (3, 5), which is on every lattice.
+    def response(pars):
+        a, b = pars["CNST1"] - 3, pars["CNST2"] - 5
+        return 1 - (a ** 2 + b ** 2 + 0.8 * a * b) / 100
+
+    exp = Experiment([Line(1.0, 3.0)], response=response)
+    routine = {"name": "lattice", "pars": ["cnst1", "cnst2"],
+               "lb": [0.0, 0.0], "ub": [10.0, 10.0], "init": [7.0, 8.0],
+               "tol": [0.1, 0.1], "steps": steps, "cf": "maxrealint",
+               "au": "poise_1d"}
+    result = simulate(routine, exp, tmp_path, algorithm=algorithm)
+    assert result.message == ("Optimisation terminated successfully due to"
+                              " convergence.")
+    assert result.xbest[0] == 3
+    assert result.xbest[1] == pytest.approx(5, abs=0.1)
+    assert "Lattice search" in result.p_optlog.read_text()
+
+
+def test_simulate_maxtime(tmp_path, p1cal):
+    exp = Experiment([Line(1.0, 3.0)], p90=11.7, pars={"NS": 8})
+    t_spec = exp.acquisition_time(exp.acquisition_pars())
+    result = simulate(p1cal, exp, tmp_path / "a", maxtime=4.5 * t_spec)
+    assert result.nfev == 4
+    assert "time budget" in result.message
+
+    # In multi-fidelity mode, the exploratory spectra are quicker.
+    result = simulate(p1cal, exp, tmp_path / "b", explore_ns=1)
+    assert result.time < result.nfev * t_spec
+    assert abs(result.xbest[0] - 46.8) < 0.2
+
+
+def test_simulate_error(tmp_path, p1cal):
+    exp = Experiment([Line(1.0, 3.0)])
+    routine = dict(p1cal, cf="no_such_cf")
+    with pytest.raises(RuntimeError, match="AttributeError"):
+        simulate(routine, exp, tmp_path)
+
+
+def test_resume_auto(tmp_path, p1cal):
+    exp = Experiment([Line(1.0, 3.0)], p90=11.7)
+    routine = dict(p1cal, name="p1d1", pars=["p1", "d1"], lb=[40.0, 0.5],
+                   ub=[56.0, 2.0], init=[48.0, 1.0], tol=[0.2, 0.1])
+    p_expno = tmp_path / "1"
+    calls = []
+    stop_after = 4
+
+    def acquire(values):
+        # The "spectrometer" stops after the initial spectrum and three
+        # evaluations, which leaves the checkpoint behind.
+        if len(calls) == stop_after:
+            raise KeyboardInterrupt
+        calls.append(values)
+        return exp.write(p_expno, exp.acquisition_pars(values)), 1
+
+    with pytest.raises(KeyboardInterrupt):
+        run_offline(routine, acquire, tmp_path, algorithm="auto")
+    checkpoint = json.loads((p_expno / CHECKPOINT_FNAME).read_text())
+    # The checkpoint records the optimiser which was actually chosen.
+    assert checkpoint["optimiser"] in ["nm", "mds", "bobyqa"]
+    assert len(checkpoint["history"]) == 3
+
+    stop_after = None
+    result = run_offline(routine, acquire, tmp_path, algorithm="auto",
+                         resume=True)
+    assert result.message.startswith("Optimisation terminated successfully")
+    last_run = result.p_optlog.read_text().split("=" * 40)[-1]
+    assert f"- {checkpoint['optimiser']}" in last_run
+    assert "Chosen automatically" not in last_run
+
+
+def test_no_pidfile(tmp_path, p1cal):
+    # Offline backends don't write .pid files into the package, where they
+    # would be left behind if the backend is killed.
+    p_backend = Path(nmrpoise.__file__).parent / "poise_backend"
+    before = set(p_backend.glob(".pid*"))
+    exp = Experiment([Line(1.0, 3.0)], p90=11.7)
+    p_expno = tmp_path / "1"
+    seen = []
+
+    def acquire(values):
+        seen.append(set(p_backend.glob(".pid*")) - before)
+        pars = exp.acquisition_pars(values)
+        return exp.write(p_expno, pars), 1
+
+    run_offline(p1cal, acquire, tmp_path, maxfev=3)
+    assert len(seen) == 4 and not any(seen)
@@ -0,0 +1,73 @@
+import json
+
+import numpy as np
+import pytest
+
+from nmrpoise.study import run_study, summarise, main, LOG_COLUMNS
+
+
+MODEL = {"lines": [[1.0, 3.0], [3.0, 5.0, 0.5]], "p90": 11.7}
+
+
+def test_run_study(p1cal):
+    runs_df = run_study(p1cal, MODEL, algorithms=["auto"],
+                        settings={"noise": [0.01], "tol_scale": [1, 3]},
+                        reps=2, optimum=[46.8], processes=2)
+    assert len(runs_df) == 4
+    # Compatible with parse_log()
+    assert list(runs_df.columns[:len(LOG_COLUMNS)]) == LOG_COLUMNS
+    assert list(runs_df["tol_scale"]) == [1, 1, 3, 3]
+    assert list(runs_df["seed"]) == [0, 1, 0, 1]
+    # The algorithm actually used is recorded.
+    assert np.all(runs_df["algorithm"] == "brent")
+    assert np.allclose(runs_df["error"],
+                       np.abs(runs_df["optimum"] - 46.8) / 0.2)
+    assert not np.any(runs_df["failed"])
+    # Larger tolerances need fewer spectra.
+    summary_df = summarise(runs_df)
+    assert list(summary_df["tol_scale"]) == [1, 3]
+    assert list(summary_df["runs"]) == [2, 2]
+    assert summary_df["nfev_mean"][1] < summary_df["nfev_mean"][0]
+    assert np.all(summary_df["fail_rate"] == 0)
+
+    assert list(summary_df["requested"]) == ["auto", "auto"]
+    assert list(summary_df["algorithm"]) == ["brent", "brent"]
+
+    with pytest.raises(ValueError, match="Unknown setting"):
+        run_study(p1cal, MODEL, settings={"xtol": [1]})
+
+
+def test_study_auto_vs_explicit(p1cal):
+    # Runs are grouped by the algorithm requested, even if "auto" resolves to
+    # an algorithm which was also requested explicitly.
+    runs_df = run_study(p1cal, MODEL, algorithms=["auto", "brent", "nm"],
+                        reps=2, optimum=[46.8], processes=2)
+    assert list(runs_df["requested"]) == ["auto"] * 2 + ["brent"] * 2 + \
+        ["nm"] * 2
+    assert list(runs_df["algorithm"]) == ["brent"] * 4 + ["nm"] * 2
+    summary_df = summarise(runs_df)
+    assert list(summary_df["requested"]) == ["auto", "brent", "nm"]
+    assert list(summary_df["algorithm"]) == ["brent", "brent", "nm"]
+    assert list(summary_df["runs"]) == [2, 2, 2]
+
+
+def test_study_failures(p1cal):
+    # A run which raises an error counts as a failure.
+    runs_df = run_study(dict(p1cal, cf="no_such_cf"), MODEL,
+                        algorithms=["bobyqa"], reps=1, optimum=[46.8])
+    assert runs_df["optimum"][0] is None
+    assert runs_df["requested"][0] == "bobyqa"
+    assert "AttributeError" in runs_df["message"][0]
+    assert runs_df["failed"][0]
+
+
+def test_study_cli(tmp_path, capsys, p1cal):
+    p_routine, p_model = tmp_path / "p1cal.json", tmp_path / "model.json"
+    p_routine.write_text(json.dumps(p1cal))
+    p_model.write_text(json.dumps(MODEL))
+    p_out = tmp_path / "runs.csv"
+    main([str(p_routine), str(p_model), "-a", "nm", "-n", "1",
+          "--maxfev", "4", "6", "-o", str(p_out)])
+    out = capsys.readouterr().out
+    assert "nfev_mean" in out and "fail_rate" in out
+    assert len(p_out.read_text().splitlines()) == 3
@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+from nmrpoise.synthetic import (to_int32, encode, to_submatrices, write_fid,
+                                write_1d, write_2d, write_spectrum,
+                                process_1d)
+from nmrpoise.poise_backend.cfhelpers import (getpar, getndim, get1d_fid,
+                                              get1d_real, get1d_imag,
+                                              get2d_rr, get2d_ii,
+                                              _ppm_to_point)
+
+
+ACQUS = {"SW_H": 5000.0, "SFO1": 500.0, "O1": 2500.0, "P1": 12.5,
+         "CNST20": 3, "PULPROG": "zg"}
+
+
+def make_fid(n, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n) / 5000.0
+    return (np.exp((2j * np.pi * 800 - np.pi * 3) * t)
+            + 0.01 * (rng.standard_normal(n) + 1j * rng.standard_normal(n)))
+
+
+def test_encode():
+    data = np.array([1.5, -2.0, 1e-3])
+    ints, nc = encode(data)
+    assert ints.dtype == np.dtype("<i4")
+    assert np.allclose(ints * 2.0 ** nc, data, atol=2.0 ** nc)
+    assert np.array_equal(ints, to_int32(data)[0])
+    doubles, nc = encode(data, dtype=2, byteorder=1)
+    assert doubles.dtype == np.dtype(">f8") and nc == 0
+    assert np.array_equal(doubles, data)
+    ints, nc = encode(data, nc=-10)
+    assert nc == -10 and ints[0] == 1536
+    with pytest.raises(ValueError, match="data type"):
+        encode(data, dtype=1)
+    with pytest.raises(ValueError, match="byte order"):
+        encode(data, byteorder=2)
+
+
+@pytest.mark.parametrize("dtypa, bytorda", [(0, 0), (0, 1), (2, 0), (2, 1)])
+def test_write_1d(tmp_path, dtypa, bytorda):
+    fid = make_fid(4096)
+    p_spec = write_1d(tmp_path / "1", fid, acqus=ACQUS, dtypa=dtypa,
+                      bytorda=bytorda, dtypp=dtypa, bytordp=bytorda)
+    assert p_spec == tmp_path / "1" / "pdata" / "1"
+    assert getndim(p_spec) == 1
+    assert getpar("TD", p_spec) == 8192
+    assert getpar("P1", p_spec) == 12.5
+    assert getpar("CNST20", p_spec) == 3
+    assert getpar("SI", p_spec) == 4096
+    assert getpar("DTYPA", p_spec) == dtypa
+    assert getpar("BYTORDP", p_spec) == bytorda
+    # Integers are only accurate up to the scaling.
+    atol = 1e-7 if dtypa == 0 else 1e-12
+    assert np.allclose(get1d_fid(p_spec=p_spec), fid, atol=atol)
+    spec = process_1d(fid)
+    atol = np.max(np.abs(spec)) * 1e-7
+    assert np.allclose(get1d_real(p_spec=p_spec), spec.real, atol=atol)
+    assert np.allclose(get1d_imag(p_spec=p_spec), spec.imag, atol=atol)
+    # The peak is at the right chemical shift (O1P + 800 Hz).
+    peak = get1d_real(bounds="6.5..6.7", p_spec=p_spec)
+    assert np.max(peak) == pytest.approx(np.max(spec.real), rel=1e-6)
+
+
+def test_write_ser(tmp_path):
+    ser = np.stack([make_fid(100, seed) for seed in range(3)])
+    write_fid(tmp_path / "2", ser, acqus=ACQUS, acqu2s={"SFO1": 125.0},
+              dtypa=2, bytorda=1)
+    data = np.fromfile(tmp_path / "2" / "ser", dtype=">f8")
+    # Each FID is padded to 1024 bytes (128 doubles).
+    assert data.size == 3 * 256
+    data = data.reshape(3, 256)
+    assert np.all(data[:, 200:] == 0)
+    assert np.allclose(data[:, 0:200:2] + 1j * data[:, 1:200:2], ser)
+    p_spec = tmp_path / "2" / "pdata" / "1"
+    assert getndim(p_spec) == 2
+    assert np.array_equal(getpar("TD", p_spec), [3, 200])
+    assert np.array_equal(getpar("SFO1", p_spec), [125.0, 500.0])
+
+
+def test_to_submatrices():
+    data = np.arange(24).reshape(4, 6)
+    assert np.array_equal(to_submatrices(data, (4, 6)), np.arange(24))
+    assert list(to_submatrices(data, (2, 3))[:9]) == [0, 1, 2, 6, 7, 8,
+                                                      3, 4, 5]
+    with pytest.raises(ValueError, match="does not divide"):
+        to_submatrices(data, (3, 3))
+
+
+@pytest.mark.parametrize("xdim, dtypp, bytordp",
+                         [(None, 0, 0), ((16, 64), 0, 0), ((8, 32), 2, 1),
+                          ((64, 16), 0, 1)])
+def test_write_2d(tmp_path, xdim, dtypp, bytordp):
+    rng = np.random.default_rng(0)
+    rr = rng.standard_normal((64, 128))
+    ii = rng.standard_normal((64, 128))
+    p_spec = write_2d(tmp_path / "101", {"2rr": rr, "2ii": ii},
+                      acqus=ACQUS, acqu2s={"SW_H": 10000.0, "SFO1": 125.0,
+                                           "O1": 12500.0},
+                      xdim=xdim, dtypp=dtypp, bytordp=bytordp)
+    assert np.array_equal(getpar("SI", p_spec), [64, 128])
+    assert np.array_equal(getpar("XDIM", p_spec), xdim or [64, 128])
+    assert np.array_equal(getpar("SW", p_spec), [80, 10])
+    atol = 1e-7 if dtypp == 0 else 0
+    assert np.allclose(get2d_rr(p_spec=p_spec), rr, atol=atol)
+    assert np.allclose(get2d_ii(p_spec=p_spec), ii, atol=atol)
+    # F1 runs from 140 to 60 ppm, and F2 from 10 to 0 ppm.
+    sub = get2d_rr(f1_bounds="90..110", f2_bounds="4..6", p_spec=p_spec)
+    i0, i1 = [_ppm_to_point(x, axis=0, p_spec=p_spec) for x in [110, 90]]
+    j0, j1 = [_ppm_to_point(x, axis=1, p_spec=p_spec) for x in [6, 4]]
+    assert np.allclose(sub, rr[i0:i1 + 1, j0:j1 + 1], atol=atol)
+
+
+def test_write_spectrum_procno(tmp_path):
+    write_1d(tmp_path / "1", make_fid(512), acqus=ACQUS)
+    spec = np.ones(512) * (2 + 1j)
+    p_spec = write_spectrum(tmp_path / "1", spec, acqus=ACQUS, procno=2,
+                            procs={"SI": 512, "PHC0": 90})
+    assert p_spec.name == "2"
+    assert getpar("PHC0", p_spec) == 90
+    assert np.allclose(get1d_real(p_spec=p_spec), 2)
+    assert np.allclose(get1d_imag(p_spec=p_spec), 1)
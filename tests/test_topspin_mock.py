@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+from nmrpoise import parse_log
+from nmrpoise.simulate import Experiment, Line
+from nmrpoise.topspin_mock import MockTopSpin
+
+
+@pytest.fixture
+def topspin(tmp_path, p1cal_args):
+    exp = Experiment([Line(1.0, 3.0), Line(3.0, 5.0, 0.5)], p90=11.7)
+    topspin = MockTopSpin(tmp_path, exp)
+    topspin.run("--create", *p1cal_args)
+    return topspin
+
+
+def test_create_list(topspin):
+    p_routine = topspin.p_poise / "routines" / "p1cal.json"
+    routine = json.loads(p_routine.read_text())
+    assert routine["pars"] == ["p1"] and routine["init"] == [48.0]
+    topspin.run("--list")
+    title, text = topspin.texts[-1]
+    assert "p1cal" in text and "minabsint" in text
+
+    # Creating a routine interactively
+    topspin.dialogs = [1, ["p1cal2"], ["p1"], ["40", "56", "48", "0.5"],
+                       ["minabsint", "poise_1d"], 1]
+    topspin.run()
+    p_routine = topspin.p_poise / "routines" / "p1cal2.json"
+    assert json.loads(p_routine.read_text())["tol"] == [0.5]
+    assert topspin.errors == []
+
+
+def test_optimisation(topspin):
+    topspin.run("p1cal")
+    assert topspin.errors == []
+    title, message = topspin.messages[-1]
+    assert message.startswith("Optimisation terminated successfully")
+    optimum = float(topspin.GETPAR("P 1"))
+    assert optimum == pytest.approx(46.8, abs=0.2)
+    # One spectrum before the optimisation, plus one per evaluation.
+    log_df = parse_log(topspin.p_data / "poise_test" / "1")
+    assert log_df["optimum"][0] == pytest.approx(optimum)
+    assert len(topspin.au_times) == log_df["nfev"][0]
+    assert len(topspin.overheads) == log_df["nfev"][0] - 1
+    assert not list(topspin.p_poise.glob(".pid*"))
+
+
+def test_optimisation_separate(topspin):
+    topspin.run("p1cal", "--separate", "-q")
+    assert topspin.errors == []
+    assert topspin.messages == []
+    nfev = len(topspin.au_times)
+    assert topspin.CURDATA()[1] == str(nfev)
+    p_expnos = sorted(topspin.p_data.glob("poise_test/*/acqus"))
+    assert len(p_expnos) == nfev
+    # The optimum isn't set anywhere, and each expno has its own value.
+    p1s = [float(topspin.pars[str(i)]["fg"][("P1", 0)])
+           for i in range(1, nfev + 1)]
+    assert len(set(p1s)) == nfev
+    # Running again would overwrite the next expno.
+    topspin.RE(["poise_test", "2", "1", str(topspin.p_data), "user"])
+    topspin.run("p1cal", "--separate")
+    assert "Existing dataset" in topspin.errors[-1][1]
+    assert not list(topspin.p_poise.glob(".pid*"))
+
+
+def test_errors(topspin):
+    topspin.run("nonexistent")
+    assert "was not found" in topspin.errors[-1][1]
+
+    # Acquisition which doesn't finish
+    def stopped(topspin):
+        topspin.PUTPAR("NS", "2")
+    topspin.au_programmes["poise_1d"] = stopped
+    topspin.run("p1cal")
+    assert "Acquisition stopped prematurely" in topspin.errors[-1][1]
+    assert topspin.GETPAR("TI") == " "
+    assert not list(topspin.p_poise.glob(".pid*"))
+
+
+def test_custom_au(topspin, p1cal_args):
+    topspin.run("--create", "p1cal_au", *p1cal_args[1:-1], "my_au")
+    topspin.run("p1cal_au")
+    assert "my_au was not found" in topspin.errors[-1][1]
+    calls = []
+
+    def my_au(topspin):
+        calls.append(topspin.GETPAR("P 1"))
+        topspin.acquire()
+    topspin.au_programmes["my_au"] = my_au
+    topspin.run("p1cal_au", "--maxfev", "3")
+    assert len(calls) == 3 and calls[0] == "48"
+    assert "(so far)" in topspin.messages[-1][1]